@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from gui.logic.processor import ImageProcessor
+
+TEST_IMAGES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_images")
+
+def run(path, point, pyramid):
+    processor = ImageProcessor(debug=False, pyramid=pyramid)
+    
+    start = time.perf_counter()
+    processor.load_image(path)
+    processor.process_click_at(point[0], point[1], render=False)
+    _, report = processor.run_full_analysis(render=False)
+    elapsed = time.perf_counter() - start
+    
+    return elapsed, report, processor
+
+def mean_nearest(a, b):
+    # Mean distance from each point of a to the closest point of b
+    if not a or not b:
+        return float('nan')
+    dists, _ = cKDTree(np.asarray(b, dtype=np.float64)).query(np.asarray(a, dtype=np.float64))
+    return float(np.mean(dists))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pyramid (coarse-to-fine) mode vs full-resolution analysis")
+    parser.add_argument("--images", default=TEST_IMAGES, help="Directory with images and seeds.json")
+    args = parser.parse_args(argv)
+    
+    with open(os.path.join(args.images, "seeds.json")) as f:
+        seeds = json.load(f)
+        
+    print(f"{'image':30s} {'full s':>7s} {'pyr s':>7s} {'speedup':>8s} {'level':>5s}  "
+          f"{'count':>7s} {'dir':>11s} {'width':>13s} {'spine px':>8s} {'stitch px':>9s}")
+    
+    for name, point in seeds.items():
+        path = os.path.join(args.images, name)
+        t_full, rep_full, full = run(path, point, False)
+        t_pyr, rep_pyr, pyr = run(path, point, True)
+        
+        if not rep_full or not rep_pyr:
+            print(f"{name:30s} no result (full={rep_full}, pyramid={rep_pyr})")
+            continue
+            
+        spine_err = mean_nearest(pyr.spine_points, full.spine_points)
+        stitch_err = mean_nearest(pyr.stitch_points, full.stitch_points)
+        
+        print(f"{name:30s} {t_full:7.2f} {t_pyr:7.2f} {t_full / t_pyr:7.1f}x {pyr.level:5d}  "
+              f"{rep_full['count']:>3d}/{rep_pyr['count']:<3d} {rep_full['direction']:>5s}/{rep_pyr['direction']:<5s} "
+              f"{rep_full['width']:6.1f}/{rep_pyr['width']:<6.1f} {spine_err:8.1f} {stitch_err:9.1f}")
+        
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+import cv2
+import numpy as np
+from skimage.morphology import skeletonize
+
+from gui.logic.processor import ImageProcessor
+import postprocessing.yarn_framing as yarn_framing
+import postprocessing.direction_detection as direction_detection
+
+TEST_IMAGES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_images")
+
+def best_time(func, arg, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def photo_skeletons(image_dir):
+    with open(os.path.join(image_dir, "seeds.json")) as f:
+        seeds = json.load(f)
+        
+    for name, (x, y) in seeds.items():
+        processor = ImageProcessor()
+        processor.load_image(os.path.join(image_dir, name))
+        processor.process_click_at(x, y)
+        yield name, skeletonize(processor.current_mask > 0)
+
+def synthetic_skeletons(lengths):
+    # Sinuous yarn-like strokes, skeletonized like a real mask
+    for length in lengths:
+        width = length + 200
+        mask = np.zeros((800, width), np.uint8)
+        xs = np.arange(100, 100 + length)
+        ys = (400 + 250 * np.sin(xs / 300.0)).astype(np.int32)
+        pts = np.stack((xs, ys), axis=1).reshape((-1, 1, 2))
+        cv2.polylines(mask, [pts], False, 255, 40)
+        yield f"synthetic_{length}px", skeletonize(mask > 0)
+
+def compare(label, skeleton, repeat):
+    t_array, path_array = best_time(yarn_framing.trace_longest_path, skeleton, repeat)
+    t_graph, path_graph = best_time(yarn_framing.trace_longest_path_networkx, skeleton, repeat)
+    
+    # Equal-length alternatives can be broken differently, so compare endpoints and pixel agreement
+    same_ends = set((path_array[0], path_array[-1])) == set((path_graph[0], path_graph[-1]))
+    if path_array[0] != path_graph[0]:
+        path_array = path_array[::-1]
+    differing = sum(a != b for a, b in zip(path_array, path_graph)) + abs(len(path_array) - len(path_graph))
+    
+    print(f"{label:32s} {int(skeleton.sum()):8d} {t_graph * 1000:10.1f} {t_array * 1000:10.1f} "
+          f"{t_graph / t_array:8.1f}x  ends={'ok' if same_ends else 'DIFF'} diff_px={differing}")
+
+def path_stages(points, mask):
+    # The spine consumers that derive tangents, each handed the same points
+    yarn_framing.measure_width_at_center(points, mask)
+    yarn_framing.measure_width_profile(points, mask)
+    direction_detection.check_visual_spine_direction(mask.shape, points, 1)
+
+def compare_path(label, skeleton, repeat):
+    # List of (x, y) tuples against one SpinePath shared by the stages: bytes held and stage time
+    path = yarn_framing.trace_longest_path(skeleton)
+    tracemalloc.start()
+    points = path.tolist()
+    list_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    mask = cv2.dilate(skeleton.astype(np.uint8) * 255, np.ones((41, 41), np.uint8))
+    t_list, _ = best_time(lambda pts: path_stages(pts, mask), points, repeat)
+    t_path, _ = best_time(lambda pts: path_stages(pts, mask), path, repeat)
+    derived_bytes = path.nbytes - path.points.nbytes
+    
+    print(f"{label:32s} {len(path):8d} {list_bytes / 1024:10.1f} {path.points.nbytes / 1024:10.1f} "
+          f"{derived_bytes / 1024:10.1f} {t_list * 1000:10.1f} {t_path * 1000:10.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Array spine tracer vs networkx reference")
+    parser.add_argument("--images", default=TEST_IMAGES, help="Directory with images and seeds.json")
+    parser.add_argument("--synthetic", type=int, nargs="*", default=[5000, 20000, 50000],
+                        help="Synthetic stroke lengths in pixels")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    
+    print(f"{'skeleton':32s} {'pixels':>8s} {'nx ms':>10s} {'array ms':>10s} {'speedup':>9s}")
+    
+    for label, skeleton in photo_skeletons(args.images):
+        compare(label, skeleton, args.repeat)
+        
+    for label, skeleton in synthetic_skeletons(args.synthetic):
+        compare(label, skeleton, args.repeat)
+        
+    print()
+    print(f"{'spine':32s} {'points':>8s} {'list KiB':>10s} {'array KiB':>10s} {'derived':>10s} "
+          f"{'list ms':>10s} {'path ms':>10s}")
+    for label, skeleton in synthetic_skeletons(args.synthetic):
+        compare_path(label, skeleton, args.repeat)
+        
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from gui.logic.processor import ImageProcessor
+import preprocessing.filters as filters
+import preprocessing.hue_isolator as hue_isolator
+import postprocessing.yarn_framing as yarn_framing
+import postprocessing.stitch_detection as stitch_detection
+import postprocessing.direction_detection as direction_detection
+
+TEST_IMAGES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_images")
+
+DEFAULT_SIZES = "native,1,4,12,48"
+# Memory changes below this are noise from small bookkeeping allocations
+MIN_PEAK_BYTES = 1 << 20
+STAGES = (
+    "bilateral_filter",
+    "dominant_color",
+    "isolation_mask",
+    "find_spine",
+    "width_at_center",
+    "width_profile",
+    "detect_stitches",
+    "determine_direction",
+)
+
+def resize_to_megapixels(image, point, megapixels):
+    # Same aspect ratio, scaled to about megapixels; the seed point moves with it
+    h, w = image.shape[:2]
+    scale = np.sqrt(megapixels * 1e6 / (h * w))
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(image, size, interpolation=interpolation)
+    x = min(size[0] - 1, int(point[0] * scale))
+    y = min(size[1] - 1, int(point[1] * scale))
+    return resized, (x, y)
+
+def stage_calls(image, point):
+    # (stage, call, keep, ready) in pipeline order. keep stores a call's result as
+    # input for the stages after it; ready says whether the stage has inputs at all
+    x, y = point
+    state = {}
+
+    def bilateral():
+        return filters.apply_bilateral_filter(image)
+
+    def dominant():
+        return hue_isolator.get_dominant_color_name(state["blurred"], x, y)
+
+    def isolation():
+        return hue_isolator.get_isolation_mask(state["blurred"], state["color"], (x, y))
+
+    def spine():
+        return yarn_framing.find_spine(state["masked"])
+
+    def width():
+        return yarn_framing.measure_width_at_center(state["spine"], state["mask"])
+
+    def profile():
+        return yarn_framing.measure_width_profile(state["spine"], state["mask"])
+
+    def stitches():
+        return stitch_detection.detect_stitches(state["masked"], state["mask"], state["spine"], state["half_width"])
+
+    def direction():
+        gray = cv2.cvtColor(state["masked"], cv2.COLOR_BGR2GRAY)
+        return direction_detection.determine_direction(gray, state["spine"], state["stitches"], state["half_width"])
+
+    def keep(name):
+        def store(result):
+            state[name] = result
+            if name == "mask":
+                state["masked"] = hue_isolator.apply_mask_to_image(state["blurred"], result)
+            elif name == "width_info":
+                state["half_width"] = result[2] if result else None
+        return store
+
+    return [
+        ("bilateral_filter", bilateral, keep("blurred"), lambda: True),
+        ("dominant_color", dominant, keep("color"), lambda: True),
+        ("isolation_mask", isolation, keep("mask"), lambda: state.get("color") is not None),
+        ("find_spine", spine, keep("spine"), lambda: "mask" in state),
+        ("width_at_center", width, keep("width_info"), lambda: bool(state.get("spine"))),
+        ("width_profile", profile, keep("profile"), lambda: bool(state.get("spine"))),
+        ("detect_stitches", stitches, keep("stitches"), lambda: state.get("half_width") is not None),
+        ("determine_direction", direction, keep("direction"), lambda: bool(state.get("stitches"))),
+    ]
+
+def measure(call, repeat):
+    # Best wall time over repeat runs, then one extra run under tracemalloc for the
+    # peak of Python and NumPy allocations (tracing slows the call down, so it is not timed)
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = call()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak, result
+
+def time_load(path, repeat):
+    def load():
+        processor = ImageProcessor(debug=False)
+        processor.load_image(path)
+        return processor.original_cv_image
+    return measure(load, repeat)
+
+def run_suite(image_dir, sizes, stages, repeat):
+    with open(os.path.join(image_dir, "seeds.json")) as f:
+        seeds = json.load(f)
+
+    results = []
+    for name, point in seeds.items():
+        path = os.path.join(image_dir, name)
+        seconds, peak, original = time_load(path, repeat)
+        results.append(record(name, "native", original.shape, "load_image", seconds, peak))
+
+        for size in sizes:
+            if size == "native":
+                image, seed = original, tuple(point)
+            else:
+                image, seed = resize_to_megapixels(original, point, float(size))
+
+            for stage, call, keep, ready in stage_calls(image, seed):
+                if not ready():
+                    break
+                seconds, peak, result = measure(call, repeat)
+                keep(result)
+                if stage in stages:
+                    results.append(record(name, size, image.shape, stage, seconds, peak))
+
+            del image
+
+    return results
+
+def record(image, size, shape, stage, seconds, peak):
+    entry = {
+        "image": image,
+        "size": size if size == "native" else f"{size}MP",
+        "shape": [int(shape[0]), int(shape[1])],
+        "stage": stage,
+        "seconds": round(seconds, 6),
+        "peak_bytes": int(peak)
+    }
+    print(f"{image:30s} {entry['size']:>7s} {shape[1]:>5d}x{shape[0]:<5d} {stage:20s} "
+          f"{seconds:9.3f}s {peak / 2**20:9.1f}MB", flush=True)
+    return entry
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "opencv_threads": cv2.getNumThreads(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+def compare(baseline, current, threshold, min_seconds):
+    # Regressions: slower (or heavier) than baseline by more than threshold, ignoring
+    # stages too quick in both runs to time reliably
+    def key(entry):
+        return entry["image"], entry["size"], entry["stage"]
+
+    before = {key(entry): entry for entry in baseline["results"]}
+    regressions = []
+
+    print(f"{'image':30s} {'size':>7s} {'stage':20s} {'base s':>9s} {'now s':>9s} {'ratio':>6s} {'mem':>6s}")
+    for entry in current["results"]:
+        old = before.get(key(entry))
+        if old is None:
+            continue
+
+        time_ratio = entry["seconds"] / old["seconds"] if old["seconds"] > 0 else float('inf')
+        mem_ratio = entry["peak_bytes"] / old["peak_bytes"] if old["peak_bytes"] > 0 else 1.0
+
+        slower = time_ratio > 1 + threshold and max(entry["seconds"], old["seconds"]) >= min_seconds
+        heavier = mem_ratio > 1 + threshold and max(entry["peak_bytes"], old["peak_bytes"]) >= MIN_PEAK_BYTES
+        flag = ""
+        if slower or heavier:
+            flag = "  REGRESSION (" + ", ".join(
+                label for label, hit in (("time", slower), ("memory", heavier)) if hit
+            ) + ")"
+            regressions.append(dict(entry, time_ratio=time_ratio, memory_ratio=mem_ratio))
+
+        print(f"{entry['image']:30s} {entry['size']:>7s} {entry['stage']:20s} {old['seconds']:9.3f} "
+              f"{entry['seconds']:9.3f} {time_ratio:6.2f} {mem_ratio:6.2f}{flag}")
+
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-stage wall time and peak memory at several image sizes")
+    parser.add_argument("--images", default=TEST_IMAGES, help="Directory with images and seeds.json")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help=f"Comma separated megapixel targets, 'native' for the file as is (default {DEFAULT_SIZES})")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma separated subset of stages to report")
+    parser.add_argument("--repeat", type=int, default=1, help="Timed runs per stage; the best is kept")
+    parser.add_argument("--output", "-o", help="Write the JSON report here")
+    parser.add_argument("--compare", metavar="BASELINE", help="Flag regressions against a saved JSON report")
+    parser.add_argument("--current", metavar="REPORT", help="Compare this saved report instead of running the suite")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown before flagging (0.2 = 20%%)")
+    parser.add_argument("--min-seconds", type=float, default=0.05,
+                        help="Ignore time regressions on stages faster than this in both runs")
+    args = parser.parse_args(argv)
+
+    if args.current:
+        with open(args.current) as f:
+            report = json.load(f)
+    else:
+        sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+        stages = {stage.strip() for stage in args.stages.split(",") if stage.strip()}
+        unknown = stages.difference(STAGES)
+        if unknown:
+            parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+        report = {
+            "environment": environment(),
+            "repeat": args.repeat,
+            "results": run_suite(args.images, sizes, stages, max(1, args.repeat))
+        }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold, args.min_seconds)
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}", file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import argparse
+import sys
+
+import crochet.batch as batch
+import crochet.stream as stream
+import crochet.server as server
+import gui.logic.result_cache as result_cache
+import preprocessing.hue_isolator as hue_isolator
+
+def parse_point(text):
+    try:
+        fx, fy = (float(v) for v in text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected FX,FY fractions, got '{text}'")
+        
+    if not (0.0 <= fx <= 1.0 and 0.0 <= fy <= 1.0):
+        raise argparse.ArgumentTypeError("point fractions must be between 0 and 1")
+        
+    return fx, fy
+
+def parse_color(text):
+    if not hue_isolator.get_color_ranges(text):
+        raise argparse.ArgumentTypeError(f"unknown colour '{text}'")
+        
+    return text.lower()
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache", default=None, metavar="DIR",
+                        help="Result cache directory (default: $CROCHET_CACHE_DIR or ~/.cache/crochet-analyzer)")
+    parser.add_argument("--cache-size", type=int, default=result_cache.DEFAULT_MAX_BYTES // (1024 * 1024), metavar="MB",
+                        help="Evict least recently used cache entries beyond this size (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always recompute, and do not store results")
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="crochet", description="Headless Crochet Pattern Analyzer")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    analyze = subparsers.add_parser("analyze", help="Analyze every image in a directory")
+    analyze.add_argument("path", help="Image file or directory (searched recursively)")
+    analyze.add_argument("--workers", type=int, default=None,
+                         help="Worker processes (default: one per CPU, 1 runs in-process)")
+    analyze.add_argument("--point", type=parse_point, default=None,
+                         help="Seed point as FX,FY fractions of the image size (default: 0.5,0.5)")
+    analyze.add_argument("--color", type=parse_color, default=None,
+                         help="Yarn colour name; without --point the largest blob of this colour is used")
+    analyze.add_argument("--seeds", default=None,
+                         help="JSON file mapping image file names to [x, y] pixel seed points")
+    modes = analyze.add_mutually_exclusive_group()
+    modes.add_argument("--pyramid", action="store_true",
+                       help="Coarse-to-fine mode: isolate and trace on a downscaled copy, refine at full resolution")
+    modes.add_argument("--memory-budget", type=int, default=None, metavar="MB",
+                       help="Tiled mode for very large scans: work on disk-backed tiles, keeping each worker's "
+                            "working memory near MB megabytes. Uncompressed TIFF, BMP and PPM files are read a band "
+                            "at a time; JPEG, PNG and compressed TIFF decode whole, which must fit in MB as well")
+    analyze.add_argument("--all-components", action="store_true",
+                         help="Analyze every sufficiently large blob of the seed's colour, listed under \"components\" "
+                              "(largest first) instead of the top-level count")
+    analyze.add_argument("--max-side", type=int, default=None, metavar="PX",
+                         help="Decode each image shrunk by a power of two towards this long side (fast for JPEG); "
+                              "seeds and widths stay in file pixels")
+    analyze.add_argument("--max-level", type=int, default=0, metavar="N",
+                         help="With --memory-budget, find stitches on the yarn window downscaled up to 2**N times when "
+                              "it does not fit the budget, instead of tile by tile at full resolution; faster, but "
+                              "the count can change (default: 0, never downscale)")
+    analyze.add_argument("--scratch", default=None,
+                         help="Directory for the tiled mode's disk-backed planes (default: the system temp directory)")
+    add_cache_arguments(analyze)
+    analyze.add_argument("--output", "-o", default=None,
+                         help="Write JSON lines here instead of stdout")
+    analyze.set_defaults(func=batch.main)
+    
+    live = subparsers.add_parser("stream", help="Count stitches continuously on a video file or camera")
+    live.add_argument("source", help="Video file, or a camera index such as 0")
+    live.add_argument("--point", type=parse_point, default=None,
+                      help="Seed point in the first frame as FX,FY fractions of the frame size (default: 0.5,0.5)")
+    live.add_argument("--color", type=parse_color, default=None,
+                      help="Yarn colour name; without --point the largest blob of this colour is used")
+    live.add_argument("--drift-threshold", type=float, default=stream.DRIFT_THRESHOLD,
+                      help="Mean grey-level change inside the yarn that triggers a recompute "
+                           f"(default: {stream.DRIFT_THRESHOLD})")
+    live.add_argument("--keyframe-interval", type=int, default=stream.KEYFRAME_INTERVAL,
+                      help=f"Recompute at least every this many frames (default: {stream.KEYFRAME_INTERVAL})")
+    live.add_argument("--check-interval", type=int, default=stream.CHECK_INTERVAL,
+                      help="Recompute a tracked frame this often and make it the keyframe when its count differs; "
+                           f"0 turns the checks off (default: {stream.CHECK_INTERVAL})")
+    live.add_argument("--verify", action="store_true",
+                      help="Also run the full pipeline on every frame and report whether the counts agree")
+    live.add_argument("--max-frames", type=int, default=None, help="Stop after this many frames")
+    live.add_argument("--output", "-o", default=None,
+                      help="Write JSON lines here instead of stdout")
+    live.set_defaults(func=stream.main)
+    
+    serve = subparsers.add_parser("serve", help="Analyze uploaded images over HTTP on a local worker pool")
+    serve.add_argument("--host", default="127.0.0.1", help="Interface to listen on (default: %(default)s)")
+    serve.add_argument("--port", type=int, default=server.DEFAULT_PORT, help="Port to listen on (default: %(default)s)")
+    serve.add_argument("--workers", type=int, default=None,
+                       help="Analyses run at once, one worker process each (default: one per CPU core)")
+    serve.add_argument("--queue-size", type=int, default=server.QUEUE_SIZE,
+                       help="Requests that may wait for a worker; beyond that the server answers 429 (default: %(default)s)")
+    serve.add_argument("--timeout", type=float, default=server.TIMEOUT_SECONDS,
+                       help="Seconds a request may take, queueing included, before it fails with 504 (default: %(default)s)")
+    serve.add_argument("--pyramid", action="store_true",
+                       help="Coarse-to-fine analysis, as for analyze")
+    serve.add_argument("--max-side", type=int, default=None, metavar="PX",
+                       help="Decode uploads shrunk towards this long side, as for analyze")
+    add_cache_arguments(serve)
+    serve.set_defaults(func=server.main)
+    
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    
+    if args.command in ("analyze", "stream") and args.point is None and args.color is None:
+        args.point = (0.5, 0.5)
+        
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
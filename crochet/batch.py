@@ -0,0 +1,232 @@
+import os
+import sys
+import time
+import json
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from gui.logic.processor import ImageProcessor
+from gui.logic.tiled_processor import TiledProcessor
+import gui.logic.result_cache as result_cache
+import gui.logic.instrumentation as instrumentation
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+def find_images(root):
+    if os.path.isfile(root):
+        return [root]
+        
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(dirpath, name))
+                
+    return sorted(paths)
+
+def load_seeds(seeds_path):
+    # {"image.jpeg": [x, y]} in pixel coordinates, keyed by file name
+    with open(seeds_path) as f:
+        seeds = json.load(f)
+        
+    return {name: tuple(point) for name, point in seeds.items()}
+
+def scale_width_profile(summary, factor):
+    # Width statistics into other pixel units; the sample count stays as it is
+    if summary is None:
+        return None
+    return {key: value if key == "samples" else value * factor for key, value in summary.items()}
+
+def deadline_observer(deadline):
+    # Trace observer that stops a run at the first stage starting after time.monotonic() passes deadline
+    def observer(record, finished):
+        if not finished and time.monotonic() > deadline:
+            raise instrumentation.Cancelled(record.name)
+    return observer
+
+def to_file_pixels(points, scale):
+    return [[round(x / scale), round(y / scale)] for x, y in points or []]
+
+def component_record(result, scale, include_points):
+    # One analyze_components result in file pixels
+    record = {
+        "color": result["color"],
+        "box": [round(v / scale) for v in result["box"]],
+        "area": round(result["area"] / (scale * scale)),
+        "count": result["count"],
+        "direction": result["direction"],
+        "width": float(result["width"]) / scale if result["width"] is not None else None,
+        "width_profile": scale_width_profile(result["width_profile"], 1 / scale)
+    }
+    if include_points:
+        record["spine"] = to_file_pixels(result["spine"], scale)
+        record["stitches"] = to_file_pixels(result["stitches"], scale)
+    return record
+
+def analyze_image(path, point=(0.5, 0.5), color_name=None, relative=True, pyramid=False, memory_budget=None, scratch_dir=None,
+                  max_side=None, cache=None, include_points=False, deadline=None, all_components=False, max_level=0):
+    # path may also be a binary file object; include_points adds the spine and stitch coordinates.
+    # all_components analyzes every blob of the seed's colour and lists them under "components".
+    # With memory_budget the record also gives the level the yarn window was analyzed at: 0 unless max_level
+    # lets a window too large for the budget be downscaled, with a warning when it was.
+    record = {
+        "path": path,
+        "count": None,
+        "direction": None,
+        "width": None,
+        "width_profile": None,
+        "load_seconds": None,
+        "cached": False
+    }
+    
+    processor = None
+    try:
+        # A file analyzed before with the same seed and settings costs a hash and a read
+        cache_key = None
+        if cache is not None:
+            params = result_cache.analysis_params(pyramid=pyramid, max_side=max_side, memory_budget=memory_budget,
+                                                  points=include_points, components=all_components, max_level=max_level)
+            cache_key = result_cache.make_key("record", result_cache.file_digest(path),
+                                              [point, color_name, relative], params)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                record.update(cached[0], cached=True)
+                return record
+        
+        if memory_budget and all_components:
+            raise ValueError("all components needs the in-memory pipeline, not --memory-budget")
+        if memory_budget:
+            # Tiled on disk, for scans too large to hold in memory
+            processor = TiledProcessor(memory_budget, scratch_dir, max_level)
+        else:
+            processor = ImageProcessor(debug=False, pyramid=pyramid, workers=1, max_side=max_side, cache=cache)
+        if deadline is not None:
+            processor.trace.observer = deadline_observer(deadline)
+        processor.load_image(path)
+        record["load_seconds"] = processor.trace.find("load_image").wall
+        
+        # Images may be decoded smaller than the file; seeds and widths are in file pixels
+        scale = getattr(processor, "load_scale", 1.0)
+        h, w = processor.original_cv_image.shape[:2]
+        seed = None
+        if point is not None:
+            x, y = point
+            if relative:
+                # Seed point is given as a fraction of the image size
+                seed = (min(w - 1, int(x * w)), min(h - 1, int(y * h)))
+            else:
+                seed = (min(w - 1, int(x * scale)), min(h - 1, int(y * scale)))
+                
+        if all_components:
+            _, components = processor.analyze_components(color_name, seed)
+            record["components"] = [component_record(result, scale, include_points) for result in components]
+            isolated = components or None
+        elif seed is not None:
+            isolated = processor.process_click_at(*seed, color_name, render=False)
+        else:
+            isolated = processor.process_color(color_name, render=False)
+            
+        if isolated is None:
+            record["error"] = "isolation failed"
+            return record
+            
+        report_data = None
+        if not all_components:
+            _, report_data = processor.run_full_analysis(render=False)
+            if not report_data:
+                record["error"] = "analysis failed (no spine or stitches found)"
+                return record
+        
+        if report_data:
+            record["count"] = int(report_data["count"])
+            record["direction"] = report_data["direction"]
+            record["width"] = float(report_data["width"]) / scale
+            record["width_profile"] = scale_width_profile(report_data["width_profile"], 1 / scale)
+            if "level" in report_data:
+                record["level"] = report_data["level"]
+                if report_data["level"] > 0:
+                    record["warning"] = (
+                        f"stitches and direction were found on the yarn window downscaled {2 ** report_data['level']}x "
+                        f"to fit the memory budget and can differ from a full resolution analysis; --max-level 0 "
+                        f"or --memory-budget {math.ceil(report_data['full_resolution_budget'] / 2**20)} avoids it"
+                    )
+        if include_points:
+            record["spine"] = to_file_pixels(processor.spine_points, scale)
+            record["stitches"] = to_file_pixels(processor.stitch_points, scale)
+        
+        if cache_key is not None:
+            keys = ("count", "direction", "width", "width_profile", "level", "warning", "spine", "stitches", "components")
+            cache.put(cache_key, {key: record[key] for key in keys if key in record})
+            
+    except instrumentation.Cancelled as e:
+        record["error"] = f"timed out before {e}"
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if isinstance(processor, TiledProcessor):
+            processor.close()
+        
+    return record
+
+def _init_worker():
+    # One OpenCV thread per process; the pool provides the parallelism
+    cv2.setNumThreads(1)
+
+def _analyze_args(args):
+    return analyze_image(*args)
+
+def run_batch(paths, workers=None, point=(0.5, 0.5), color_name=None, seeds=None, pyramid=False,
+              memory_budget=None, scratch_dir=None, max_side=None, cache=None, all_components=False, max_level=0):
+    jobs = []
+    for path in paths:
+        name = os.path.basename(path)
+        if seeds and name in seeds:
+            jobs.append((path, seeds[name], color_name, False, pyramid, memory_budget, scratch_dir, max_side, cache,
+                         False, None, all_components, max_level))
+        else:
+            jobs.append((path, point, color_name, True, pyramid, memory_budget, scratch_dir, max_side, cache,
+                         False, None, all_components, max_level))
+    
+    if workers == 1:
+        for job in jobs:
+            yield _analyze_args(job)
+        return
+        
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        for record in executor.map(_analyze_args, jobs):
+            yield record
+
+def main(args):
+    paths = find_images(args.path)
+    if not paths:
+        print(f"No images found in {args.path}", file=sys.stderr)
+        return 1
+        
+    seeds = load_seeds(args.seeds) if args.seeds else None
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    cache = None if args.no_cache else result_cache.ResultCache(args.cache, args.cache_size * 1024 * 1024)
+    
+    out = open(args.output, 'w') if args.output else sys.stdout
+    
+    start = time.perf_counter()
+    failed = 0
+    
+    try:
+        for record in run_batch(paths, args.workers, args.point, args.color, seeds, args.pyramid,
+                                memory_budget, args.scratch, args.max_side, cache, args.all_components, args.max_level):
+            if "error" in record:
+                failed += 1
+            if "warning" in record:
+                print(f"{record['path']}: {record['warning']}", file=sys.stderr)
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+            
+    elapsed = time.perf_counter() - start
+    print(f"Analyzed {len(paths)} images ({failed} failed) in {elapsed:.1f}s", file=sys.stderr)
+    
+    return 0 if failed == 0 else 2
@@ -0,0 +1,312 @@
+import io
+import os
+import sys
+import json
+import time
+import bisect
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import crochet.batch as batch
+import gui.logic.result_cache as result_cache
+import preprocessing.hue_isolator as hue_isolator
+
+DEFAULT_PORT = 8765
+# Requests waiting for a worker beyond those being analyzed; more are refused with 429
+QUEUE_SIZE = 16
+# Seconds from arrival to response, queueing included
+TIMEOUT_SECONDS = 60.0
+# Extra wait for a worker to notice the deadline at its next stage before the request gives up on it
+TIMEOUT_GRACE = 2.0
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class QueueFull(Exception):
+    pass
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation (None past the last bound)
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self):
+        buckets = [{"le": bound, "count": count} for bound, count in zip(self.bounds, self.counts)]
+        buckets.append({"le": "+Inf", "count": self.counts[-1]})
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": buckets
+        }
+
+def _warm():
+    # Runs once per worker so the first real request does not pay for process start and imports
+    return os.getpid()
+
+def _analyze_upload(data, point, color_name, relative, pyramid, max_side, cache, include_points, deadline):
+    start = time.perf_counter()
+    record = batch.analyze_image(io.BytesIO(data), point, color_name, relative, pyramid, max_side=max_side,
+                                 cache=cache, include_points=include_points, deadline=deadline)
+    del record["path"]
+    record["analysis_seconds"] = time.perf_counter() - start
+    return record
+
+class AnalysisService:
+    # ImageProcessor runs on a pool of worker processes, started and warmed before the first request.
+    # At most workers + queue_size analyses are admitted at once; identical requests (same image bytes
+    # and seed) already in flight share one analysis instead of taking another slot.
+    def __init__(self, workers=None, queue_size=QUEUE_SIZE, timeout=TIMEOUT_SECONDS, cache=None,
+                 pyramid=False, max_side=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.capacity = self.workers + queue_size
+        self.timeout = timeout
+        self.cache = cache
+        self.pyramid = pyramid
+        self.max_side = max_side
+
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._in_flight = {}
+        self.executor = self._start_pool()
+
+        self.responses = Counter()
+        self.counters = Counter()
+        self.request_latency = Histogram()
+        self.analysis_latency = Histogram()
+
+    def _start_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=batch._init_worker)
+
+    def warm(self):
+        # Submitted together, so the pool starts every worker instead of reusing the first idle one
+        futures = [self.executor.submit(_warm) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    def submit(self, data, point, color_name, relative, include_points):
+        # Future resolving to the analysis record; raises QueueFull when no slot is free
+        key = (hashlib.sha256(data).hexdigest(), point, color_name, relative, include_points)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.counters["coalesced"] += 1
+                return future
+            if self._admitted >= self.capacity:
+                self.counters["rejected"] += 1
+                raise QueueFull()
+
+            args = (data, point, color_name, relative, self.pyramid, self.max_side, self.cache, include_points,
+                    time.monotonic() + self.timeout)
+            try:
+                future = self.executor.submit(_analyze_upload, *args)
+            except BrokenProcessPool:
+                # A worker died (e.g. out of memory); start a fresh pool for this and later requests
+                self.counters["pool_restarts"] += 1
+                self.executor = self._start_pool()
+                future = self.executor.submit(_analyze_upload, *args)
+            self._admitted += 1
+            self._in_flight[key] = future
+
+        future.add_done_callback(partial(self._release, key))
+        return future
+
+    def _release(self, key, future):
+        # The slot stays taken until the worker is really done, even if the request already timed out
+        with self._lock:
+            self._admitted -= 1
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def record(self, status, seconds, result=None):
+        with self._lock:
+            self.responses[status] += 1
+            self.request_latency.observe(seconds)
+            if result is not None:
+                self.analysis_latency.observe(result["analysis_seconds"])
+                if result["cached"]:
+                    self.counters["cache_hits"] += 1
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "capacity": self.capacity,
+                "admitted": self._admitted,
+                "in_flight": len(self._in_flight),
+                "responses": {str(status): count for status, count in sorted(self.responses.items())},
+                "counters": dict(self.counters),
+                "request_seconds": self.request_latency.to_dict(),
+                "analysis_seconds": self.analysis_latency.to_dict()
+            }
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class BadRequest(Exception):
+    pass
+
+def parse_seed(query):
+    # ?point=FX,FY (fractions), ?x=PX&y=PX (file pixels) and/or ?color=NAME; default is the image centre
+    def single(name):
+        values = query.get(name)
+        return values[-1] if values else None
+
+    color_name = single("color")
+    if color_name is not None:
+        color_name = color_name.strip().lower()
+        if color_name not in hue_isolator.COLOR_NAMES:
+            raise BadRequest(f"unknown colour '{color_name}' (choose from {', '.join(hue_isolator.COLOR_NAMES)})")
+
+    try:
+        if single("x") is not None or single("y") is not None:
+            point, relative = (int(single("x")), int(single("y"))), False
+        elif single("point") is not None:
+            fx, fy = (float(v) for v in single("point").split(","))
+            if not (0.0 <= fx <= 1.0 and 0.0 <= fy <= 1.0):
+                raise ValueError()
+            point, relative = (fx, fy), True
+        else:
+            point, relative = (None if color_name else (0.5, 0.5)), True
+    except (TypeError, ValueError):
+        raise BadRequest("give the seed as point=FX,FY with fractions in [0, 1], or as x=PX&y=PX")
+
+    include_points = single("points") in ("1", "true", "yes")
+    return point, color_name, relative, include_points
+
+class AnalysisHandler(BaseHTTPRequestHandler):
+    server_version = "CrochetAnalyzer"
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/metrics":
+            self._send_json(200, self.server.service.metrics())
+        elif path == "/health":
+            self._send_json(200, {"status": "ok", "workers": self.server.service.workers})
+        else:
+            self._send_json(404, {"error": f"no such endpoint {path}"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/analyze":
+            self._send_json(404, {"error": f"no such endpoint {url.path}"})
+            return
+
+        service = self.server.service
+        start = time.monotonic()
+        status, payload, result = self._analyze(service, url, start)
+        headers = {"Retry-After": "1"} if status == 429 else None
+        # Counted before the response goes out, so a client reading /metrics next already sees it
+        service.record(status, time.monotonic() - start, result)
+        self._send_json(status, payload, headers)
+
+    def _analyze(self, service, url, start):
+        # (status, payload, record or None)
+        length = self.headers.get("Content-Length")
+        if length is None:
+            return 411, {"error": "Content-Length required"}, None
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return 400, {"error": "Content-Length must be a non-negative integer"}, None
+        if length > MAX_UPLOAD_BYTES:
+            return 413, {"error": f"image larger than {MAX_UPLOAD_BYTES} bytes"}, None
+        data = self.rfile.read(length)
+        if not data:
+            return 400, {"error": "the request body must be the image file"}, None
+
+        try:
+            seed = parse_seed(parse_qs(url.query))
+        except BadRequest as e:
+            return 400, {"error": str(e)}, None
+
+        try:
+            future = service.submit(data, *seed)
+        except QueueFull:
+            return 429, {"error": "server busy, retry later"}, None
+
+        remaining = service.timeout - (time.monotonic() - start)
+        try:
+            result = future.result(timeout=max(0.0, remaining) + TIMEOUT_GRACE)
+        except FutureTimeout:
+            return 504, {"error": f"analysis did not finish within {service.timeout:g}s"}, None
+        except BrokenProcessPool:
+            return 503, {"error": "analysis worker crashed"}, None
+
+        error = result.get("error")
+        if error is None:
+            return 200, result, result
+        if error.startswith("timed out"):
+            return 504, result, result
+        if error.startswith("UnidentifiedImageError"):
+            return 400, {"error": "the request body is not a readable image"}, None
+        return 422, result, result
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class AnalysisServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        super().__init__(address, AnalysisHandler)
+        self.service = service
+
+def main(args):
+    cache = None if args.no_cache else result_cache.ResultCache(args.cache, args.cache_size * 1024 * 1024)
+    service = AnalysisService(args.workers, args.queue_size, args.timeout, cache, args.pyramid, args.max_side)
+    try:
+        service.warm()
+        server = AnalysisServer((args.host, args.port), service)
+    except Exception:
+        service.close()
+        raise
+
+    host, port = server.server_address[:2]
+    print(f"Serving on http://{host}:{port} with {service.workers} workers "
+          f"(queue {args.queue_size}, timeout {args.timeout:g}s)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+    return 0
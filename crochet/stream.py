@@ -0,0 +1,352 @@
+import sys
+import time
+import json
+import math
+from collections import Counter, deque
+
+import cv2
+import numpy as np
+
+from gui.logic.processor import ImageProcessor
+import postprocessing.pyramid as pyramid
+
+# Long side of the grayscale copy used for optical flow and drift checks
+TRACK_LONG_SIDE = 640
+MAX_FEATURES = 200
+MIN_FEATURES = 12
+# Forward-backward optical flow error (tracking pixels) above which a feature is dropped
+MAX_FLOW_ERROR = 1.0
+# Mean absolute grey difference inside the yarn, after motion compensation, still treated as the same scene
+DRIFT_THRESHOLD = 6.0
+# The direction is reported as a compass point and the detector is tuned to the measured width,
+# so rotating or zooming the camera past these limits forces a recompute
+MAX_ROTATION_DEGREES = 10.0
+MAX_SCALE_CHANGE = 0.1
+# Recompute at least this often even when nothing seems to change
+KEYFRAME_INTERVAL = 90
+# Tracked frames are checked against a full recompute this often; a different count becomes the new keyframe
+CHECK_INTERVAL = 5
+# Frames in the rolling frames-per-second figure
+FPS_WINDOW = 30
+
+def open_source(source):
+    # A number selects a camera, anything else is a video file
+    capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+    if not capture.isOpened():
+        raise IOError(f"Cannot open video source {source}")
+    return capture
+
+def compose(second, first):
+    # 2x3 affine matrices: apply first, then second
+    a = np.vstack((second, (0, 0, 1)))
+    b = np.vstack((first, (0, 0, 1)))
+    return (a @ b)[:2]
+
+def transform_points(points, matrix):
+    if points is None or len(points) == 0:
+        return points
+    pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return pts @ matrix[:, :2].T + matrix[:, 2]
+
+def rotation_and_scale(matrix):
+    return math.degrees(math.atan2(matrix[1, 0], matrix[0, 0])), math.hypot(matrix[0, 0], matrix[1, 0])
+
+def to_ints(points):
+    return [tuple(p) for p in np.rint(points).astype(np.int64).tolist()]
+
+class StreamAnalyzer:
+    # Stitch counts for consecutive frames of one piece. A full analysis (a keyframe) is only run when
+    # the frame has drifted from the last keyframe; otherwise its result is carried over, moved with
+    # the camera. Drift is measured on a small greyscale copy: the camera motion since the keyframe
+    # comes from sparse optical flow, and the keyframe warped by that motion is compared with the
+    # current frame inside the yarn. Recomputes look only at a window around where the yarn moved to.
+    # Every check_interval frames a tracked result is recomputed as well, so a count that went stale
+    # without the frame drifting is corrected rather than carried on to the next keyframe.
+    def __init__(self, point=(0.5, 0.5), color_name=None, drift_threshold=DRIFT_THRESHOLD,
+                 keyframe_interval=KEYFRAME_INTERVAL, verify=False, workers=None, check_interval=CHECK_INTERVAL):
+        self.point = point
+        self.color_name = color_name
+        self.drift_threshold = drift_threshold
+        self.keyframe_interval = keyframe_interval
+        # 0 or None turns the checks off
+        self.check_interval = check_interval
+        # verify runs the full pipeline on every frame as well and records whether the counts agree
+        self.verify = verify
+        self.processor = ImageProcessor(debug=False, workers=workers)
+        self.index = -1
+        self.key = None
+        self.prev_gray = None
+        self.motion = None
+        self.frame_times = deque(maxlen=FPS_WINDOW)
+
+    def process(self, frame):
+        # Returns one record per frame; "mode" says how its result was obtained
+        start = time.perf_counter()
+        self.index += 1
+
+        scale = min(1.0, TRACK_LONG_SIDE / max(frame.shape[:2]))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        drift = None
+        if self.key is None:
+            mode = self._recompute(frame, gray, scale, self._first_seed(frame), None)
+        else:
+            step = self._track(gray)
+            mode = None
+            if step is not None:
+                self.motion = compose(step, self.motion)
+                drift = self._drift(gray)
+                if self._can_reuse(drift):
+                    mode = "tracked"
+
+            if mode is None:
+                mode = self._recompute_tracked(frame, gray, scale)
+            elif self.check_interval and (self.index - self.key["frame"]) % self.check_interval == 0:
+                mode = self._check(frame, gray, scale)
+
+        self.prev_gray = gray
+        record = self._record(mode, drift)
+
+        seconds = time.perf_counter() - start
+        self.frame_times.append(seconds)
+        record["seconds"] = round(seconds, 4)
+        record["fps"] = round(len(self.frame_times) / sum(self.frame_times), 2)
+
+        if self.verify:
+            # Not part of the timing: this is what the stream saves
+            full = self._analyze(frame, record["seed"]) if record["seed"] is not None else None
+            record["full_count"] = full["count"] if full else None
+            record["full_direction"] = full["direction"] if full else None
+        return record
+
+    def _first_seed(self, frame):
+        if self.point is None:
+            return None
+        h, w = frame.shape[:2]
+        return min(w - 1, int(self.point[0] * w)), min(h - 1, int(self.point[1] * h))
+
+    def _analyze(self, image, seed, offset=(0, 0)):
+        # Full pipeline on image (a frame or a window of one); seed and results in frame coordinates
+        self.processor.load_frame(image)
+        if seed is not None:
+            x = min(max(int(round(seed[0])) - offset[0], 0), image.shape[1] - 1)
+            y = min(max(int(round(seed[1])) - offset[1], 0), image.shape[0] - 1)
+            isolated = self.processor.process_click_at(x, y, self.color_name, render=False)
+        else:
+            isolated = self.processor.process_color(self.color_name, render=False)
+
+        if isolated is None:
+            return None
+        _, report = self.processor.run_full_analysis(render=False)
+        if not report or not self.processor.spine_points:
+            return None
+
+        spine = np.asarray(pyramid.shift_points(self.processor.spine_points, offset), dtype=np.float64)
+        return {
+            "count": int(report["count"]),
+            "direction": report["direction"],
+            "width": float(report["width"]),
+            "color": self.processor.isolation_seed[0],
+            "mask": self.processor.full_mask,
+            "spine": spine,
+            "stitches": np.asarray(pyramid.shift_points(self.processor.stitch_points, offset), dtype=np.float64),
+            # Later recomputes click the middle of the spine, which stays on the yarn as it moves
+            "seed": spine[len(spine) // 2]
+        }
+
+    def _recompute_tracked(self, frame, gray, scale):
+        # Recompute where the keyframe's yarn has moved to
+        motion = self._full_motion()
+        seed = transform_points([self.key["seed"]], motion)[0]
+        return self._recompute(frame, gray, scale, seed, self._window(frame, motion))
+
+    def _check(self, frame, gray, scale):
+        # Recompute a tracked frame: a different count makes it the new keyframe, the same count (or losing
+        # the yarn) keeps tracking the old one
+        key, motion = self.key, self.motion
+        mode = self._recompute_tracked(frame, gray, scale)
+        if mode == "lost":
+            return "tracked"
+        if self.key["count"] == key["count"]:
+            self.key, self.motion = key, motion
+            return "checked"
+        return mode
+
+    def _window(self, frame, motion):
+        # Where the keyframe's yarn is now, grown by a yarn width and the filter context
+        h, w = frame.shape[:2]
+        corners = transform_points(self.key["box"], motion)
+        margin = int(self.key["width"]) + pyramid.FILTER_PAD
+        x1, y1 = np.floor(corners.min(axis=0)).astype(int) - margin
+        x2, y2 = np.ceil(corners.max(axis=0)).astype(int) + margin
+        return max(0, x1), max(0, y1), min(w, x2), min(h, y2)
+
+    def _recompute(self, frame, gray, scale, seed, window):
+        mode = "full"
+        result = None
+        if window is not None:
+            x1, y1, x2, y2 = window
+            result = self._analyze(frame[y1:y2, x1:x2], seed, (x1, y1))
+            # Yarn running off the window may continue outside it; only the whole frame can tell
+            if result is not None and not self._inside(result["mask"], window, frame.shape):
+                result = None
+            elif result is not None:
+                mode = "roi"
+                full_mask = np.zeros(frame.shape[:2], dtype=np.uint8)
+                full_mask[y1:y2, x1:x2] = result["mask"]
+                result["mask"] = full_mask
+
+        if result is None:
+            result = self._analyze(frame, seed)
+            if result is None:
+                # Lost the yarn: keep the old keyframe (if any) and try again on the next frame
+                return "lost"
+
+        if self.color_name is None:
+            self.color_name = result["color"]
+
+        x, y, w, h = cv2.boundingRect(result["mask"])
+        result["box"] = np.float64([[x, y], [x + w, y + h]])
+        # Tracking happens on the small copy; keep the yarn there as well
+        result["mask_small"] = cv2.resize(result["mask"], (gray.shape[1], gray.shape[0]), interpolation=cv2.INTER_NEAREST)
+        result["gray"] = gray
+        result["scale"] = scale
+        result["frame"] = self.index
+        self.key = result
+        self.motion = np.float64([[1, 0, 0], [0, 1, 0]])
+        return mode
+
+    def _inside(self, mask, window, shape):
+        # False when the mask touches a window edge that is not also a frame edge
+        x1, y1, x2, y2 = window
+        h, w = shape[:2]
+        return not ((x1 > 0 and mask[:, 0].any()) or (y1 > 0 and mask[0].any()) or
+                    (x2 < w and mask[:, -1].any()) or (y2 < h and mask[-1].any()))
+
+    def _region(self, motion):
+        # Keyframe yarn moved by motion and grown to take in its edges, where the texture tracks best
+        mask = cv2.warpAffine(self.key["mask_small"], motion, (self.key["gray"].shape[1], self.key["gray"].shape[0]),
+                              flags=cv2.INTER_NEAREST)
+        grow = max(3, int(self.key["width"] * self.key["scale"] / 2)) | 1
+        return mask, cv2.dilate(mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (grow, grow)))
+
+    def _track(self, gray):
+        # Camera motion from the previous frame to this one (small-copy pixels), or None if it cannot be trusted
+        if self.prev_gray is None or self.prev_gray.shape != gray.shape:
+            return None
+
+        _, region = self._region(self.motion)
+        features = cv2.goodFeaturesToTrack(self.prev_gray, MAX_FEATURES, 0.01, 5, mask=region)
+        if features is None or len(features) < MIN_FEATURES:
+            return None
+
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, features, None)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.prev_gray, moved, None)
+        error = np.linalg.norm((back - features).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < MAX_FLOW_ERROR)
+        if good.sum() < max(MIN_FEATURES, len(features) // 2):
+            return None
+
+        step, inliers = cv2.estimateAffinePartial2D(features[good], moved[good], method=cv2.RANSAC,
+                                                    ransacReprojThreshold=MAX_FLOW_ERROR)
+        if step is None or inliers.sum() < MIN_FEATURES:
+            return None
+        return step
+
+    def _drift(self, gray):
+        # Mean grey difference inside the yarn between this frame and the motion-compensated keyframe
+        mask, _ = self._region(self.motion)
+        if not mask.any():
+            return float('inf')
+
+        size = (gray.shape[1], gray.shape[0])
+        predicted = cv2.warpAffine(self.key["gray"], self.motion, size, flags=cv2.INTER_LINEAR)
+        return float(cv2.mean(cv2.absdiff(predicted, gray), mask=mask)[0])
+
+    def _can_reuse(self, drift):
+        rotation, scale = rotation_and_scale(self.motion)
+        return (
+            drift <= self.drift_threshold and
+            abs(rotation) <= MAX_ROTATION_DEGREES and
+            abs(scale - 1.0) <= MAX_SCALE_CHANGE and
+            self.index - self.key["frame"] < self.keyframe_interval
+        )
+
+    def _full_motion(self):
+        # Keyframe-to-now motion in frame pixels
+        motion = self.motion.copy()
+        motion[:, 2] /= self.key["scale"]
+        return motion
+
+    def _record(self, mode, drift):
+        record = {"frame": self.index, "mode": mode, "count": None, "direction": None, "width": None,
+                  "seed": None, "stitches": None}
+        if drift is not None:
+            record["drift"] = round(drift, 3)
+        if self.key is None or mode == "lost":
+            return record
+
+        motion = self._full_motion()
+        _, scale = rotation_and_scale(motion)
+        record["count"] = self.key["count"]
+        record["direction"] = self.key["direction"]
+        record["width"] = round(self.key["width"] * scale, 2)
+        record["seed"] = [round(v, 1) for v in transform_points([self.key["seed"]], motion)[0]]
+        record["stitches"] = to_ints(transform_points(self.key["stitches"], motion))
+        return record
+
+def run_stream(capture, analyzer, max_frames=None):
+    while max_frames is None or analyzer.index + 1 < max_frames:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        yield analyzer.process(frame)
+
+def main(args):
+    try:
+        capture = open_source(args.source)
+    except IOError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    analyzer = StreamAnalyzer(args.point, args.color, args.drift_threshold, args.keyframe_interval, args.verify,
+                              check_interval=args.check_interval)
+    out = open(args.output, 'w') if args.output else sys.stdout
+
+    start = time.perf_counter()
+    modes = Counter()
+    checked = agreed = 0
+    # The full pipeline's own consistency: consecutive verified frames giving the same count
+    previous_full = None
+    pairs = steady = 0
+
+    try:
+        for record in run_stream(capture, analyzer, args.max_frames):
+            modes[record["mode"]] += 1
+            if args.verify and record["full_count"] is not None:
+                checked += 1
+                agreed += record["count"] == record["full_count"]
+                if previous_full is not None:
+                    pairs += 1
+                    steady += record["full_count"] == previous_full
+            if args.verify:
+                previous_full = record["full_count"]
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+    finally:
+        capture.release()
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    frames = sum(modes.values())
+    fps = frames / elapsed if elapsed > 0 else 0.0
+    summary = ", ".join(f"{count} {mode}" for mode, count in modes.most_common())
+    print(f"Streamed {frames} frames in {elapsed:.1f}s ({fps:.1f} fps): {summary}", file=sys.stderr)
+    if args.verify:
+        print(f"Count agreed with full recomputation on {agreed}/{checked} frames; full recomputation kept "
+              f"its count from one frame to the next on {steady}/{pairs}", file=sys.stderr)
+
+    return 0 if modes["lost"] < frames else 2
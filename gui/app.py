@@ -1,8 +1,13 @@
+from functools import partial
+
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import gui.ui.image_viewer as image_viewer
 import gui.logic.processor as processor
+import gui.logic.result_cache as result_cache
+import gui.logic.worker as worker
 import gui.ui.report_panel as report_panel
+import gui.ui.parameter_panel as parameter_panel
 import gui.ui.pipeline_viewer as pipeline_viewer
 from gui.ui.theme import Colors, Fonts
 from gui.ui.components import ModernButton, StatusLabel
@@ -13,7 +18,13 @@ class ImageApp:
         self.root.title("Crochet Pattern Analyzer")
         
         self._setup_window()
-        self.processor = processor.ImageProcessor()
+        # Reopened images skip isolation and analysis they have already been through
+        self.processor = processor.ImageProcessor(cache=result_cache.ResultCache())
+        # Load, isolation and analysis run on this thread. The Tk thread never reads the processor
+        # directly: it only sees what each job returns (see _analyze)
+        self.worker = worker.AnalysisWorker(root, self.processor)
+        # Pipeline steps of the analysis on screen, as returned by the job that produced it
+        self.pipeline_frames = []
         
         self.main_container = tk.Frame(root, bg=Colors.BACKGROUND)
         self.main_container.pack(fill=tk.BOTH, expand=True)
@@ -43,6 +54,9 @@ class ImageApp:
         self.control_frame = tk.Frame(self.control_container, bg=Colors.BACKGROUND)
         self.control_frame.pack(side=tk.BOTTOM, fill=tk.X, pady=10)
         
+        # Shown once an analysis is on screen; moving a slider re-runs only the stages it affects
+        self.parameter_panel = parameter_panel.ParameterPanel(self.control_container, on_change=self.update_analysis)
+        
         self.display_container = tk.Frame(self.main_container, bg=Colors.BORDER, padx=1, pady=1)
         self.display_container.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=20, pady=(10, 0))
         
@@ -77,11 +91,53 @@ class ImageApp:
                                       
         self.btn_pipeline = ModernButton(self.control_frame, text="VIEW STEPS", 
                                          command=self.open_pipeline_viewer, primary=False)
+        
+        self.btn_cancel = ModernButton(self.control_frame, text="CANCEL", 
+                                       command=self.cancel_job, primary=False)
+    
+    def _start_job(self, status, call, on_done, on_cancel, on_error=None):
+        # Runs call() in the background; progress shows the pipeline stage it has reached
+        self.status_label.set_status(status, "warning")
+        self.btn_continue.set_disabled(True)
+        self.btn_cancel.pack(side=tk.LEFT, padx=20)
+        
+        def on_progress(record, finished):
+            if not finished:
+                self.status_label.set_status(f"{status} {record.name.replace('_', ' ')}", "warning")
+                
+        def on_failed(e):
+            self._end_job()
+            if on_error:
+                on_error(e)
+            else:
+                messagebox.showerror("Error", f"Processing failed: {e}")
+                self.status_label.set_status("Error during processing.", "error")
+            
+        self.worker.submit(
+            call,
+            on_done=lambda result: (self._end_job(), on_done(result)),
+            on_error=on_failed,
+            on_cancel=lambda: (self._end_job(), on_cancel()),
+            on_progress=on_progress
+        )
+        
+    def _end_job(self):
+        self.btn_cancel.pack_forget()
+        self.btn_continue.set_disabled(False)
+        
+    def cancel_job(self):
+        self.status_label.set_status("Cancelling after the current step...", "warning")
+        self.worker.cancel()
     
     def reset_app(self):
-        self.processor.reset_state()
+        # Supersedes whatever is running; the reset itself happens in turn on the worker
+        self.worker.submit(self.processor.reset_state)
+        self._end_job()
+        self.image_loaded = False
         self.viewer.clear()
         self.report_panel.reset_report()
+        self.pipeline_frames = []
+        self._show_parameters(False)
         
         self.btn_continue.pack_forget()
         self.btn_reset.pack_forget()
@@ -97,34 +153,36 @@ class ImageApp:
         )
         
         if file_path:
-            try:
-                self.status_label.set_status("Preprocessing image...", "warning")
-                self.root.update()
-                
-                # Processor loads logic
-                pil_img = self.processor.load_image(file_path)
-                
-                # Viewer displays
-                self.viewer.display_image(pil_img)
-                self.btn_load.place_forget()
-                
-                self.status_label.set_status("Image Loaded. Click on the yarn to isolate specific hue.")
-                
-            except Exception as e:
+            self.btn_load.place_forget()
+            
+            def on_error(e):
                 messagebox.showerror("Error", f"Failed to open image: {e}")
+                self.reset_app()
                 self.status_label.set_status("Error loading image.", "error")
+            
+            self._start_job("Preprocessing image...", partial(self.processor.load_image, file_path),
+                            self._on_image_loaded, self.reset_app, on_error)
+
+    def _on_image_loaded(self, pil_img):
+        # Viewer displays
+        self.viewer.display_image(pil_img)
+        self.image_loaded = True
+        
+        self.status_label.set_status("Image Loaded. Click on the yarn to isolate specific hue.")
 
     def on_image_click(self, x, y):
         # Isolation Phase check
         if self.btn_reset.winfo_ismapped() and not self.btn_continue.winfo_ismapped():
             return
             
-        if not self.processor.has_image():
+        if not self.image_loaded:
             return
 
-        # Delegate to Processor
-        preview_img = self.processor.process_click_at(x, y)
-        
+        # A new click supersedes an isolation still running for the previous one
+        self._start_job("Isolating hue...", partial(self.processor.process_click_at, x, y),
+                        self._on_isolated, self._on_isolation_cancelled)
+
+    def _on_isolated(self, preview_img):
         if preview_img:
             self.viewer.display_image(preview_img)
             self.status_label.set_status("Hue Isolated. Ready to process geometry.", "success")
@@ -133,13 +191,40 @@ class ImageApp:
             if not self.btn_continue.winfo_ismapped():
                 self.btn_continue.pack(side=tk.RIGHT, padx=20)
                 self.btn_reset.pack(side=tk.RIGHT, padx=0) 
+        else:
+            self.status_label.set_status("No yarn colour found there. Click on the yarn to isolate specific hue.")
+
+    def _on_isolation_cancelled(self):
+        # The mask may be half replaced, so the shown preview can no longer be analyzed
+        self.btn_continue.pack_forget()
+        self.btn_reset.pack_forget()
+        self.status_label.set_status("Isolation cancelled. Click on the yarn to isolate specific hue.")
 
     def run_analysis(self):
-        self.status_label.set_status("Executing detection algorithms...", "warning")
-        self.root.update()
-        
-        # Delegate to Processor
-        result_img, report_data = self.processor.run_full_analysis()
+        self._start_job("Executing detection algorithms...", self._analyze,
+                        self._on_analysis_done,
+                        lambda: self.status_label.set_status("Analysis cancelled. Ready to process geometry."))
+
+    def update_analysis(self, settings):
+        self._start_job("Updating analysis...", partial(self._analyze, **settings),
+                        self._on_analysis_done,
+                        lambda: self.status_label.set_status("Update cancelled."))
+
+    def _show_parameters(self, show):
+        if show and not self.parameter_panel.winfo_ismapped():
+            self.control_container.configure(height=200)
+            self.parameter_panel.pack(side=tk.TOP, fill=tk.X, padx=20, pady=(0, 5))
+        elif not show:
+            self.parameter_panel.pack_forget()
+            self.control_container.configure(height=130)
+
+    def _analyze(self, **settings):
+        # Runs on the worker, so the settings and steps it captures belong to this very run
+        result = self.processor.run_full_analysis(**settings)
+        return result, dict(self.processor.analysis_settings), list(self.processor.debug_frames)
+
+    def _on_analysis_done(self, outcome):
+        (result_img, report_data), settings, frames = outcome
         
         if result_img:
             self.viewer.display_image(result_img)
@@ -159,11 +244,17 @@ class ImageApp:
             self.btn_reset.pack(side=tk.RIGHT, padx=20)
             self.btn_pipeline.pack(side=tk.LEFT, padx=20)
             
+            self.pipeline_frames = frames
+            self.parameter_panel.set_settings(settings)
+            self._show_parameters(True)
+            
             self.status_label.set_status("Analysis Complete.", "success")
+        else:
+            self.status_label.set_status("No spine found in the isolated yarn.", "error")
             
     def open_pipeline_viewer(self):
-        if not self.processor.debug_frames:
+        if not self.pipeline_frames:
             messagebox.showinfo("Info", "No pipeline data available.")
             return
             
-        viewer = pipeline_viewer.PipelineViewer(self.root, self.processor.debug_frames)
+        viewer = pipeline_viewer.PipelineViewer(self.root, self.pipeline_frames)
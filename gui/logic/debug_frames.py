@@ -0,0 +1,175 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PIL import Image
+
+DEFAULT_BUDGET_BYTES = 512 * 1024 * 1024
+
+class DebugFrame:
+    # A pipeline step whose image is rendered from its recipe only when viewed
+    def __init__(self, store, title, desc, render, stage=None):
+        self.store = store
+        self.title = title
+        self.desc = desc
+        self.render = render
+        self.stage = stage
+        self.spill_path = None
+
+    @property
+    def image(self):
+        return self.store.get_image(self)
+
+    @property
+    def discarded(self):
+        # A newer run replaced this step and dropped its recipe and spilled copy
+        return self.render is None and self.spill_path is None
+
+    def __getitem__(self, key):
+        if key == 'title': return self.title
+        if key == 'desc': return self.desc
+        if key == 'image': return self.image
+        if key == 'stage': return self.stage
+        raise KeyError(key)
+
+class DebugFrameStore:
+    # Filled by the analysis on the worker thread while the viewer may read it on the Tk thread,
+    # so every accessor holds the lock over the store's state; iteration walks a snapshot
+    def __init__(self, budget_bytes=DEFAULT_BUDGET_BYTES, spill=False, spill_dir=None):
+        self.budget_bytes = budget_bytes
+        self.spill = spill or spill_dir is not None
+        self.spill_dir = spill_dir
+        self._owns_spill_dir = False
+        
+        self.frames = []
+        self._rendered = OrderedDict()
+        self._rendered_bytes = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.frames)
+
+    def __getitem__(self, index):
+        with self._lock:
+            return self.frames[index]
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self.frames))
+
+    def add(self, title, desc, render, stage=None):
+        # render() returns a BGR image; nothing is drawn until the frame is viewed
+        frame = DebugFrame(self, title, desc, render, stage)
+        with self._lock:
+            self.frames.append(frame)
+        return frame
+
+    def truncate(self, count):
+        with self._lock:
+            for frame in self.frames[count:]:
+                self._discard(frame)
+            self.frames = self.frames[:count]
+
+    def clear(self):
+        self.truncate(0)
+
+    @property
+    def rendered_bytes(self):
+        return self._rendered_bytes
+
+    def get_image(self, frame):
+        # None once a newer run has discarded the frame. Rendering happens outside the lock, so a
+        # slow render on one thread does not hold up the others' lookups or the worker's add/truncate.
+        with self._lock:
+            if frame in self._rendered:
+                self._rendered.move_to_end(frame)
+                return self._rendered[frame]
+            spill_path, render = frame.spill_path, frame.render
+            
+        if spill_path is None and render is None:
+            return None
+        try:
+            if spill_path is not None:
+                pil_img = Image.fromarray(np.load(spill_path))
+            else:
+                pil_img = self._to_pil(render())
+        except OSError:
+            # The spilled copy was removed by a truncate while loading
+            if frame.discarded:
+                return None
+            raise
+            
+        with self._lock:
+            if frame.discarded:
+                return None
+            if frame in self._rendered:
+                # Another thread rendered it meanwhile
+                self._rendered.move_to_end(frame)
+                return self._rendered[frame]
+                
+            self._rendered[frame] = pil_img
+            self._rendered_bytes += self._size_of(pil_img)
+            self._evict(keep=frame)
+            
+            return pil_img
+
+    def _evict(self, keep):
+        # Least recently viewed first; the frame being returned always stays
+        while self._rendered_bytes > self.budget_bytes and len(self._rendered) > 1:
+            frame, pil_img = next(iter(self._rendered.items()))
+            if frame is keep:
+                break
+                
+            del self._rendered[frame]
+            self._rendered_bytes -= self._size_of(pil_img)
+            
+            if self.spill and frame.spill_path is None:
+                frame.spill_path = os.path.join(self._get_spill_dir(), f"frame_{id(frame)}.npy")
+                np.save(frame.spill_path, np.asarray(pil_img))
+                # The spilled copy replaces the recipe and the arrays it holds
+                frame.render = None
+
+    def _discard(self, frame):
+        pil_img = self._rendered.pop(frame, None)
+        if pil_img is not None:
+            self._rendered_bytes -= self._size_of(pil_img)
+            
+        if frame.spill_path is not None and os.path.exists(frame.spill_path):
+            os.remove(frame.spill_path)
+        frame.spill_path = None
+        frame.render = None
+
+    def _get_spill_dir(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="crochet-frames-")
+            self._owns_spill_dir = True
+        return self.spill_dir
+
+    def close(self):
+        self.clear()
+        if self._owns_spill_dir and self.spill_dir and os.path.isdir(self.spill_dir):
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+            self._owns_spill_dir = False
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _size_of(pil_img):
+        w, h = pil_img.size
+        return w * h * len(pil_img.getbands())
+
+    @staticmethod
+    def _to_pil(cv_img):
+        if len(cv_img.shape) == 2:
+            return Image.fromarray(cv_img)
+        return Image.fromarray(cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB))
@@ -0,0 +1,138 @@
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+DEFAULT_BUDGET_BYTES = 64 * 1024 * 1024
+# LANCZOS after a box reduction to within this factor of the target; visually the same as a plain
+# LANCZOS (a few grey levels at most) at a fraction of the cost on full resolution composites
+REDUCING_GAP = 3.0
+# Steps on either side of the shown one that are rendered and scaled ahead of navigation
+PREFETCH_RADIUS = 1
+
+def fit_size(image_size, viewport):
+    # Largest size that fits the viewport; small magnifications are skipped so thin lines stay crisp
+    (w, h), (win_w, win_h) = image_size, viewport
+    ratio = min(win_w / w, win_h / h)
+    if 1 < ratio < 2:
+        ratio = 1
+
+    size = (int(w * ratio), int(h * ratio))
+    return size if size[0] > 0 and size[1] > 0 else None
+
+def scale_image(pil_img, viewport):
+    size = fit_size(pil_img.size, viewport)
+    if size is None:
+        return None
+    if size == pil_img.size:
+        return pil_img
+    return pil_img.resize(size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+
+class DisplayCache:
+    # Debug frames scaled for display, per (frame, viewport size), least recently shown evicted past
+    # budget_bytes. A background thread renders and scales the steps around the shown one, so
+    # stepping through them is a lookup; frames are keyed by identity, so a re-run never reuses them.
+    def __init__(self, frames, budget_bytes=DEFAULT_BUDGET_BYTES, radius=PREFETCH_RADIUS):
+        self.frames = frames
+        self.budget_bytes = budget_bytes
+        self.radius = radius
+
+        # (frame, viewport) -> (scaled image, full size of the frame), the size letting previews
+        # skip rendering the frame again
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Latest prefetch request; a newer one replaces whatever is still waiting
+        self._wanted = []
+        self._wake = threading.Condition(self._lock)
+        self._closed = False
+
+        self.thread = threading.Thread(target=self._run, name="display-prefetch", daemon=True)
+        self.thread.start()
+
+    def get(self, index, viewport):
+        # High quality scaling of step index, computed here on a miss; None if it cannot be shown
+        # (too small a viewport, or a step discarded by a newer analysis)
+        frame = self.frames[index]
+        key = (frame, viewport)
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                return self._images[key][0]
+
+        pil_img = frame.image
+        if pil_img is None:
+            return None
+        scaled = scale_image(pil_img, viewport)
+        if scaled is not None:
+            self._put(key, scaled, pil_img.size)
+        return scaled
+
+    def preview(self, index, viewport):
+        # Nearest-neighbour scaling for live resizing, from the largest cached scaling when there is one
+        frame = self.frames[index]
+        with self._lock:
+            cached = [entry for (f, _), entry in self._images.items() if f is frame]
+        if cached:
+            source, source_size = max(cached, key=lambda entry: entry[0].size[0])
+        else:
+            source = frame.image
+            if source is None:
+                return None
+            source_size = source.size
+
+        size = fit_size(source_size, viewport)
+        if size is None:
+            return None
+        return source.resize(size, Image.Resampling.NEAREST)
+
+    def prefetch(self, index, viewport):
+        # Neighbours of index, nearest first, scaled on the background thread
+        order = []
+        for step in range(1, self.radius + 1):
+            order += [index + step, index - step]
+        with self._wake:
+            self._wanted = [(i, viewport) for i in order if 0 <= i < len(self.frames)]
+            self._wake.notify()
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._wanted and not self._closed:
+                    self._wake.wait()
+                if self._closed:
+                    return
+                index, viewport = self._wanted.pop(0)
+
+            try:
+                self.get(index, viewport)
+            except Exception:
+                # A step that fails to render is simply not prefetched; showing it reports the error
+                pass
+
+    def _put(self, key, pil_img, source_size):
+        with self._lock:
+            if key in self._images:
+                return
+            self._images[key] = (pil_img, source_size)
+            self._bytes += self._size_of(pil_img)
+            while self._bytes > self.budget_bytes and len(self._images) > 1:
+                _, (old, _) = self._images.popitem(last=False)
+                self._bytes -= self._size_of(old)
+
+    @property
+    def cached_bytes(self):
+        return self._bytes
+
+    def close(self):
+        with self._wake:
+            self._closed = True
+            self._wanted = []
+            self._images.clear()
+            self._bytes = 0
+            self._wake.notify()
+
+    @staticmethod
+    def _size_of(pil_img):
+        w, h = pil_img.size
+        return w * h * len(pil_img.getbands())
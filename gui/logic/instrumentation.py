@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import threading
+import contextvars
+import tracemalloc
+from functools import wraps
+from contextlib import contextmanager
+
+# Top-level runs (load, click, analysis, ...) a trace keeps; older ones are dropped as new ones start
+MAX_RUNS = 32
+
+class Cancelled(Exception):
+    # Raised by a trace observer to stop a run where its next stage would start
+    pass
+
+class StageRecord:
+    # One timed stage: wall and CPU seconds, peak traced allocation and the arrays it produced
+    def __init__(self, name, parent, depth, start, args):
+        self.name = name
+        self.parent = parent
+        self.depth = depth
+        self.thread = threading.get_ident()
+        self.start = start
+        self.args = args
+        self.wall = None
+        self.cpu = None
+        self.peak_bytes = None
+        self.arrays = {}
+        self._running_peak = 0
+
+    def add_array(self, name, array):
+        if array is None or not hasattr(array, 'shape'):
+            return
+        self.arrays[name] = {
+            "shape": list(array.shape),
+            "dtype": str(array.dtype),
+            "bytes": int(array.nbytes)
+        }
+
+    @property
+    def done(self):
+        return self.wall is not None
+
+    def summary(self):
+        # Short text for the UI, e.g. "1.24 s (CPU 2.10 s, peak 310 MB)"
+        if not self.done:
+            return "running"
+        text = f"{format_seconds(self.wall)} (CPU {format_seconds(self.cpu)}"
+        if self.peak_bytes is not None:
+            text += f", peak {self.peak_bytes / 2**20:.0f} MB"
+        return text + ")"
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "parent": self.parent,
+            "depth": self.depth,
+            "thread": self.thread,
+            "start": self.start,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "peak_bytes": self.peak_bytes,
+            "arrays": self.arrays,
+            "args": self.args
+        }
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 1:
+        return f"{seconds * 1000:.0f} ms"
+    return f"{seconds:.2f} s"
+
+class Trace:
+    # Structured record of the stages of one run (image load, isolation clicks, analysis).
+    # Peak allocation needs tracemalloc; with track_memory the trace starts it itself.
+    # Concurrent stages on other threads share tracemalloc's single peak counter. The open stages are
+    # held in a context variable, so a stage run through contextvars.copy_context() on a pool thread
+    # (see StageScheduler) nests under the stage that submitted it.
+    # observer(record, finished) is called on the stage's thread as each stage starts and ends;
+    # raising from the start call (e.g. Cancelled) aborts the run before that stage does any work.
+    # Only the last max_runs runs are kept, so a long interactive session does not grow it without bound.
+    def __init__(self, track_memory=False, observer=None, max_runs=MAX_RUNS):
+        self.track_memory = track_memory
+        self.observer = observer
+        self.max_runs = max(1, int(max_runs))
+        self.records = []
+        # Index in records where each kept run begins
+        self._run_starts = []
+        self.origin = time.perf_counter()
+        self._stack = contextvars.ContextVar(f"trace_stack_{id(self)}", default=())
+        self._lock = threading.Lock()
+        self._owns_tracemalloc = False
+
+    @contextmanager
+    def stage(self, name, **args):
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracemalloc = True
+        tracing = tracemalloc.is_tracing()
+
+        stack = self._stack.get()
+        parent = stack[-1] if stack else None
+        record = StageRecord(name, parent.name if parent else None, len(stack),
+                             time.perf_counter() - self.origin, args)
+        if self.observer is not None:
+            self.observer(record, False)
+        with self._lock:
+            self.records.append(record)
+
+        base = 0
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent._running_peak = max(parent._running_peak, peak)
+            tracemalloc.reset_peak()
+            base = current
+
+        token = self._stack.set(stack + (record,))
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record.cpu = time.process_time() - cpu_start
+            record.wall = time.perf_counter() - wall_start
+            self._stack.reset(token)
+
+            if tracing and tracemalloc.is_tracing():
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, record._running_peak)
+                record.peak_bytes = max(0, peak - base)
+                # The enclosing stage must still see this stage's peak after the reset
+                if parent is not None:
+                    parent._running_peak = max(parent._running_peak, peak)
+                tracemalloc.reset_peak()
+
+            if self.observer is not None:
+                self.observer(record, True)
+
+    @property
+    def in_stage(self):
+        # Whether the calling context is inside a stage of this trace
+        return bool(self._stack.get())
+
+    def begin_run(self):
+        # Marks the start of a top-level run, dropping the oldest runs beyond max_runs
+        with self._lock:
+            if len(self._run_starts) >= self.max_runs:
+                drop = self._run_starts[len(self._run_starts) - self.max_runs + 1]
+                del self.records[:drop]
+                self._run_starts = [start - drop for start in self._run_starts if start >= drop]
+            self._run_starts.append(len(self.records))
+
+    def find(self, name):
+        # Most recent finished record with this name
+        for record in reversed(self.records):
+            if record.name == name and record.done:
+                return record
+        return None
+
+    def close(self):
+        if self._owns_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._owns_tracemalloc = False
+
+    def to_dict(self):
+        with self._lock:
+            return {"stages": [record.to_dict() for record in self.records]}
+
+    def to_json(self, path=None):
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+    def to_chrome_trace(self, path=None):
+        # Trace Event Format ("X" complete events), viewable in chrome://tracing or Perfetto
+        pid = os.getpid()
+        events = []
+        with self._lock:
+            records = [record for record in self.records if record.done]
+        for record in records:
+            events.append({
+                "name": record.name,
+                "cat": "pipeline",
+                "ph": "X",
+                "ts": record.start * 1e6,
+                "dur": record.wall * 1e6,
+                "pid": pid,
+                "tid": record.thread,
+                "args": dict(record.args, cpu_s=record.cpu, peak_bytes=record.peak_bytes, arrays=record.arrays)
+            })
+
+        trace = {"traceEvents": events, "displayTimeUnit": "ms"}
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(trace, f)
+        return trace
+
+def traced(name, new_trace=False):
+    # Method decorator: time the whole call as one stage of self.trace; an outermost call is a new run.
+    # new_trace starts a fresh trace first (a new run, e.g. loading another image), keeping the observer.
+    def decorate(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if new_trace:
+                old = self.trace
+                old.close()
+                self.trace = Trace(track_memory=old.track_memory, observer=old.observer, max_runs=old.max_runs)
+            if not self.trace.in_stage:
+                self.trace.begin_run()
+            with self.trace.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
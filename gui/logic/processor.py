@@ -1,301 +1,947 @@
+import math
+from functools import partial
+
 import cv2
 import numpy as np
 from PIL import Image, ImageOps
 
 import preprocessing.hue_isolator as hue_isolator
 import preprocessing.filters as filters
+import preprocessing.image_context as image_context
 import postprocessing.yarn_framing as yarn_framing
 import postprocessing.stitch_detection as stitch_detection
 import postprocessing.direction_detection as direction_detection
+import postprocessing.pyramid as pyramid
+import postprocessing.scheduler as scheduler
+import postprocessing.pipeline as pipeline
+import gui.logic.debug_frames as debug_frames
+import gui.logic.instrumentation as instrumentation
+import gui.logic.result_cache as result_cache
 import gui.utils.visualizer as visualizer
 
+# JPEG decoders can scale by up to 1/8 while decoding
+MAX_DRAFT_FACTOR = 8
+# In analyze_components, blobs smaller than this fraction of the image are noise rather than yarn
+MIN_COMPONENT_FRACTION = 0.001
+# Brightness left outside the yarn in the analysis display
+DISPLAY_DARKEN_FACTOR = 0.4
+# Settings run_full_analysis takes, with their defaults; each one feeds a single stage (see _analysis_pipeline)
+ANALYSIS_SETTINGS = {
+    "max_corners": stitch_detection.MAX_CORNERS,
+    "quality_level": stitch_detection.QUALITY_LEVEL,
+    "darken_factor": DISPLAY_DARKEN_FACTOR
+}
+
+def pil_to_bgr(pil_img):
+    # np.asarray shares PIL's exported buffer, so the conversion writes the only new full size copy
+    if pil_img.mode == 'RGB':
+        return cv2.cvtColor(np.asarray(pil_img), cv2.COLOR_RGB2BGR)
+    if pil_img.mode == 'RGBA':
+        return cv2.cvtColor(np.asarray(pil_img), cv2.COLOR_RGBA2BGR)
+    return cv2.cvtColor(np.array(pil_img), cv2.COLOR_GRAY2BGR)
+
+def decode_image(file_path, max_side=None):
+    # Returns (pil_img, scale): the oriented image and its size relative to the file.
+    # With max_side the image is shrunk by the largest power of two that keeps its long side
+    # at least max_side, mostly inside the JPEG decoder, before any full size pixels exist.
+    pil_img = Image.open(file_path)
+    full_long = max(pil_img.size)
+    
+    factor = 1
+    if max_side and full_long > max_side:
+        factor = 2 ** int(math.floor(math.log2(full_long / max_side)))
+        
+    if factor > 1:
+        w, h = pil_img.size
+        draft = min(factor, MAX_DRAFT_FACTOR)
+        # Formats without decoder scaling ignore this; reduce() does whatever is left
+        pil_img.draft(pil_img.mode, (w // draft, h // draft))
+        decoded = max(1, round(w / pil_img.size[0]))
+        if factor > decoded:
+            pil_img = pil_img.reduce(factor // decoded)
+            
+    # In place, so orienting does not add another copy
+    ImageOps.exif_transpose(pil_img, in_place=True)
+    return pil_img, max(pil_img.size) / full_long
+
+def analyze_crop(blurred, mask):
+    # Spine, width, stitches and direction of the yarn in one mask, without visualization.
+    # Returns (report or None, spine points, stitch points) in the crop's coordinates.
+    processing_img = hue_isolator.apply_mask_to_image(blurred, mask, darken_factor=0.0)
+    context = image_context.ImageContext(processing_img, mask)
+    
+    spine_points = yarn_framing.find_spine(processing_img, context=context)
+    if not spine_points:
+        return None, spine_points, []
+    width_info = yarn_framing.measure_width_at_center(spine_points, mask)
+    if not width_info:
+        return None, spine_points, []
+    half_width = width_info[2]
+    
+    width_profile = yarn_framing.measure_width_profile(spine_points, mask)
+    width_summary = None
+    if width_profile is not None:
+        width_summary = yarn_framing.summarize_width_profile(width_profile[3] * 2)
+        
+    spine_index = spine_points.spatial_index
+    stitches = stitch_detection.detect_stitches(
+        processing_img, mask, spine_points, half_width, spine_index=spine_index, context=context
+    )
+    if not stitches:
+        return None, spine_points, []
+        
+    _, _, mean_vec = direction_detection.determine_direction(
+        context.gray, spine_points, stitches, half_width, spine_index=spine_index
+    )
+    report = {
+        "count": len(stitches),
+        "direction": direction_detection.cardinal_direction(mean_vec),
+        "width": half_width * 2,
+        "width_profile": width_summary
+    }
+    return report, spine_points, stitches
+
 class ImageProcessor:
-    def __init__(self):
+    def __init__(self, debug=True, frame_budget=debug_frames.DEFAULT_BUDGET_BYTES, spill_frames=False, pyramid=False, workers=None, trace_memory=False, max_side=None, cache=None):
+        # debug=False skips all pipeline visualization (headless use)
+        self.debug = debug
+        # Decode images shrunk towards this long side (see decode_image); None keeps full resolution
+        self.max_side = max_side
+        # Decoded size relative to the file, for mapping file coordinates and lengths
+        self.load_scale = 1.0
+        # pyramid=True isolates and traces on a downscaled level, refining results at full resolution
+        self.pyramid = pyramid
+        # Threads for independent analysis stages; 1 runs everything in order on the caller's thread
+        self.workers = scheduler.default_workers() if workers is None else workers
+        # ResultCache for masks and analyses of files seen before; None computes everything
+        self.cache = cache
+        self.image_digest = None
+        self.level = 0
         self.original_cv_image = None
         self.blurred_cv_image = None
         self.masked_processing_image = None
         self.current_mask = None
+        self.full_mask = None
+        self.isolation_seed = None
         self.yarn_width = None
-        self.debug_frames = []
+        self.spine_points = None
+        self.stitch_points = None
+        self.image_context = None
+        self.analysis_context = None
+        # Stages of run_full_analysis for the current mask, with their results; see _analysis_pipeline
+        self.analysis_pipeline = None
+        self.analysis_settings = dict(ANALYSIS_SETTINGS)
+        self.preview_layers = None
+        self.debug_frames = debug_frames.DebugFrameStore(frame_budget, spill=spill_frames)
+        # Wall/CPU time of every stage of the current run; trace_memory adds tracemalloc peaks
+        self.trace = instrumentation.Trace(track_memory=trace_memory)
     
+    @instrumentation.traced("load_image", new_trace=True)
     def load_image(self, file_path):
         self.reset_state()
         
         try:
-            # Load and Orient
-            pil_img = Image.open(file_path)
-            pil_img = ImageOps.exif_transpose(pil_img)
-            
-            if pil_img.mode == 'RGB':
-                open_cv_image = np.array(pil_img) 
-                open_cv_image = open_cv_image[:, :, ::-1].copy() 
-            elif pil_img.mode == 'RGBA':
-                open_cv_image = np.array(pil_img) 
-                open_cv_image = cv2.cvtColor(open_cv_image, cv2.COLOR_RGBA2BGR)
-            else: 
-                 open_cv_image = cv2.cvtColor(np.array(pil_img), cv2.COLOR_GRAY2BGR)
-
-            self.original_cv_image = open_cv_image
+            with self.trace.stage("decode", max_side=self.max_side) as decode_stage:
+                # Load and Orient
+                pil_img, self.load_scale = decode_image(file_path, self.max_side)
+                open_cv_image = pil_to_bgr(pil_img)
+
+                decode_stage.args["scale"] = self.load_scale
+                decode_stage.add_array("image", open_cv_image)
             
-            self.blurred_cv_image = filters.apply_bilateral_filter(self.original_cv_image)
+            if self.cache is not None:
+                with self.trace.stage("hash"):
+                    self.image_digest = result_cache.file_digest(file_path)
             
-            self.debug_frames.append({
-                'title': "Original Image",
-                'image': self._cv_to_pil(self.original_cv_image),
-                'desc': "The raw input image loaded from disk."
-            })
-            self.debug_frames.append({
-                'title': "Blurred Image",
-                'image': self._cv_to_pil(self.blurred_cv_image),
-                'desc': "Bilateral filter applied to reduce noise while preserving edges."
-            })
+            self._prepare_image(open_cv_image, decode_stage, "The raw input image loaded from disk.")
             
             return pil_img
             
         except Exception:
             raise
 
-    def process_click_at(self, x, y):
+    @instrumentation.traced("load_frame", new_trace=True)
+    def load_frame(self, bgr_image):
+        # Same as load_image for a BGR array already in memory (video frames, crops)
+        self.reset_state()
+        self._prepare_image(bgr_image, None, "The input frame.")
+
+    def _prepare_image(self, open_cv_image, source_stage, source_desc):
+        self.original_cv_image = open_cv_image
+        
+        with self.trace.stage("bilateral_filter") as filter_stage:
+            # Working level: everything up to refinement runs on this copy
+            self.level = pyramid.choose_level(open_cv_image.shape) if self.pyramid else 0
+            working_image = pyramid.downscale(self.original_cv_image, self.level)
+            
+            self.blurred_cv_image = filters.apply_bilateral_filter(working_image)
+            self.image_context = image_context.ImageContext(self.blurred_cv_image)
+            filter_stage.add_array("blurred", self.blurred_cv_image)
+        
+        original = self.original_cv_image
+        blurred = self.blurred_cv_image
+        self._add_frame(
+            "Original Image",
+            source_desc,
+            lambda: original,
+            stage=source_stage
+        )
+        self._add_frame(
+            "Blurred Image",
+            "Bilateral filter applied to reduce noise while preserving edges.",
+            lambda: blurred,
+            stage=filter_stage
+        )
+
+    @instrumentation.traced("process_click_at")
+    def process_click_at(self, x, y, color_name=None, render=True):
         if self.blurred_cv_image is None:
             return None
 
-        color_name = hue_isolator.get_dominant_color_name(self.blurred_cv_image, x, y)
+        # Click is in original image coordinates
+        click = (x, y)
+        cache_key = self._cache_key("mask", [color_name, click])
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            meta, arrays = cached
+            self.isolation_seed = (meta["color"], click)
+            return self._apply_isolation(result_cache.unpack_mask(arrays["mask"], meta["shape"]), render)
+        
+        x, y = pyramid.to_working(click, self.level, self.blurred_cv_image.shape)
+
+        if color_name is None:
+            with self.trace.stage("dominant_color"):
+                color_name = hue_isolator.get_dominant_color_name(
+                    self.blurred_cv_image, x, y, context=self.image_context
+                )
         
         if color_name:
-            self.current_mask = hue_isolator.get_isolation_mask(self.blurred_cv_image, color_name, (x, y))
-            
-            self.masked_processing_image = hue_isolator.apply_mask_to_image(
-                self.blurred_cv_image, self.current_mask, darken_factor=0.0
-            )
-            
-            self.debug_frames = self.debug_frames[:2] 
-            self.debug_frames.append({
-                'title': "Isolated Yarn (Masked)",
-                'image': self._cv_to_pil(self.masked_processing_image),
-                'desc': "Yarn isolated from background using hue detection. Background set to black."
-            })
-            
-            display_cv = hue_isolator.apply_mask_to_image(
-                self.original_cv_image, self.current_mask, darken_factor=0.4
-            )
-            
-            return self._cv_to_pil(display_cv)
+            with self.trace.stage("isolation_mask", color=color_name) as isolation_stage:
+                mask = hue_isolator.get_isolation_mask(
+                    self.blurred_cv_image, color_name, (x, y), context=self.image_context
+                )
+                isolation_stage.add_array("mask", mask)
+            self.isolation_seed = (color_name, click)
+            self._cache_put(cache_key, {"color": color_name, "shape": mask.shape}, mask=result_cache.pack_mask(mask))
+            return self._apply_isolation(mask, render, stage=isolation_stage)
         
         return None
 
-    def run_full_analysis(self):
+    @instrumentation.traced("process_color")
+    def process_color(self, color_name, render=True):
+        if self.blurred_cv_image is None:
+            return None
+
+        # No seed point: keep the largest blob of the requested colour
+        self.isolation_seed = (color_name, None)
+        cache_key = self._cache_key("mask", [color_name, None])
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            meta, arrays = cached
+            return self._apply_isolation(result_cache.unpack_mask(arrays["mask"], meta["shape"]), render)
+        
+        with self.trace.stage("isolation_mask", color=color_name) as isolation_stage:
+            mask = hue_isolator.get_isolation_mask(self.blurred_cv_image, color_name, context=self.image_context)
+            mask = hue_isolator.keep_largest_component(mask)
+            isolation_stage.add_array("mask", mask)
+        self._cache_put(cache_key, {"color": color_name, "shape": mask.shape}, mask=result_cache.pack_mask(mask))
+        
+        return self._apply_isolation(mask, render, stage=isolation_stage)
+
+    def _apply_isolation(self, mask, render=True, stage=None):
+        # Returns the preview image, or the mask itself when render is False
+        self.current_mask = mask
+        self.full_mask = pyramid.upscale_mask(mask, self.level, self.original_cv_image.shape)
+        
+        self.masked_processing_image = hue_isolator.apply_mask_to_image(
+            self.blurred_cv_image, self.current_mask, darken_factor=0.0
+        )
+        self.analysis_context = image_context.ImageContext(self.masked_processing_image, self.current_mask)
+        self.analysis_pipeline = self._analysis_pipeline()
+        
+        masked = self.masked_processing_image
+        self.debug_frames.truncate(2)
+        self._add_frame(
+            "Isolated Yarn (Masked)",
+            "Yarn isolated from background using hue detection. Background set to black.",
+            lambda: masked,
+            stage=stage
+        )
+
+        if not render:
+            return self.current_mask
+        
+        with self.trace.stage("render_preview"):
+            # Only the mask changes between clicks, so the dimmed and plain RGB layers are reused
+            if self.preview_layers is None:
+                original_rgb = cv2.cvtColor(self.original_cv_image, cv2.COLOR_BGR2RGB)
+                dimmed_rgb = hue_isolator.apply_mask_to_image(
+                    original_rgb, np.zeros(original_rgb.shape[:2], dtype=np.uint8), darken_factor=DISPLAY_DARKEN_FACTOR
+                )
+                self.preview_layers = (dimmed_rgb, original_rgb)
+                
+            dimmed_rgb, original_rgb = self.preview_layers
+            display_rgb = dimmed_rgb.copy()
+            cv2.copyTo(original_rgb, self.full_mask, display_rgb)
+            
+            return Image.fromarray(display_rgb)
+
+    @instrumentation.traced("run_full_analysis")
+    def run_full_analysis(self, render=True, **settings):
+        # Returns (display image, report); the image is None when render is False.
+        # settings (see ANALYSIS_SETTINGS) apply to this and later runs. Stage results are kept per mask,
+        # so running again after a settings change only repeats the stages that take a changed setting
+        # and the stages after them.
         if self.current_mask is None or self.masked_processing_image is None:
             return None, None
+        self.set_analysis_settings(**settings)
+        
+        # Drop the frames of an earlier (or cancelled) analysis of this mask
+        self.debug_frames.truncate(3)
+        
+        stages = self.analysis_pipeline
+        stages.set_params(**self.analysis_settings)
+        
+        # Analysis depends only on the mask and settings, except that full resolution refinement re-isolates from the seed
+        cache_key = None
+        if self.cache is not None and self.image_digest is not None and not stages.is_fresh("direction"):
+            with self.trace.stage("hash"):
+                mask_digest = result_cache.array_digest(self.current_mask)
+            cache_key = self._cache_key(
+                "analysis", [mask_digest, self.isolation_seed if self.level > 0 else None],
+                max_corners=self.analysis_settings["max_corners"], quality_level=self.analysis_settings["quality_level"]
+            )
+            # Once the spine and corner candidates are in memory, redoing the later stages beats reading the cache
+            cached = None if stages.is_fresh("candidates") else self._cache_get(cache_key)
+            if cached is not None:
+                return self._restore_analysis(*cached, render)
             
-        processing_img = self.masked_processing_image
-        report_data = None
+        results = stages.run("direction")
+        spine, detection, direction = results["spine"], results["stitches"], results["direction"]
+        for frame in spine["frames"] + detection["frames"] + direction["frames"]:
+            self._add_frame(*frame)
+            
+        spine_points = spine["spine_points"]
+        offset = spine["offset"]
+        width_info = spine["width_info"]
+        stitches = detection["stitches"]
+        flow = direction["flow"]
+        report_data = direction["report"]
         
-        display_cv = hue_isolator.apply_mask_to_image(
-            self.original_cv_image, self.current_mask, darken_factor=0.4
+        # Results in original image coordinates
+        if self.level > 0 and offset == (0, 0) and spine_points:
+            # Never reached full resolution (no width), scale the working spine up
+            spine_points = yarn_framing.SpinePath(pyramid.densify_path(pyramid.to_full(spine_points, self.level)))
+            
+        full_spine = spine_points.shifted(offset)
+        full_width_info = None
+        if width_info:
+            p1, p2, half_width = width_info
+            full_width_info = (*pyramid.shift_points([p1, p2], offset), half_width)
+        full_flow = None
+        if flow is not None:
+            global_dir, visual_votes, final_dots = flow
+            vote_points = pyramid.shift_points([pt for pt, _, _ in visual_votes], offset)
+            full_votes = [(pt, vb, vs) for pt, (_, vb, vs) in zip(vote_points, visual_votes)]
+            full_flow = (global_dir, full_votes, pyramid.shift_points(final_dots, offset))
+            
+        analysis = {
+            "yarn_width": spine["yarn_width"],
+            "full_mask": spine["full_mask"],
+            "spine_points": full_spine,
+            "stitch_points": pyramid.shift_points(stitches, offset),
+            "width_info": full_width_info,
+            "flow": full_flow,
+            "report": report_data
+        }
+        self._store_analysis(cache_key, analysis)
+        
+        return self._finish_analysis(analysis, render)
+
+    def set_analysis_settings(self, **settings):
+        for name, value in settings.items():
+            if name not in ANALYSIS_SETTINGS:
+                raise ValueError(f"Unknown analysis setting: {name}")
+            self.analysis_settings[name] = type(ANALYSIS_SETTINGS[name])(value)
+
+    def _analysis_pipeline(self):
+        # run_full_analysis as stages over the isolated mask:
+        # spine -> corner candidates -> stitches (max_corners, quality_level) -> direction.
+        # The display (darken_factor) is drawn from the results afterwards, see _finish_analysis.
+        # Stages only return values; the processor's fields are set from them in _finish_analysis,
+        # so a memo hit or a cancelled run never leaves them out of step with the results.
+        # Only stitches and direction ever have more than one result (one per setting), so a few are kept
+        stages = pipeline.Pipeline(self.workers, memo_size=4)
+        stages.add_source(
+            "isolation", (self.masked_processing_image, self.analysis_context, self.current_mask, self.full_mask), "mask"
         )
+        stages.add("spine", self._spine_stage, inputs=("isolation",))
+        stages.add("candidates", self._candidates_stage, inputs=("spine",))
+        stages.add("stitches", self._stitch_stage, inputs=("spine", "candidates"), params=("max_corners", "quality_level"))
+        stages.add("direction", self._direction_stage, inputs=("spine", "stitches"))
+        return stages
+
+    def _spine_stage(self, isolation):
+        # Spine, centre width and width profile; at a pyramid level this also hands off to a full resolution window
+        processing_img, context, mask, full_mask = isolation
+        offset = (0, 0)
+        width_info = None
+        yarn_width = None
+        width_summary = None
+        frames = []
         
-        spine_points, skeleton_img = yarn_framing.find_spine(processing_img, return_skeleton=True)
+        # Skeletonization is the slowest stage; the planes stitch detection needs next overlap with it.
+        # After a coarse-to-fine hand-off those planes belong to the full resolution window instead.
+        with self.trace.stage("find_spine") as spine_stage:
+            stages = scheduler.StageScheduler(self.workers)
+            stages.add('spine', partial(yarn_framing.find_spine, processing_img, return_skeleton=True, context=context))
+            if self.level == 0:
+                stages.add('distance', lambda: context.distance)
+                stages.add('snap_gray', lambda: context.snap_gray)
+            spine_points, skeleton_img = stages.run()['spine']
+            spine_stage.add_array("skeleton", skeleton_img)
         
         if spine_points:
-            # Yarn Framing (Spine)
-            visualizer.draw_spine(display_cv, spine_points)
-
             # Measure Width
-            width_info = yarn_framing.measure_width_at_center(spine_points, self.current_mask)
+            with self.trace.stage("measure_width"):
+                width_info = yarn_framing.measure_width_at_center(spine_points, mask)
+            if width_info:
+                yarn_width = width_info[2]
             
             # Spine & Skeleton Visualization
-            step3_left = processing_img.copy()
-            visualizer.draw_spine(step3_left, spine_points)
-            if width_info:
-                p1, p2, half_width = width_info
-                self.yarn_width = half_width
-                visualizer.draw_width_line(step3_left, p1, p2)
-                visualizer.draw_width_line(display_cv, p1, p2)
+            frames.append((
+                "Spine Extraction",
+                "Left: Spine & Width detected on isolated image. Right: Skeleton used for pathfinding.",
+                partial(self._render_spine_frame, processing_img, skeleton_img, spine_points, width_info),
+                spine_stage
+            ))
+            
+            if self.level > 0 and yarn_width is not None:
+                # Coarse-to-fine: the spine is redone and stitches and direction run at full resolution, in a band around the yarn
+                with self.trace.stage("full_resolution", level=self.level):
+                    window = self._enter_full_resolution(spine_points, mask, full_mask)
+                processing_img, context, mask, offset, spine_points, width_info, yarn_width, full_mask = window
+            
+            # Width along the whole spine; the centre measurement stays the headline width
+            with self.trace.stage("width_profile"):
+                width_profile = yarn_framing.measure_width_profile(spine_points.shifted(offset), mask, offset=offset)
+            if width_profile is not None:
+                width_summary = yarn_framing.summarize_width_profile(width_profile[3] * 2)
+                
+        return {
+            "processing_img": processing_img,
+            "context": context,
+            "mask": mask,
+            "offset": offset,
+            "spine_points": spine_points,
+            "width_info": width_info,
+            "yarn_width": yarn_width,
+            "full_mask": full_mask,
+            "width_summary": width_summary,
+            "frames": frames
+        }
+
+    def _candidates_stage(self, spine):
+        # Corner response of the yarn, shared by every max_corners and quality_level
+        if not spine["spine_points"] or spine["yarn_width"] is None:
+            return None
+        with self.trace.stage("corner_candidates"):
+            return stitch_detection.get_corner_candidates(spine["context"])
+
+    def _stitch_stage(self, spine, candidates, max_corners, quality_level):
+        if candidates is None:
+            return {"stitches": [], "raw": [], "frames": []}
             
-            step3_right = cv2.cvtColor(skeleton_img, cv2.COLOR_GRAY2BGR)
+        processing_img = spine["processing_img"]
+        frames = []
+        with self.trace.stage("detect_stitches") as stitch_stage:
+            stitches, debug_data = stitch_detection.detect_stitches(
+                processing_img, 
+                spine["mask"], 
+                spine["spine_points"], 
+                spine["yarn_width"],
+                max_corners=max_corners,
+                quality_level=quality_level,
+                debug=True,
+                spine_index=spine["spine_points"].spatial_index,
+                context=spine["context"],
+                workers=self.workers,
+                candidates=candidates
+            )
+            stitch_stage.add_array("image", processing_img)
+        
+        weight_map = debug_data.get('weight_map')
+        opt_steps = debug_data.get('steps', [])
+        raw_pts = debug_data.get('raw', [])
+        snapped_pts = stitches
+        
+        # Heat Map Visualization
+        if weight_map is not None:
+            frames.append((
+                "Distance Transform Heatmap",
+                "Weighting map based on distance from center (spine) and yarn edges.",
+                partial(stitch_detection.render_heatmap, weight_map),
+                stitch_stage
+            ))
             
-            h, w, _ = step3_left.shape
-            combined = np.hstack((step3_left, step3_right))
+        # Optimization Steps Visualization
+        if opt_steps:
+            indices = [0, len(opt_steps)//2, len(opt_steps)-1]
+            indices = sorted(list(set(indices))) 
             
-            self.debug_frames.append({
-                'title': "Spine Extraction",
-                'image': self._cv_to_pil(combined),
-                'desc': "Left: Spine & Width detected on isolated image. Right: Skeleton used for pathfinding."
-            })
+            shown_steps = [opt_steps[idx] for idx in indices]
+            descriptions = [f"d={step['dist']}, cv={step['cv']:.2f}" for step in shown_steps]
             
-            # Detect Stitches
-            if self.yarn_width is not None:
-                stitches, debug_data = stitch_detection.detect_stitches(
-                    processing_img, 
-                    self.current_mask, 
-                    spine_points, 
-                    self.yarn_width,
-                    debug=True
-                )
-                
-                heatmap_img = debug_data.get('heatmap')
-                opt_steps = debug_data.get('steps', [])
-                raw_pts = debug_data.get('raw', [])
-                snapped_pts = stitches
-                
-                # Heat Map Visualization
-                if heatmap_img is not None:
-                    self.debug_frames.append({
-                        'title': "Distance Transform Heatmap",
-                        'image': self._cv_to_pil(heatmap_img),
-                        'desc': "Weighting map based on distance from center (spine) and yarn edges."
-                    })
-                    
-                # Optimization Steps Visualization
-                if opt_steps:
-                    indices = [0, len(opt_steps)//2, len(opt_steps)-1]
-                    indices = sorted(list(set(indices))) 
-                    
-                    combined_opt_list = []
-                    descriptions = []
-                    
-                    for idx in indices:
-                        step = opt_steps[idx]
-                        desc = f"d={step['dist']}, cv={step['cv']:.2f}"
-                        descriptions.append(desc)
-                        
-                        clean_img = processing_img.copy()
-                        visualizer.draw_corners(clean_img, step['corners'], color=(0, 255, 255), radius=20)
-                        
-                        cv2.putText(clean_img, desc, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-                        
-                        combined_opt_list.append(clean_img)
-                    
-                    if combined_opt_list:
-                        combined_opt_img = np.hstack(combined_opt_list)
-                        self.debug_frames.append({
-                            'title': f"Optimization Iterations",
-                            'image': self._cv_to_pil(combined_opt_img),
-                            'desc': f"Comparing corner spacing consistency (CV) at different minimum distances: {', '.join(descriptions)}"
-                        })
-
-                # Stitch Refinement Visualization
-                left_img = processing_img.copy()
-                visualizer.draw_corners(left_img, raw_pts, color=(0, 255, 255), radius=15) 
-                
-                right_img = processing_img.copy()
-                visualizer.draw_corners(right_img, snapped_pts, color=(0, 0, 255), radius=15)
-                
-                combined_stitches = np.hstack((left_img, right_img))
-                self.debug_frames.append({
-                    'title': "Stitch Refinement",
-                    'image': self._cv_to_pil(combined_stitches),
-                    'desc': "Left: Raw Optimization Results (Cyan). Right: Snapped to Darkest Pixels (Red)."
-                })
-                if stitches:
-                    # Determine Direction
-                    gray_proc = cv2.cvtColor(processing_img, cv2.COLOR_BGR2GRAY)
-                    
-                    global_dir, votes, mean_vec = direction_detection.determine_direction(
-                        gray_proc, 
-                        spine_points, 
-                        stitches, 
-                        self.yarn_width
-                    )
-                    
-                    # Convert Mean Vector to Cardinal Direction
-                    mx, my = mean_vec
-                    abs_x = abs(mx)
-                    abs_y = abs(my)
-                    
-                    dir_text = "UNKNOWN"
-                    if abs_x > abs_y:
-                        dir_text = "RIGHT" if mx > 0 else "LEFT"
-                    else:
-                        dir_text = "DOWN" if my > 0 else "UP"
-
-                    # Check Visual Alignment of Spine Arrows
-                    visual_dir_text = direction_detection.check_visual_spine_direction(
-                        processing_img.shape, spine_points, global_dir
-                    )
-                    
-                    # Flip logic if strictly opposite
-                    flipped_visual = False
-                    if dir_text == "LEFT" and visual_dir_text == "RIGHT":
-                        global_dir *= -1
-                        flipped_visual = True
-                    elif dir_text == "RIGHT" and visual_dir_text == "LEFT":
-                        global_dir *= -1
-                        flipped_visual = True
-                    elif dir_text == "UP" and visual_dir_text == "DOWN":
-                        global_dir *= -1
-                        flipped_visual = True
-                    elif dir_text == "DOWN" and visual_dir_text == "UP":
-                        global_dir *= -1
-                        flipped_visual = True
-
-                    # Map visual arrows to use raw points while keeping direction calculation from snapped points
-                    visual_votes = votes
-                    if raw_pts and len(raw_pts) == len(votes):
-                        visual_votes = []
-                        for i in range(len(votes)):
-                            _, vb, vs = votes[i]
-                            visual_votes.append((raw_pts[i], vb, vs))
-
-                    # CAPTURE STEP 7: Stitch Directions
-                    step7_img = processing_img.copy()
-                    visualizer.draw_stitch_votes(step7_img, visual_votes) # Start arrows at Raw
-                    # Also draw Raw dots instead of snapped stitches
-                    final_dots = raw_pts if raw_pts else stitches
-                    visualizer.draw_corners(step7_img, final_dots, color=(0, 0, 255), radius=20)
-                    
-                    self.debug_frames.append({
-                        'title': "Stitch Direction Analysis",
-                        'image': self._cv_to_pil(step7_img),
-                        'desc': "Cyan Arrows: Brightness Gradient. Pink Arrows: Structure Tensor (if active). Calculating local flow at each stitch."
-                    })
-
-                    # Drawing Layer 2: Spine Arrows
-                    visualizer.draw_spine_arrows(display_cv, spine_points, global_dir)
-                    
-                    # CAPTURE STEP 8: Spine Direction
-                    step8_img = processing_img.copy()
-                    visualizer.draw_spine(step8_img, spine_points) # Added spine line for context
-                    visualizer.draw_spine_arrows(step8_img, spine_points, global_dir)
-                    
-                    flip_msg = f" (Visual Correction applied: {visual_dir_text} -> Adjusted)" if flipped_visual else ""
-                    self.debug_frames.append({
-                        'title': "Global Spine Flow",
-                        'image': self._cv_to_pil(step8_img),
-                        'desc': f"Global Direction Determined: {dir_text} (Mean Vector: [{mx:.2f}, {my:.2f}]). Green arrows follow the loop structure.{flip_msg}"
-                    })
-                    
-                    # Drawing Layer 3: Stitch Arrows
-                    visualizer.draw_stitch_votes(display_cv, visual_votes) # Use mapped votes
-                    
-                    # Drawing Layer 4: Stitch Dots (Top)
-                    # User Request: Use raw points (not snapped) for final dot visualization
-                    visualizer.draw_corners(display_cv, final_dots, color=(0, 0, 255), radius=20)
-                     # For consistency in main view too
-                    
-                    # CAPTURE STEP 9: Final Result
-                    self.debug_frames.append({
-                        'title': "Final Analysis Output",
-                        'image': self._cv_to_pil(display_cv),
-                        'desc': "Complete visualization with Spine, Width, Flow Arrows, and Stitch Locations (Raw) overlaid on the original image."
-                    })
-                    
-                    # Prepare Report Data
-                    report_data = {
-                        "count": len(stitches),
-                        "direction": dir_text,
-                        "width": self.yarn_width * 2 # Full width
-                    }
+            frames.append((
+                f"Optimization Iterations",
+                f"Comparing corner spacing consistency (CV) at different minimum distances: {', '.join(descriptions)}",
+                partial(self._render_optimization_frame, processing_img, shown_steps, descriptions),
+                stitch_stage
+            ))
+
+        # Stitch Refinement Visualization
+        frames.append((
+            "Stitch Refinement",
+            "Left: Raw Optimization Results (Cyan). Right: Snapped to Darkest Pixels (Red).",
+            partial(self._render_refinement_frame, processing_img, raw_pts, snapped_pts),
+            stitch_stage
+        ))
         
+        return {"stitches": stitches, "raw": raw_pts, "frames": frames}
+
+    def _direction_stage(self, spine, detection):
+        # Global direction, arrows for the display and the report
+        stitches = detection["stitches"]
+        if not stitches:
+            return {"flow": None, "report": None, "frames": []}
+            
+        processing_img = spine["processing_img"]
+        spine_points = spine["spine_points"]
+        raw_pts = detection["raw"]
+        frames = []
+        
+        # Determine Direction
+        gray_proc = spine["context"].gray
+        
+        with self.trace.stage("determine_direction", stitches=len(stitches)) as direction_stage:
+            global_dir, votes, mean_vec = direction_detection.determine_direction(
+                gray_proc, 
+                spine_points, 
+                stitches, 
+                spine["yarn_width"],
+                spine_index=spine_points.spatial_index
+            )
+        
+        mx, my = mean_vec
+        dir_text = direction_detection.cardinal_direction(mean_vec)
+
+        # Check Visual Alignment of Spine Arrows
+        visual_dir_text = direction_detection.check_visual_spine_direction(
+            processing_img.shape, spine_points, global_dir
+        )
+        
+        # Flip logic if strictly opposite
+        flipped_visual = False
+        if dir_text == "LEFT" and visual_dir_text == "RIGHT":
+            global_dir *= -1
+            flipped_visual = True
+        elif dir_text == "RIGHT" and visual_dir_text == "LEFT":
+            global_dir *= -1
+            flipped_visual = True
+        elif dir_text == "UP" and visual_dir_text == "DOWN":
+            global_dir *= -1
+            flipped_visual = True
+        elif dir_text == "DOWN" and visual_dir_text == "UP":
+            global_dir *= -1
+            flipped_visual = True
+
+        # Map visual arrows to use raw points while keeping direction calculation from snapped points
+        visual_votes = votes
+        if raw_pts and len(raw_pts) == len(votes):
+            visual_votes = []
+            for i in range(len(votes)):
+                _, vb, vs = votes[i]
+                visual_votes.append((raw_pts[i], vb, vs))
+
+        # User Request: Use raw points (not snapped) for final dot visualization
+        final_dots = raw_pts if raw_pts else stitches
+        flow = (global_dir, visual_votes, final_dots)
+        
+        # CAPTURE STEP 7: Stitch Directions
+        frames.append((
+            "Stitch Direction Analysis",
+            "Cyan Arrows: Brightness Gradient. Pink Arrows: Structure Tensor (if active). Calculating local flow at each stitch.",
+            partial(self._render_votes_frame, processing_img, visual_votes, final_dots),
+            direction_stage
+        ))
+        
+        # CAPTURE STEP 8: Spine Direction
+        flip_msg = f" (Visual Correction applied: {visual_dir_text} -> Adjusted)" if flipped_visual else ""
+        frames.append((
+            "Global Spine Flow",
+            f"Global Direction Determined: {dir_text} (Mean Vector: [{mx:.2f}, {my:.2f}]). Green arrows follow the loop structure.{flip_msg}",
+            partial(self._render_flow_frame, processing_img, spine_points, global_dir),
+            direction_stage
+        ))
+        
+        # Prepare Report Data
+        report_data = {
+            "count": len(stitches),
+            "direction": dir_text,
+            "width": spine["yarn_width"] * 2, # Full width
+            "width_profile": spine["width_summary"]
+        }
+        return {"flow": flow, "report": report_data, "frames": frames}
+
+    def _finish_analysis(self, analysis, render):
+        # analysis holds the results in original image coordinates (see run_full_analysis); this is the
+        # only place an analysis or a cache restore updates the processor's fields
+        self.yarn_width = analysis["yarn_width"]
+        self.full_mask = analysis["full_mask"]
+        self.spine_points = analysis["spine_points"]
+        self.stitch_points = analysis["stitch_points"]
+        
+        full_mask = self.full_mask
+        full_spine = self.spine_points
+        full_width_info = analysis["width_info"]
+        full_flow = analysis["flow"]
+        report_data = analysis["report"]
+        display_cv = None
+        render_stage = None
+        if render:
+            with self.trace.stage("render_display") as render_stage:
+                display_cv = self._render_display(full_mask, full_spine, full_width_info, full_flow)
+
+        if full_flow is not None:
+            # CAPTURE STEP 9: Final Result
+            self._add_frame(
+                "Final Analysis Output",
+                "Complete visualization with Spine, Width, Flow Arrows, and Stitch Locations (Raw) overlaid on the original image.",
+                (lambda: display_cv) if display_cv is not None else
+                partial(self._render_display, full_mask, full_spine, full_width_info, full_flow),
+                stage=render_stage
+            )
+
+        if display_cv is None:
+            return None, report_data
         return self._cv_to_pil(display_cv), report_data
 
+    @instrumentation.traced("analyze_components")
+    def analyze_components(self, color_name=None, point=None, min_area=None, render=False):
+        # Every blob of the colour (by default the colour under point, and with neither given every
+        # colour in the image) of at least min_area pixels (default MIN_COMPONENT_FRACTION of the image),
+        # each analyzed on its own crop. Crops run in parallel, largest first, so the total stays close
+        # to the slowest one. Returns (display image or None, results), one result per blob, largest
+        # first within each colour, in original image coordinates.
+        if self.blurred_cv_image is None:
+            return None, []
+            
+        if color_name is None and point is not None:
+            with self.trace.stage("dominant_color"):
+                x, y = pyramid.to_working(point, self.level, self.blurred_cv_image.shape)
+                color_name = hue_isolator.get_dominant_color_name(
+                    self.blurred_cv_image, x, y, context=self.image_context
+                )
+            if not color_name:
+                return None, []
+            
+        h, w = self.original_cv_image.shape[:2]
+        if min_area is None:
+            min_area = MIN_COMPONENT_FRACTION * h * w
+        s = 2 ** self.level
+        working_area = min_area / (s * s)
+            
+        if color_name is None:
+            # Colours too rare to hold a single blob are never cleaned or labelled
+            with self.trace.stage("color_areas"):
+                areas = hue_isolator.get_color_areas(self.blurred_cv_image, context=self.image_context)
+            color_names = [name for name in hue_isolator.COLOR_NAMES if areas[name] >= working_area]
+        else:
+            color_names = [color_name]
+            
+        crops = []
+        for name in color_names:
+            with self.trace.stage("isolation_mask", color=name):
+                crops += [(name, box, mask) for box, mask in hue_isolator.get_component_crops(
+                    self.blurred_cv_image, name, working_area, context=self.image_context
+                )]
+        
+        stages = scheduler.StageScheduler(self.workers)
+        for index, (name, box, mask) in enumerate(crops):
+            stages.add(index, partial(self._analyze_component, index, name, box, mask))
+        results = stages.run()
+        results = [results[index] for index in range(len(crops))]
+        
+        display = None
+        if render:
+            with self.trace.stage("render_display"):
+                display = self._cv_to_pil(self._render_components(results))
+        return display, results
+
+    def _analyze_component(self, index, color_name, box, mask):
+        with self.trace.stage("component", index=index, color=color_name) as stage:
+            x1, y1, x2, y2 = box
+            if self.level > 0:
+                # Working level crops are aligned to whole blocks, so they scale up exactly
+                s = 2 ** self.level
+                h, w = self.original_cv_image.shape[:2]
+                x1, y1, x2, y2 = x1 * s, y1 * s, min(w, x2 * s), min(h, y2 * s)
+                mask = pyramid.upscale_mask(mask, self.level, (y2 - y1, x2 - x1))
+                blurred = pyramid.filter_window(self.original_cv_image, (x1, y1, x2, y2), filters.apply_bilateral_filter)
+            else:
+                blurred = self.blurred_cv_image[y1:y2, x1:x2]
+            stage.add_array("mask", mask)
+            
+            report, spine_points, stitches = analyze_crop(blurred, mask)
+            
+        result = {
+            "index": index,
+            "color": color_name,
+            "box": [int(x1), int(y1), int(x2), int(y2)],
+            "area": int(cv2.countNonZero(mask)),
+            "count": None,
+            "direction": None,
+            "width": None,
+            "width_profile": None
+        }
+        if report is not None:
+            result.update(report)
+        result["spine"] = spine_points.shifted((x1, y1))
+        result["stitches"] = pyramid.shift_points(stitches, (x1, y1))
+        return result
+
+    def _render_components(self, results):
+        full_mask = np.zeros(self.original_cv_image.shape[:2], dtype=np.uint8)
+        display_cv = hue_isolator.apply_mask_to_image(
+            self.original_cv_image, full_mask, darken_factor=self.analysis_settings["darken_factor"]
+        )
+        for result in results:
+            x1, y1, x2, y2 = result["box"]
+            cv2.rectangle(display_cv, (x1, y1), (x2 - 1, y2 - 1), (255, 255, 0), 8)
+            if result["spine"]:
+                visualizer.draw_spine(display_cv, result["spine"])
+            visualizer.draw_corners(display_cv, result["stitches"], color=(0, 0, 255), radius=20)
+        return display_cv
+
+    def _cache_key(self, kind, seed, **params):
+        # params override the default analysis settings in the key
+        if self.cache is None or self.image_digest is None:
+            return None
+        params = result_cache.analysis_params(pyramid=self.pyramid, max_side=self.max_side, **params)
+        return result_cache.make_key(kind, self.image_digest, seed, params)
+
+    def _cache_get(self, key):
+        if key is None:
+            return None
+        with self.trace.stage("cache_read") as stage:
+            cached = self.cache.get(key)
+            stage.args["hit"] = cached is not None
+        return cached
+
+    def _cache_put(self, key, meta, **arrays):
+        if key is not None:
+            with self.trace.stage("cache_write"):
+                self.cache.put(key, meta, **arrays)
+
+    def _store_analysis(self, key, analysis):
+        # Everything _restore_analysis needs to report and draw the result again, in original image coordinates
+        if key is None:
+            return
+        full_width_info = analysis["width_info"]
+        full_flow = analysis["flow"]
+        meta = {"report": analysis["report"], "yarn_width": analysis["yarn_width"], "width_info": None, "direction": None}
+        arrays = {
+            "spine": result_cache.pack_points(analysis["spine_points"]),
+            "stitches": result_cache.pack_points(analysis["stitch_points"])
+        }
+        if full_width_info is not None:
+            p1, p2, half_width = full_width_info
+            meta["width_info"] = [list(p1), list(p2), half_width]
+        if full_flow is not None:
+            global_dir, votes, final_dots = full_flow
+            meta["direction"] = global_dir
+            arrays["vote_points"] = result_cache.pack_points([pt for pt, _, _ in votes])
+            arrays["vote_vectors"] = np.array([[*vb, *vs] for _, vb, vs in votes], dtype=np.float64).reshape(-1, 4)
+            arrays["dots"] = result_cache.pack_points(final_dots)
+        if self.level > 0:
+            # Refinement replaced the upscaled mask that the display is drawn over
+            meta["full_shape"] = analysis["full_mask"].shape
+            arrays["full_mask"] = result_cache.pack_mask(analysis["full_mask"])
+        self._cache_put(key, meta, **arrays)
+
+    def _restore_analysis(self, meta, arrays, render):
+        # Without refinement the display is drawn over the isolated mask itself (free at level 0)
+        if "full_mask" in arrays:
+            full_mask = result_cache.unpack_mask(arrays["full_mask"], meta["full_shape"])
+        else:
+            full_mask = pyramid.upscale_mask(self.current_mask, self.level, self.original_cv_image.shape)
+        
+        full_width_info = None
+        if meta["width_info"] is not None:
+            p1, p2, half_width = meta["width_info"]
+            full_width_info = (tuple(p1), tuple(p2), half_width)
+        full_flow = None
+        if meta["direction"] is not None:
+            votes = [
+                (pt, (bx, by), (sx, sy))
+                for pt, (bx, by, sx, sy) in zip(result_cache.unpack_points(arrays["vote_points"]), arrays["vote_vectors"].tolist())
+            ]
+            full_flow = (meta["direction"], votes, result_cache.unpack_points(arrays["dots"]))
+        
+        analysis = {
+            "yarn_width": meta["yarn_width"],
+            "full_mask": full_mask,
+            "spine_points": yarn_framing.SpinePath(arrays["spine"]),
+            "stitch_points": result_cache.unpack_points(arrays["stitches"]),
+            "width_info": full_width_info,
+            "flow": full_flow,
+            "report": meta["report"]
+        }
+        return self._finish_analysis(analysis, render)
+
+    def _enter_full_resolution(self, spine_points, mask, full_mask):
+        # Re-isolate and re-skeletonize at full resolution, but only in a band around the upscaled spine (see
+        # pyramid.spine_band): the bilateral filter runs on the band's tiles and the mask is cut to the band.
+        # The band holds the whole yarn, so mask, spine and width are the full resolution run's, and so are
+        # the stitches and direction found from them. Returns the window's image, context, mask and offset,
+        # the spine, width info and yarn width in it, and the full size mask with the window re-isolated
+        # (full_mask itself is left alone).
+        band, (x1, y1, x2, y2) = pyramid.spine_band(spine_points, mask, self.level, full_mask.shape)
+        window_band = band[y1:y2, x1:x2]
+        
+        blurred = pyramid.filter_band(self.original_cv_image, band, (x1, y1, x2, y2), filters.apply_bilateral_filter)
+        mask = self._isolate_window(blurred, (x1, y1))
+        if mask is not None:
+            mask = cv2.bitwise_and(mask, window_band)
+        else:
+            mask = cv2.bitwise_and(full_mask[y1:y2, x1:x2], window_band)
+        full_mask = np.zeros_like(full_mask)
+        full_mask[y1:y2, x1:x2] = mask
+            
+        processing_img = hue_isolator.apply_mask_to_image(blurred, mask, darken_factor=0.0)
+        context = image_context.ImageContext(processing_img, mask)
+        
+        spine_points = yarn_framing.find_spine(processing_img, context=context)
+        # Rays are cast from the full size spine, so they round as on the whole image
+        width_info = None
+        if spine_points:
+            width_info = yarn_framing.measure_width_at_center(spine_points.shifted((x1, y1)), mask, offset=(x1, y1))
+        if width_info:
+            width_info = (*pyramid.shift_points(width_info[:2], (-x1, -y1)), width_info[2])
+        yarn_width = width_info[2] if width_info else None
+            
+        return processing_img, context, mask, (x1, y1), spine_points, width_info, yarn_width, full_mask
+
+    def _isolate_window(self, blurred, offset):
+        # Same isolation as the click, on a full resolution window; None if it finds nothing there
+        if self.isolation_seed is None:
+            return None
+            
+        color_name, point = self.isolation_seed
+        if point is not None:
+            mask = hue_isolator.get_isolation_mask(blurred, color_name, (point[0] - offset[0], point[1] - offset[1]))
+        else:
+            mask = hue_isolator.keep_largest_component(hue_isolator.get_isolation_mask(blurred, color_name))
+            
+        if not np.any(mask):
+            return None
+        return mask
+
+    def _render_display(self, full_mask, spine_points, width_info, flow):
+        display_cv = hue_isolator.apply_mask_to_image(
+            self.original_cv_image, full_mask, darken_factor=self.analysis_settings["darken_factor"]
+        )
+
+        if spine_points:
+            # Yarn Framing (Spine)
+            visualizer.draw_spine(display_cv, spine_points)
+            if width_info:
+                p1, p2, _ = width_info
+                visualizer.draw_width_line(display_cv, p1, p2)
+
+        if flow is not None:
+            global_dir, visual_votes, final_dots = flow
+
+            # Drawing Layer 2: Spine Arrows
+            visualizer.draw_spine_arrows(display_cv, spine_points, global_dir)
+
+            # Drawing Layer 3: Stitch Arrows
+            visualizer.draw_stitch_votes(display_cv, visual_votes) # Use mapped votes
+
+            # Drawing Layer 4: Stitch Dots (Top)
+            visualizer.draw_corners(display_cv, final_dots, color=(0, 0, 255), radius=20)
+
+        return display_cv
+
+    def _render_spine_frame(self, processing_img, skeleton_img, spine_points, width_info):
+        step3_left = processing_img.copy()
+        visualizer.draw_spine(step3_left, spine_points)
+        if width_info:
+            p1, p2, _ = width_info
+            visualizer.draw_width_line(step3_left, p1, p2)
+
+        step3_right = cv2.cvtColor(skeleton_img, cv2.COLOR_GRAY2BGR)
+
+        return np.hstack((step3_left, step3_right))
+
+    def _render_optimization_frame(self, processing_img, steps, descriptions):
+        combined_opt_list = []
+
+        for step, desc in zip(steps, descriptions):
+            clean_img = processing_img.copy()
+            visualizer.draw_corners(clean_img, step['corners'], color=(0, 255, 255), radius=20)
+
+            cv2.putText(clean_img, desc, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+
+            combined_opt_list.append(clean_img)
+
+        return np.hstack(combined_opt_list)
+
+    def _render_refinement_frame(self, processing_img, raw_pts, snapped_pts):
+        left_img = processing_img.copy()
+        visualizer.draw_corners(left_img, raw_pts, color=(0, 255, 255), radius=15)
+
+        right_img = processing_img.copy()
+        visualizer.draw_corners(right_img, snapped_pts, color=(0, 0, 255), radius=15)
+
+        return np.hstack((left_img, right_img))
+
+    def _render_votes_frame(self, processing_img, visual_votes, final_dots):
+        step7_img = processing_img.copy()
+        visualizer.draw_stitch_votes(step7_img, visual_votes) # Start arrows at Raw
+        # Also draw Raw dots instead of snapped stitches
+        visualizer.draw_corners(step7_img, final_dots, color=(0, 0, 255), radius=20)
+        return step7_img
+
+    def _render_flow_frame(self, processing_img, spine_points, global_dir):
+        step8_img = processing_img.copy()
+        visualizer.draw_spine(step8_img, spine_points) # Added spine line for context
+        visualizer.draw_spine_arrows(step8_img, spine_points, global_dir)
+        return step8_img
+
+    def _add_frame(self, title, desc, render, stage=None):
+        # Frames only record how to draw themselves; see DebugFrameStore.
+        # stage is the trace record of the step that produced the frame.
+        if self.debug:
+            self.debug_frames.add(title, desc, render, stage=stage)
+
     def reset_state(self):
+        self.load_scale = 1.0
+        self.image_digest = None
         self.original_cv_image = None
         self.blurred_cv_image = None
         self.masked_processing_image = None
         self.current_mask = None
+        self.full_mask = None
+        self.isolation_seed = None
         self.yarn_width = None
-        self.debug_frames = []
+        self.spine_points = None
+        self.stitch_points = None
+        self.image_context = None
+        self.analysis_context = None
+        self.analysis_pipeline = None
+        self.preview_layers = None
+        self.debug_frames.clear()
 
     def has_image(self):
         return self.original_cv_image is not None
@@ -0,0 +1,178 @@
+import os
+import json
+import hashlib
+import tempfile
+import zipfile
+from functools import lru_cache
+
+import numpy as np
+
+import preprocessing.filters as filters
+import postprocessing.stitch_detection as stitch_detection
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Packages whose code decides the results; editing any of their sources invalidates every entry
+CODE_PACKAGES = ("preprocessing", "postprocessing")
+# Modules outside those packages that also shape what is stored, including the batch records
+CODE_FILES = (
+    os.path.join("gui", "logic", "processor.py"),
+    os.path.join("gui", "logic", "tiled_processor.py"),
+    os.path.join("gui", "logic", "result_cache.py"),
+    os.path.join("crochet", "batch.py")
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def default_dir():
+    # CROCHET_CACHE_DIR, else the platform cache directory
+    if os.environ.get("CROCHET_CACHE_DIR"):
+        return os.environ["CROCHET_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "crochet-analyzer")
+
+@lru_cache(maxsize=None)
+def code_version():
+    # Digest of the analysis sources, so results computed by older code are never returned
+    digest = hashlib.sha256()
+    paths = [os.path.join(ROOT, path) for path in CODE_FILES]
+    for package in CODE_PACKAGES:
+        folder = os.path.join(ROOT, package)
+        paths += [os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".py")]
+    for path in sorted(paths):
+        digest.update(os.path.relpath(path, ROOT).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def file_digest(source):
+    # source is a path or a seekable binary file, which is left rewound
+    if hasattr(source, "read"):
+        source.seek(0)
+        digest = _read_digest(source)
+        source.seek(0)
+        return digest
+    with open(source, "rb") as f:
+        return _read_digest(f)
+
+def _read_digest(f):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def array_digest(array):
+    digest = hashlib.sha256(str((array.shape, str(array.dtype))).encode())
+    digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+def analysis_params(**extra):
+    # Settings that change results without changing code; callers add their own (pyramid, max_side, ...)
+    params = {
+        "max_corners": stitch_detection.MAX_CORNERS,
+        "quality_level": stitch_detection.QUALITY_LEVEL,
+        "bilateral": [filters.BILATERAL_D, filters.BILATERAL_SIGMA_COLOR, filters.BILATERAL_SIGMA_SPACE]
+    }
+    params.update(extra)
+    return params
+
+def make_key(kind, image_digest, seed, params):
+    text = json.dumps([kind, image_digest, seed, params, code_version()], sort_keys=True, default=_plain)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _plain(value):
+    # numpy scalars and arrays in keys and metadata
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def pack_mask(mask):
+    return np.packbits(mask.ravel() > 0)
+
+def unpack_mask(bits, shape):
+    count = int(np.prod(shape))
+    return (np.unpackbits(bits, count=count).reshape(shape) * 255).astype(np.uint8)
+
+def pack_points(points):
+    return np.asarray(points, dtype=np.int32).reshape(-1, 2)
+
+def unpack_points(array):
+    return [tuple(p) for p in array.tolist()]
+
+class ResultCache:
+    # Persistent store of analysis results keyed by make_key: one compressed .npz per entry holding
+    # arrays plus JSON metadata. Reading an entry marks it used; writing evicts the least recently
+    # used entries once the directory exceeds max_bytes. Writes are atomic, so processes can share it.
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        # (meta, arrays) or None
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # Truncated or foreign file; forget it
+            self._remove(path)
+            return None
+
+        meta = json.loads(arrays.pop("meta").tobytes().decode())
+        return meta, arrays
+
+    def put(self, key, meta=None, **arrays):
+        meta = np.frombuffer(json.dumps(meta, default=_plain).encode(), dtype=np.uint8)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, meta=meta, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".npz"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    @property
+    def size_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for _, _, path in self._entries():
+            self._remove(path)
@@ -0,0 +1,531 @@
+import os
+import tempfile
+
+import cv2
+import numpy as np
+from PIL import ExifTags, Image, ImageOps
+
+import preprocessing.hue_isolator as hue_isolator
+import preprocessing.filters as filters
+import preprocessing.image_context as image_context
+import postprocessing.yarn_framing as yarn_framing
+import postprocessing.stitch_detection as stitch_detection
+import postprocessing.direction_detection as direction_detection
+import postprocessing.pyramid as pyramid
+import postprocessing.tiling as tiling
+import gui.logic.instrumentation as instrumentation
+from gui.logic.processor import pil_to_bgr
+
+# Working memory per pixel of the yarn window loaded for stitch and direction analysis
+# (masked image, grey and float planes, distance map, snap image, orientation field)
+WINDOW_BYTES_PER_PIXEL = 64
+# Working memory per pixel of a padded tile of the corner response when the window does not fit (image,
+# mask and masked copy, distance and weight planes, cornerMinEigenVal's gradients and box sums, dilation)
+CORNER_BYTES_PER_PIXEL = 80
+# Corner response reach beyond the distances: cornerMinEigenVal's gradient (1) and block (4), the dilation
+# that finds local maxima (1), and slack for the distances' own trust margin
+CORNER_MARGIN = 8
+# First overlap of the mask windows width rays are cast in; rays that reach a window's edge are cast again further out
+WIDTH_PAD = 64
+# Rows converted into the disk copy at a time while loading
+DECODE_BAND_ROWS = 256
+# Memory per pixel of a band on its way to disk: PIL's copy (4 bytes for RGB), its exported array, the BGR result
+DECODE_BAND_BYTES_PER_PIXEL = 11
+# Modes read a band at a time; pil_to_bgr handles these directly
+BAND_MODES = ("RGB", "RGBA", "L")
+# Scans this size are what tiling is for; PIL's decompression bomb guard stops at about 179 megapixels
+MAX_IMAGE_PIXELS = 2 ** 31
+
+def raw_tiles(pil_img):
+    # PIL's tile list as (extents, offset, rawmode, stride, ystep) when every tile is stored uncompressed
+    # (uncompressed TIFF, BMP, PPM...), so any band of rows can be read straight from the file; None otherwise
+    if pil_img.mode not in BAND_MODES or not pil_img.tile:
+        return None
+    tiles = []
+    for decoder_name, extents, offset, args in pil_img.tile:
+        if decoder_name != "raw":
+            return None
+        args = (args,) if isinstance(args, str) else tuple(args)
+        rawmode = args[0]
+        stride = args[1] if len(args) > 1 else 0
+        ystep = args[2] if len(args) > 2 else 1
+        if not stride:
+            # Rows are packed; the packer for rawmode gives their length, and rawmodes without one are decoded whole
+            try:
+                stride = len(Image.new(pil_img.mode, (extents[2] - extents[0], 1)).tobytes("raw", rawmode))
+            except ValueError:
+                return None
+        tiles.append((extents, offset, rawmode, stride, ystep))
+    return tiles
+
+def exif_orientation(pil_img):
+    # EXIF orientation from the file's header; getexif would decode a PNG whole to look for a late eXIf chunk
+    if pil_img.format == "PNG":
+        exif = Image.Exif()
+        if "exif" in pil_img.info:
+            exif.load(pil_img.info["exif"])
+    else:
+        exif = pil_img.getexif()
+    return exif.get(ExifTags.Base.Orientation, 1)
+
+def read_raw_band(fp, mode, tiles, width, top, bottom):
+    # Rows top to bottom of an image stored as raw_tiles, reading only the bytes of those rows
+    band = Image.new(mode, (width, bottom - top))
+    for (x1, y1, x2, y2), offset, rawmode, stride, ystep in tiles:
+        r1, r2 = max(top, y1) - y1, min(bottom, y2) - y1
+        if r1 >= r2:
+            continue
+        # Bottom-up files (ystep -1) store the tile's last row first
+        fp.seek(offset + (r1 if ystep > 0 else y2 - y1 - r2) * stride)
+        data = fp.read((r2 - r1) * stride)
+        if len(data) < (r2 - r1) * stride:
+            raise OSError("image file is truncated")
+        piece = Image.frombytes(mode, (x2 - x1, r2 - r1), data, "raw", rawmode, stride, ystep)
+        band.paste(piece, (x1, y1 + r1 - top))
+    return band
+
+class TiledProcessor:
+    # Headless ImageProcessor for scans too large to hold in memory. Every full size plane is a file in a
+    # scratch directory, processed tile by tile, so working memory stays near budget_bytes whatever the
+    # image size. Uncompressed files are read a band at a time; compressed ones (JPEG, PNG, compressed TIFF)
+    # only decode whole, so their decode is counted against the budget and refused if it does not fit. Isolation and the spine match ImageProcessor pixel for pixel. Stitches and direction run on
+    # a window around the yarn when it fits the budget, and otherwise at full resolution along the spine: corner
+    # candidates tile by tile, snapping and votes in patches around each stitch, which gives ImageProcessor's
+    # answer too. Analyzing the window downscaled instead is faster but can change the count and even the
+    # direction, so it is only done up to max_level, and the report gives the level it used.
+    def __init__(self, budget_bytes=tiling.DEFAULT_BUDGET_BYTES, scratch_dir=None, max_level=0):
+        self.budget_bytes = budget_bytes
+        # Parent of the scratch directory; this should be a local disk rather than a RAM-backed /tmp
+        self.scratch_dir = scratch_dir
+        # Most the window may be downscaled (by 2**max_level) rather than analyzed tile by tile; 0 never downscales
+        self.max_level = max_level or 0
+        self.scratch = None
+        self.trace = instrumentation.Trace()
+        self.reset_state()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.reset_state()
+
+    def reset_state(self):
+        if self.scratch is not None:
+            self.scratch.cleanup()
+        self.scratch = None
+        self.original_cv_image = None
+        self.blurred_cv_image = None
+        self.current_mask = None
+        self.mask_box = None
+        self.level = 0
+        self.isolation_seed = None
+        self.yarn_width = None
+        self.spine_points = None
+        self.stitch_points = None
+
+    def has_image(self):
+        return self.original_cv_image is not None
+
+    def _array(self, name, shape, dtype=np.uint8):
+        return tiling.DiskArray(os.path.join(self.scratch.name, name), shape, dtype)
+
+    @instrumentation.traced("load_image", new_trace=True)
+    def load_image(self, file_path):
+        self.reset_state()
+        self.scratch = tempfile.TemporaryDirectory(prefix="crochet-tiles-", dir=self.scratch_dir)
+
+        with self.trace.stage("decode"):
+            limit = Image.MAX_IMAGE_PIXELS
+            Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS if limit is None else max(limit, MAX_IMAGE_PIXELS)
+            try:
+                pil_img = Image.open(file_path)
+            finally:
+                Image.MAX_IMAGE_PIXELS = limit
+            with pil_img:
+                transposed = exif_orientation(pil_img) not in (0, 1)
+                tiles = None if transposed else raw_tiles(pil_img)
+                if tiles is not None:
+                    # Uncompressed: each band is read from the file on its own, so the whole image never exists
+                    w, h = pil_img.size
+                    self.original_cv_image = self._array("original.bgr", (h, w, 3))
+                    with open(file_path, "rb") as fp:
+                        for top in range(0, h, DECODE_BAND_ROWS):
+                            bottom = min(h, top + DECODE_BAND_ROWS)
+                            band = pil_to_bgr(read_raw_band(fp, pil_img.mode, tiles, w, top, bottom))
+                            self.original_cv_image.write((0, top, w, bottom), band)
+                else:
+                    self._decode_whole(pil_img, transposed)
+            h, w = self.original_cv_image.shape[:2]
+
+        with self.trace.stage("bilateral_filter"):
+            self.blurred_cv_image = self._array("blurred.bgr", (h, w, 3))
+            tiling.filter_image(self.original_cv_image, self.blurred_cv_image, filters.apply_bilateral_filter,
+                                self.budget_bytes, pyramid.FILTER_PAD)
+
+    def _decode_whole(self, pil_img, transposed):
+        # Compressed formats (JPEG, PNG, compressed TIFF) only decode whole, so the full image is held once on
+        # its way to disk; that counts against the budget, with a second copy while EXIF rotation transposes it
+        w, h = pil_img.size
+        pixel_bytes = 1 if pil_img.mode in ("1", "L", "P") else 2 if pil_img.mode.startswith("I;16") else 4
+        needed = w * h * pixel_bytes * (2 if transposed else 1) + w * DECODE_BAND_ROWS * DECODE_BAND_BYTES_PER_PIXEL
+        if needed > self.budget_bytes:
+            raise tiling.BudgetError(
+                f"{os.path.basename(pil_img.filename)} is compressed and decodes whole, which needs "
+                f"{needed / 2**20:.0f} MB, more than a {self.budget_bytes / 2**20:.0f} MB budget allows; raise the "
+                f"memory budget to at least {int(np.ceil(needed / 2**20))} MB, or save the scan as an uncompressed "
+                f"TIFF, which is read a band at a time"
+            )
+        pil_img.load()
+        # In place: without it exif_transpose returns a second full size copy to keep
+        ImageOps.exif_transpose(pil_img, in_place=True)
+        w, h = pil_img.size
+        self.original_cv_image = self._array("original.bgr", (h, w, 3))
+        for top in range(0, h, DECODE_BAND_ROWS):
+            bottom = min(h, top + DECODE_BAND_ROWS)
+            band = pil_to_bgr(pil_img.crop((0, top, w, bottom)))
+            self.original_cv_image.write((0, top, w, bottom), band)
+
+    @instrumentation.traced("process_click_at")
+    def process_click_at(self, x, y, color_name=None, render=False):
+        # Returns the mask (a DiskArray); nothing is drawn, render is accepted for ImageProcessor parity
+        if self.blurred_cv_image is None:
+            return None
+
+        if color_name is None:
+            with self.trace.stage("dominant_color"):
+                box = tiling.grow((x, y, x + 1, y + 1), 8, self.blurred_cv_image.shape)
+                color_name = hue_isolator.get_dominant_color_name(
+                    self.blurred_cv_image.read(box), x - box[0], y - box[1]
+                )
+
+        if not color_name:
+            return None
+
+        with self.trace.stage("isolation_mask", color=color_name):
+            self.isolation_seed = (color_name, (x, y))
+            shape = self.blurred_cv_image.shape[:2]
+            clean = self._array("clean.mask", shape)
+            component = self._array("component.mask", shape)
+            filled = self._array("filled.mask", shape)
+            self.current_mask = self._array("mask", shape)
+            self.mask_box = None
+
+            if hue_isolator.get_color_ranges(color_name):
+                tiling.clean_color_mask(self.blurred_cv_image, clean, color_name, self.budget_bytes)
+                box = tiling.keep_components(clean, component, self.budget_bytes, point=(x, y))
+                if box is not None:
+                    tiling.fill_holes(component, filled, self.budget_bytes)
+                    self.mask_box = tiling.smooth_mask(filled, self.current_mask, self.budget_bytes, roi=box)
+
+        return self.current_mask
+
+    @instrumentation.traced("process_color")
+    def process_color(self, color_name, render=False):
+        # Largest blob of the colour, in ImageProcessor's order: finish every blob, then keep the largest
+        if self.blurred_cv_image is None:
+            return None
+
+        with self.trace.stage("isolation_mask", color=color_name):
+            self.isolation_seed = (color_name, None)
+            shape = self.blurred_cv_image.shape[:2]
+            clean = self._array("clean.mask", shape)
+            filled = self._array("filled.mask", shape)
+            smoothed = self._array("smoothed.mask", shape)
+            self.current_mask = self._array("mask", shape)
+            self.mask_box = None
+
+            if hue_isolator.get_color_ranges(color_name):
+                tiling.clean_color_mask(self.blurred_cv_image, clean, color_name, self.budget_bytes)
+                tiling.fill_holes(clean, filled, self.budget_bytes)
+                tiling.smooth_mask(filled, smoothed, self.budget_bytes)
+                self.mask_box = tiling.keep_components(smoothed, self.current_mask, self.budget_bytes)
+
+        return self.current_mask
+
+    @instrumentation.traced("run_full_analysis")
+    def run_full_analysis(self, render=False):
+        # Returns (None, report) like ImageProcessor.run_full_analysis(render=False)
+        if self.mask_box is None:
+            return None, None
+
+        with self.trace.stage("find_spine"):
+            # Same input as yarn_framing.find_spine: the non-black pixels of the masked image
+            def foreground(blurred, mask):
+                gray = cv2.cvtColor(hue_isolator.apply_mask_to_image(blurred, mask), cv2.COLOR_BGR2GRAY)
+                return cv2.threshold(gray, 1, 255, cv2.THRESH_BINARY)[1]
+
+            binary = self._array("foreground.mask", self.current_mask.shape)
+            tiling.map_tiles(foreground, [self.blurred_cv_image, self.current_mask], binary,
+                             self.budget_bytes, roi=self.mask_box)
+            pad = tiling.skeleton_pad(binary, self.budget_bytes, self.mask_box)
+            xs, ys = tiling.skeleton_points(binary, self.budget_bytes, self.mask_box, pad)
+            spine_points = yarn_framing.trace_point_path(xs, ys)
+
+        self.spine_points = spine_points
+        self.stitch_points = []
+        if not spine_points:
+            return None, None
+
+        # The skeleton pad is at least the yarn width, so the window takes in everything the
+        # stitch and direction stages look at around the yarn
+        window, level, full_resolution_budget = self._analysis_window(pad + pyramid.FILTER_PAD)
+        if level == 0:
+            report_data = self._analyze_window(spine_points, window, 0)
+        elif level <= self.max_level:
+            report_data = self._analyze_window(spine_points, window, level)
+        else:
+            level = 0
+            report_data = self._analyze_tiles(spine_points)
+        self.level = level
+
+        if report_data is not None:
+            report_data.update({
+                # Stitches and direction were found on the window downscaled by 2**level
+                "level": level,
+                "full_resolution_budget": full_resolution_budget
+            })
+        return None, report_data
+
+    def _analyze_window(self, spine_points, window, level):
+        # Stitches and direction on the yarn window loaded whole, downscaled by 2**level
+        s = 2 ** level
+        x1, y1 = window[:2]
+
+        with self.trace.stage("load_window", level=level):
+            if level == 0:
+                blurred = self.blurred_cv_image.read(window)
+                mask = self.current_mask.read(window)
+                spine = spine_points.shifted((-x1, -y1))
+            else:
+                blurred = tiling.read_downscaled(self.blurred_cv_image, window, level, self.budget_bytes)
+                mask = tiling.read_downscaled(self.current_mask, window, level, self.budget_bytes)
+                _, mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
+                spine = self._downscale_path(spine_points, (x1, y1), s)
+
+            processing_img = hue_isolator.apply_mask_to_image(blurred, mask, darken_factor=0.0)
+            context = image_context.ImageContext(processing_img, mask)
+            del blurred
+
+        # At level 0 rays are cast from the full size spine, so they round as on the whole image
+        width_spine, width_offset = (spine_points, (x1, y1)) if level == 0 else (spine, (0, 0))
+        with self.trace.stage("measure_width"):
+            width_info = yarn_framing.measure_width_at_center(width_spine, mask, offset=width_offset)
+        if not width_info:
+            return None
+        half_width = width_info[2]
+        self.yarn_width = half_width * s
+
+        with self.trace.stage("width_profile"):
+            width_profile = yarn_framing.measure_width_profile(width_spine, mask, offset=width_offset)
+        width_summary = None
+        if width_profile is not None:
+            width_summary = yarn_framing.summarize_width_profile(width_profile[3] * 2 * s)
+
+        spine_index = spine.spatial_index
+        with self.trace.stage("detect_stitches"):
+            stitches = stitch_detection.detect_stitches(
+                processing_img, mask, spine, half_width, spine_index=spine_index, context=context
+            )
+        if not stitches:
+            return None
+
+        with self.trace.stage("determine_direction", stitches=len(stitches)):
+            _, _, mean_vec = direction_detection.determine_direction(
+                context.gray, spine, stitches, half_width, spine_index=spine_index
+            )
+
+        if level == 0:
+            self.stitch_points = pyramid.shift_points(stitches, (x1, y1))
+        else:
+            self.stitch_points = pyramid.shift_points(pyramid.to_full(stitches, level), (x1, y1))
+
+        return {
+            "count": len(stitches),
+            "direction": direction_detection.cardinal_direction(mean_vec),
+            "width": self.yarn_width * 2,
+            "width_profile": width_summary
+        }
+
+    def _analyze_tiles(self, spine_points):
+        # Stitches and direction at full resolution when the yarn window does not fit the budget: widths from
+        # rays cast in windows along the spine, corner candidates tile by tile, the sweep on the candidates
+        # alone, then snapping and brightness votes in small patches around each stitch
+        with self.trace.stage("width_profile"):
+            half_widths = self._width_profile(spine_points)
+        half_width = float(half_widths[len(spine_points) // 2])
+        if np.isnan(half_width):
+            return None
+        self.yarn_width = half_width
+        width_summary = yarn_framing.summarize_width_profile(half_widths * 2)
+
+        with self.trace.stage("corner_candidates"):
+            candidates = self._corner_candidates()
+
+        spine_index = spine_points.spatial_index
+        with self.trace.stage("detect_stitches"):
+            selections = {
+                test_dist: stitch_detection.select_corners(
+                    candidates, test_dist, stitch_detection.MAX_CORNERS, stitch_detection.QUALITY_LEVEL
+                )
+                for test_dist in stitch_detection.sweep_distances(half_width)
+            }
+            corners, _ = stitch_detection.choose_corners(selections, spine_index, half_width)
+            stitches = [self._snap(corner, half_width) for corner in corners]
+        if not stitches:
+            return None
+
+        with self.trace.stage("determine_direction", stitches=len(stitches)):
+            mean_vec = self._brightness_vector(spine_points, stitches, half_width)
+
+        self.stitch_points = stitches
+        return {
+            "count": len(stitches),
+            "direction": direction_detection.cardinal_direction(mean_vec),
+            "width": self.yarn_width * 2,
+            "width_profile": width_summary
+        }
+
+    def _masked_gray(self, box):
+        # Grey of the masked image (what the in-memory pipeline analyzes) over box
+        processing = hue_isolator.apply_mask_to_image(self.blurred_cv_image.read(box), self.current_mask.read(box),
+                                                      darken_factor=0.0)
+        return image_context.ImageContext(processing).gray
+
+    def _width_profile(self, path):
+        # Half widths of yarn_framing.measure_width_profile at every spine point, on mask windows around the spine
+        # points of each tile. A ray that leaves its window may go on beyond it, so it is cast again in a window
+        # grown twice as far, until it meets the background inside the window (or leaves the image)
+        shape = self.current_mask.shape
+        h, w = shape[:2]
+        points = path.points.astype(np.int64)
+        tile = tiling.tile_size(self.budget_bytes, WIDTH_PAD)
+        keys = (points[:, 1] // tile) * (w // tile + 1) + points[:, 0] // tile
+        half_widths = np.full(len(points), np.nan)
+
+        for key in np.unique(keys):
+            indices = np.flatnonzero(keys == key)
+            x, y = points[indices[0]] // tile * tile
+            box = (x, y, min(w, x + tile), min(h, y + tile))
+            reach = WIDTH_PAD
+            while len(indices):
+                x1, y1, x2, y2 = tiling.grow(box, reach, shape)
+                mask = self.current_mask.read((x1, y1, x2, y2))
+                _, p1, p2, found = yarn_framing.measure_width_profile(path, mask, indices=indices, offset=(x1, y1))
+
+                ends = np.concatenate([p1, p2])
+                escaped = (((ends[:, 0] < x1) & (x1 > 0)) | ((ends[:, 0] >= x2) & (x2 < w)) |
+                           ((ends[:, 1] < y1) & (y1 > 0)) | ((ends[:, 1] >= y2) & (y2 < h)))
+                escaped = escaped[:len(indices)] | escaped[len(indices):]
+                half_widths[indices[~escaped]] = found[~escaped]
+                indices = indices[escaped]
+                reach *= 2
+
+        return half_widths
+
+    def _corner_candidates(self):
+        # stitch_detection.get_corner_candidates on the whole masked image, tile by tile. The distances are scaled
+        # by the whole mask's largest, found first, and tiles overlap by that distance and the corner response's
+        # reach, so every tile sees what the whole image would (cornerMinEigenVal's box sums differ only in the
+        # last bits). Candidates too weak for the quality level against the strongest so far are dropped at once.
+        shape = self.current_mask.shape
+        h, w = shape[:2]
+        widest = tiling.max_pad(self.budget_bytes, CORNER_BYTES_PER_PIXEL) - CORNER_MARGIN
+        largest = tiling.largest_distance(self.current_mask, self.budget_bytes, self.mask_box, widest)
+        pad = int(np.ceil(largest)) + CORNER_MARGIN
+        if largest > widest:
+            raise tiling.pad_error(pad, self.budget_bytes, 2 * int(np.ceil(largest)), "for the corner response",
+                                   CORNER_BYTES_PER_PIXEL)
+
+        max_value = 0.0
+        xs, ys, values = [], [], []
+        roi = tiling.grow(self.mask_box, CORNER_MARGIN, shape)
+        for box in tiling.iter_tiles(shape, tiling.tile_size(self.budget_bytes, pad, CORNER_BYTES_PER_PIXEL), roi):
+            outer = tiling.grow(box, pad, shape)
+            mask = self.current_mask.read(outer)
+            if not mask.any():
+                continue
+            processing = hue_isolator.apply_mask_to_image(self.blurred_cv_image.read(outer), mask, darken_factor=0.0)
+            _, weighted = stitch_detection.get_weighted_image(image_context.ImageContext(processing, mask), largest)
+            del processing, mask
+            eig = cv2.cornerMinEigenVal(weighted, stitch_detection.CORNER_BLOCK_SIZE, 3)
+            peaks = tiling.core_of((eig > 0) & (eig == cv2.dilate(eig, None)), box, outer)
+            eig = tiling.core_of(eig, box, outer)
+            max_value = max(max_value, float(eig.max()))
+
+            tile_ys, tile_xs = np.nonzero(peaks)
+            tile_values = eig[tile_ys, tile_xs]
+            tile_xs = tile_xs + box[0]
+            tile_ys = tile_ys + box[1]
+            # Like the whole image, nothing on its outermost pixels
+            keep = ((tile_values >= np.float32(max_value * stitch_detection.QUALITY_LEVEL)) &
+                    (tile_xs > 0) & (tile_ys > 0) & (tile_xs < w - 1) & (tile_ys < h - 1))
+            xs.append(tile_xs[keep])
+            ys.append(tile_ys[keep])
+            values.append(tile_values[keep])
+
+        xs = np.concatenate(xs) if xs else np.zeros(0, np.int64)
+        ys = np.concatenate(ys) if ys else np.zeros(0, np.int64)
+        values = np.concatenate(values) if values else np.zeros(0, np.float32)
+        # Strongest first; equal values later pixel first, as get_corner_candidates orders them
+        order = np.lexsort((-xs.astype(np.int64), -ys.astype(np.int64), -values))
+        return {
+            "weight_map": None,
+            "max_value": max_value,
+            "values": values[order],
+            "points": np.column_stack((xs[order], ys[order]))
+        }
+
+    def _snap(self, corner, half_width):
+        # stitch_detection.snap_corners on a patch around the corner, read with room for the bilateral filter
+        shape = self.current_mask.shape
+        cx, cy = int(corner[0]), int(corner[1])
+        box = tiling.grow((cx, cy, cx + 1, cy + 1), stitch_detection.snap_radius(half_width), shape)
+        outer = tiling.grow(box, pyramid.FILTER_PAD, shape)
+        snap_gray = tiling.core_of(image_context.ImageContext(self._masked_gray(outer)).snap_gray, box, outer)
+        (x, y), = stitch_detection.snap_corners(snap_gray, [(cx - box[0], cy - box[1])], half_width)
+        return x + box[0], y + box[1]
+
+    def _brightness_vector(self, path, stitches, half_width):
+        # The mean vector of direction_detection.determine_direction, from each stitch's brightness vote
+        # on a patch around it
+        shape = self.current_mask.shape
+        radius = direction_detection.vote_radius(half_width)
+        nearest = path.spatial_index.project(stitches)
+        tangents = path.forward_tangents(1)[nearest].tolist()
+
+        voting, votes = [], []
+        for (sx, sy), (tx, ty) in zip(stitches, tangents):
+            if tx == 0 and ty == 0:
+                continue
+            box = tiling.grow((sx, sy, sx + 1, sy + 1), radius, shape)
+            vote = direction_detection.get_brightness_votes(
+                self._masked_gray(box), [(sx - box[0], sy - box[1])], radius, [(tx, ty)]
+            )
+            voting.append((tx, ty))
+            votes.append(int(vote[0]))
+        return direction_detection.mean_brightness_vector(voting, votes)
+
+    def _analysis_window(self, margin):
+        # Mask bounding box grown by margin, the pyramid level at which it fits the budget, and the
+        # budget it would need at level 0. Above level 0 the window is trimmed to whole 2**level blocks.
+        x1, y1, x2, y2 = tiling.grow(self.mask_box, margin, self.current_mask.shape)
+        full_bytes = (x2 - x1) * (y2 - y1) * WINDOW_BYTES_PER_PIXEL
+        level = 0
+        while full_bytes >> (2 * level) > self.budget_bytes:
+            level += 1
+
+        if level > 0:
+            s = 2 ** level
+            x2 = x1 + (x2 - x1) // s * s
+            y2 = y1 + (y2 - y1) // s * s
+        return (x1, y1, x2, y2), level, full_bytes
+
+    def _downscale_path(self, points, offset, s):
+        # Full resolution path to window pixels at 1/s scale; consecutive repeats are merged
+        pts = (np.asarray(points, dtype=np.int64) - np.asarray(offset, dtype=np.int64)) // s
+        keep = np.ones(len(pts), dtype=bool)
+        keep[1:] = np.any(pts[1:] != pts[:-1], axis=1)
+        return yarn_framing.SpinePath(pts[keep])
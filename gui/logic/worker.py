@@ -0,0 +1,110 @@
+import queue
+import threading
+
+import gui.logic.instrumentation as instrumentation
+
+# How often the Tk thread collects results and progress from the worker
+POLL_MS = 50
+
+class Job:
+    def __init__(self, generation, call, on_done, on_error, on_cancel, on_progress):
+        self.generation = generation
+        self.call = call
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self.on_progress = on_progress
+        self.cancel_event = threading.Event()
+
+class AnalysisWorker:
+    # Runs processor calls one at a time on a background thread so the Tk loop stays responsive.
+    # Each submit supersedes earlier jobs: the running one is cancelled at its next pipeline stage
+    # (through the processor's trace observer), queued ones never start, and any result they still
+    # deliver is dropped. Callbacks always run on the Tk thread, from root.after.
+    def __init__(self, root, processor):
+        self.root = root
+        self.processor = processor
+        self.generation = 0
+        self.current = None
+        self._jobs = queue.Queue()
+        self._events = queue.Queue()
+        self._lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run, name="analysis-worker", daemon=True)
+        self.thread.start()
+        self.root.after(POLL_MS, self._poll)
+
+    @property
+    def busy(self):
+        return self.current is not None
+
+    def submit(self, call, on_done=None, on_error=None, on_cancel=None, on_progress=None):
+        # call() runs on the worker thread; on_done gets its return value, on_progress(record, finished)
+        # each stage of the processor's trace, on_error the exception
+        with self._lock:
+            if self.current is not None:
+                self.current.cancel_event.set()
+            self.generation += 1
+            job = Job(self.generation, call, on_done, on_error, on_cancel, on_progress)
+            self.current = job
+        self._jobs.put(job)
+        return job
+
+    def cancel(self):
+        # Cooperative: the job stops where its next stage would start, then on_cancel runs
+        with self._lock:
+            if self.current is not None:
+                self.current.cancel_event.set()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job.cancel_event.is_set():
+                self._events.put((job, "cancelled", None))
+                continue
+
+            def observer(record, finished, job=job):
+                if not finished and job.cancel_event.is_set():
+                    raise instrumentation.Cancelled(record.name)
+                self._events.put((job, "progress", (record, finished)))
+
+            self.processor.trace.observer = observer
+            try:
+                result = job.call()
+                self._events.put((job, "done", result))
+            except instrumentation.Cancelled:
+                self._events.put((job, "cancelled", None))
+            except Exception as e:
+                self._events.put((job, "error", e))
+            finally:
+                self.processor.trace.observer = None
+
+    def _poll(self):
+        try:
+            while True:
+                job, kind, payload = self._events.get_nowait()
+                self._deliver(job, kind, payload)
+        except queue.Empty:
+            pass
+        self.root.after(POLL_MS, self._poll)
+
+    def _deliver(self, job, kind, payload):
+        # Results of superseded jobs are stale
+        if job.generation != self.generation:
+            return
+
+        if kind == "progress":
+            if job.on_progress:
+                job.on_progress(*payload)
+            return
+
+        with self._lock:
+            self.current = None
+        if kind == "done":
+            if job.on_done:
+                job.on_done(payload)
+        elif kind == "cancelled":
+            if job.on_cancel:
+                job.on_cancel()
+        elif job.on_error:
+            job.on_error(payload)
@@ -40,7 +40,7 @@ class ImageViewer:
         self.scaled_size = (new_width, new_height)
         
         if new_width > 0 and new_height > 0:
-            resized_img = pil_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            resized_img = pil_img.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=2.0)
         else:
             resized_img = pil_img
             
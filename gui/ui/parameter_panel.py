@@ -0,0 +1,66 @@
+from gui.ui.theme import Colors, Fonts
+import tkinter as tk
+
+# Quiet time (ms) after the last slider movement before the change is reported
+DEBOUNCE_MS = 200
+
+# (setting, label, from, to, resolution); settings are those of ImageProcessor.run_full_analysis
+SLIDERS = (
+    ("max_corners", "MAX CORNERS", 10, 300, 5),
+    ("quality_level", "CORNER QUALITY", 0.01, 0.30, 0.01),
+    ("darken_factor", "BACKGROUND", 0.0, 1.0, 0.05),
+)
+
+class ParameterPanel(tk.Frame):
+    # Sliders over the analysis settings. on_change(settings) gets every setting once the sliders
+    # have been still for DEBOUNCE_MS, so dragging re-runs the analysis once rather than per step.
+    def __init__(self, parent, on_change=None, **kwargs):
+        super().__init__(parent, bg=Colors.PANEL_BG, **kwargs)
+        self.on_change = on_change
+        self._pending = None
+        # Settings of the shown analysis; moving a slider away and back reports nothing
+        self.applied = {}
+        self.variables = {}
+
+        for col_index, (name, title, low, high, resolution) in enumerate(SLIDERS):
+            self.columnconfigure(col_index, weight=1)
+            self.variables[name] = self._create_slider(title, low, high, resolution, col_index)
+
+    def _create_slider(self, title, low, high, resolution, col_index):
+        variable = tk.DoubleVar(self)
+
+        frame = tk.Frame(self, bg=Colors.PANEL_BG)
+        frame.grid(row=0, column=col_index, sticky="nsew", padx=10)
+
+        tk.Label(frame, text=title, bg=Colors.PANEL_BG, fg=Colors.TEXT_DIM,
+                 font=("Helvetica Neue", 10, "bold")).pack(side=tk.TOP)
+
+        tk.Scale(frame, variable=variable, from_=low, to=high, resolution=resolution, orient=tk.HORIZONTAL,
+                 bg=Colors.PANEL_BG, fg=Colors.TEXT_MAIN, troughcolor=Colors.CANVAS_BG,
+                 activebackground=Colors.ACCENT, highlightthickness=0, bd=0, font=Fonts.STATUS,
+                 command=lambda _: self._changed()).pack(side=tk.TOP, fill=tk.X)
+
+        return variable
+
+    def get_settings(self):
+        return {name: variable.get() for name, variable in self.variables.items()}
+
+    def set_settings(self, settings):
+        # Moves the sliders without reporting a change
+        for name, value in settings.items():
+            if name in self.variables:
+                self.variables[name].set(value)
+        self.applied = self.get_settings()
+
+    def _changed(self):
+        if self._pending is not None:
+            self.after_cancel(self._pending)
+        self._pending = self.after(DEBOUNCE_MS, self._report)
+
+    def _report(self):
+        self._pending = None
+        settings = self.get_settings()
+        if settings != self.applied:
+            self.applied = settings
+            if self.on_change:
+                self.on_change(settings)
@@ -1,8 +1,9 @@
 from gui.ui.theme import Colors, Fonts
 import tkinter as tk
 from tkinter import ttk
-from PIL import Image, ImageTk
+from PIL import ImageTk
 
+import gui.logic.display_cache as display_cache
 from gui.ui.components import ModernButton
 
 class PipelineViewer(tk.Toplevel):
@@ -13,14 +14,18 @@ class PipelineViewer(tk.Toplevel):
         self.configure(bg=Colors.BACKGROUND)
         
         self.debug_frames = debug_frames 
+        # Scaled images per step and window size, with the neighbouring steps prepared in the background
+        self.display = display_cache.DisplayCache(debug_frames)
         self.current_step = 0
         self.tk_img = None
+        self.shown_viewport = None
         
         self._setup_ui()
         
         self.after(100, lambda: self._show_step(0))
         
         self.content_frame.bind("<Configure>", self._on_resize)
+        self.bind("<Destroy>", self._on_destroy)
         
     def _setup_ui(self):
         self.header_frame = tk.Frame(self, bg=Colors.PANEL_BG, height=60)
@@ -56,9 +61,17 @@ class PipelineViewer(tk.Toplevel):
         self.lbl_counter.pack(side=tk.TOP, pady=30)
         
     def _on_resize(self, event):
+        # A quick preview follows the drag; the high quality image waits until the size settles
+        if (event.width, event.height) == self.shown_viewport:
+            return
         self.after_cancel(getattr(self, '_resize_job', '')) if hasattr(self, '_resize_job') else None
+        self._show_image(preview=True)
         self._resize_job = self.after(100, lambda: self._show_step(self.current_step))
 
+    def _on_destroy(self, event):
+        if event.widget is self:
+            self.display.close()
+
     def _show_step(self, index):
         if not self.debug_frames:
             return
@@ -69,34 +82,41 @@ class PipelineViewer(tk.Toplevel):
         
         frame = self.debug_frames[index]
         
-        self.lbl_title.config(text=f"Step {index}: {frame['title']}")
+        title = f"Step {index}: {frame['title']}"
+        stage = frame['stage']
+        if stage is not None:
+            # Time spent in the pipeline stage that produced this step
+            title += f"  [{stage.name}: {stage.summary()}]"
+        self.lbl_title.config(text=title)
         self.lbl_desc.config(text=frame['desc'])
         self.lbl_counter.config(text=f"{index + 1} / {len(self.debug_frames)}")
         
         self.btn_prev.set_disabled(index <= 0)
         self.btn_next.set_disabled(index >= len(self.debug_frames) - 1)
         
-        # Display Image
-        pil_img = frame['image']
-        
-        win_w = self.content_frame.winfo_width()
-        win_h = self.content_frame.winfo_height()
+        self._show_image()
+
+    def _show_image(self, preview=False):
+        if not self.debug_frames:
+            return
+        viewport = (self.content_frame.winfo_width(), self.content_frame.winfo_height())
+        if viewport[0] <= 1 or viewport[1] <= 1:
+            return
         
-        if win_w > 1 and win_h > 1:
-            w, h = pil_img.size
-            ratio = min(win_w/w, win_h/h)
-            
-            if ratio > 1 and ratio < 2: ratio = 1
-                
-            new_w = int(w * ratio)
-            new_h = int(h * ratio)
-            
-            if new_w > 0 and new_h > 0:
-                resized = pil_img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-                self.tk_img = ImageTk.PhotoImage(resized)
-                self.image_label.config(image=self.tk_img)
+        if preview:
+            display_img = self.display.preview(self.current_step, viewport)
         else:
-            pass
+            display_img = self.display.get(self.current_step, viewport)
+            self.display.prefetch(self.current_step, viewport)
+            
+        if display_img is not None:
+            self.tk_img = ImageTk.PhotoImage(display_img)
+            self.image_label.config(image=self.tk_img, text="")
+            self.shown_viewport = viewport
+        elif self.debug_frames[self.current_step].discarded:
+            self.tk_img = None
+            self.image_label.config(image="", text="The analysis was re-run since this view opened. Open VIEW STEPS again.",
+                                    fg=Colors.TEXT_DIM, font=Fonts.MAIN)
 
     def next_step(self):
         self._show_step(self.current_step + 1)
@@ -38,19 +38,18 @@ def draw_stitch_votes(image, stitch_votes):
             
     return image
 
-def draw_spine_arrows(image, spine_points, global_dir, spacing=200):
+def draw_spine_arrows(image, spine_points, global_dir, spacing=200, reach=10):
     if not spine_points:
         return image
         
-    step = spacing 
+    # Point lists and SpinePath alike, as one int32 array
+    pts = np.asarray(spine_points, dtype=np.int32).reshape(-1, 2)
+    if global_dir != 1:
+        pts = pts[::-1]
     
-    points_to_draw = spine_points if global_dir == 1 else spine_points[::-1]
-    
-    for i in range(0, len(points_to_draw), step):
-        if i + 10 >= len(points_to_draw): break
-        
-        p1 = points_to_draw[i]
-        p2 = points_to_draw[i+10]
+    for i in range(0, len(pts) - reach, spacing):
+        p1 = tuple(pts[i].tolist())
+        p2 = tuple(pts[i + reach].tolist())
         
         cv2.arrowedLine(image, p1, p2, (0, 255, 0), 10, tipLength=4)
         
@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
 import math
+import postprocessing.yarn_framing as yarn_framing
 
 def get_structural_vector(image, cx, cy, radius):
     h, w = image.shape
@@ -54,6 +55,70 @@ def get_structural_vector(image, cx, cy, radius):
             
     return vx, vy
 
+class OrientationField:
+    # Structure tensor and intensity centroid, box-summed over (2*radius+1)^2 windows
+    # once, so the structural vector at any pixel inside bounds is an O(1) lookup
+    def __init__(self, image, radius, bounds=None):
+        h, w = image.shape
+        if bounds is None:
+            bounds = (0, 0, w, h)
+        bx1, by1, bx2, by2 = bounds
+        
+        # Windows near the bounds reach radius pixels further out, gradients one more
+        pad = radius + 1
+        self.x1, self.y1 = max(0, bx1 - pad), max(0, by1 - pad)
+        self.x2, self.y2 = min(w, bx2 + pad), min(h, by2 + pad)
+        self.radius = radius
+        
+        roi = image[self.y1:self.y2, self.x1:self.x2]
+        ksize = (2 * radius + 1, 2 * radius + 1)
+        
+        def window_sum(plane, ddepth=-1):
+            # Zero border: windows are clipped at the image edge like a cropped ROI
+            return cv2.boxFilter(plane, ddepth, ksize, normalize=False, borderType=cv2.BORDER_CONSTANT)
+            
+        gX = cv2.Sobel(roi, cv2.CV_32F, 1, 0, ksize=3)
+        gY = cv2.Sobel(roi, cv2.CV_32F, 0, 1, ksize=3)
+        
+        # Structure Tensor elements
+        self.jxx = window_sum(gX * gX)
+        self.jyy = window_sum(gY * gY)
+        self.jxy = window_sum(gX * gY)
+        
+        # Offset from each pixel to the intensity centroid of its window
+        intensity = roi.astype(np.float64)
+        cols = np.arange(roi.shape[1], dtype=np.float64)
+        rows = np.arange(roi.shape[0], dtype=np.float64)[:, None]
+        m00 = window_sum(intensity, cv2.CV_64F)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mass_dx = (window_sum(intensity * cols, cv2.CV_64F) / m00 - cols).astype(np.float32)
+            self.mass_dy = (window_sum(intensity * rows, cv2.CV_64F) / m00 - rows).astype(np.float32)
+            
+    def angle(self):
+        # Dense structure angle (radians), e.g. for visualization
+        return 0.5 * np.arctan2(2 * self.jxy, self.jxx - self.jyy) + (np.pi / 2)
+        
+    def structural_vectors(self, points):
+        # Unit structure vectors at (x, y) points, pointing away from the brighter mass
+        pts = np.asarray(points, dtype=np.intp).reshape(-1, 2)
+        xs = pts[:, 0] - self.x1
+        ys = pts[:, 1] - self.y1
+        
+        jxx = self.jxx[ys, xs].astype(np.float64)
+        jyy = self.jyy[ys, xs].astype(np.float64)
+        jxy = self.jxy[ys, xs].astype(np.float64)
+        
+        # Angle of Structure
+        struct_angle = 0.5 * np.arctan2(2 * jxy, jxx - jyy) + (np.pi / 2)
+        vx = np.cos(struct_angle)
+        vy = np.sin(struct_angle)
+        
+        # Resolve ambiguity using Intensity Centroid (empty windows have no centroid)
+        dot = vx * self.mass_dx[ys, xs] + vy * self.mass_dy[ys, xs]
+        flip = np.where(dot > 0, -1.0, 1.0)
+        
+        return np.column_stack([vx * flip, vy * flip])
+
 def get_brightness_vote(image, cx, cy, radius, tx, ty):
     h, w = image.shape
     x1 = max(0, cx - radius)
@@ -87,43 +152,125 @@ def get_brightness_vote(image, cx, cy, radius, tx, ty):
             
     return 0
 
-def determine_direction(image_gray, spine_points, stitches, yarn_width):
+def get_brightness_votes(image, centers, radius, tangents):
+    # Same votes as get_brightness_vote for many stitches. Each row of a disk splits
+    # into one forward and one backward run, so row prefix sums give both half-disk
+    # sums in O(radius) per stitch instead of O(radius^2).
+    centers = np.asarray(centers, dtype=np.int64).reshape(-1, 2)
+    tangents = np.asarray(tangents, dtype=np.float64).reshape(-1, 2)
+    if len(centers) == 0:
+        return np.zeros(0, dtype=int)
+        
+    h, w = image.shape
+    
+    # Prefix sums along x over the window the disks can reach
+    x1 = max(0, int(centers[:, 0].min()) - radius)
+    y1 = max(0, int(centers[:, 1].min()) - radius)
+    x2 = min(w, int(centers[:, 0].max()) + radius + 1)
+    y2 = min(h, int(centers[:, 1].max()) + radius + 1)
+    window = image[y1:y2, x1:x2]
+    wh, ww = window.shape
+    
+    cx = centers[:, 0:1] - x1
+    cy = centers[:, 1:2] - y1
+    tx = tangents[:, 0:1]
+    ty = tangents[:, 1:2]
+    
+    # Disk rows: |dx| <= half_chord, the integer form of dx*dx + dy*dy <= radius*radius
+    dy = np.arange(-radius, radius + 1, dtype=np.int64)
+    half_chord = np.array([math.isqrt(radius*radius - int(d)*int(d)) for d in dy], dtype=np.int64)
+    
+    ys = cy + dy
+    row_inside = (ys >= 0) & (ys < wh)
+    
+    # Prefix rows only for the rows some disk touches. A row of uint8 sums to under 2^31
+    # for any width below 8M, so int32 holds it at half the memory of int64.
+    rows = np.unique(ys[row_inside])
+    prefix = np.zeros((len(rows), ww + 1), dtype=np.int32)
+    np.cumsum(window[rows], axis=1, out=prefix[:, 1:])
+    ys = np.minimum(np.searchsorted(rows, ys), max(len(rows) - 1, 0))
+    lo = np.maximum(cx - half_chord, 0)
+    hi = np.minimum(cx + half_chord, ww - 1)
+    
+    # Forward means dx*tx + dy*ty > 0. Along a row that is monotone in dx, so find the
+    # first forward offset e of the mirrored row (e = -dx when tx < 0) exactly, by
+    # stepping up from an estimate with the very same floating point expression.
+    dot_y = dy * ty
+    slope = np.abs(tx)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        estimate = np.nan_to_num(-dot_y / slope, nan=0.0, posinf=radius + 1, neginf=-radius)
+    first = np.clip(np.floor(estimate).astype(np.int64) - 2, -radius, radius + 1)
+    for _ in range(6):
+        forward = first * slope + dot_y > 0
+        first = np.where((first <= radius) & ~forward, first + 1, first)
+    # Rows with tx == 0 are all forward or all backward
+    first = np.where(first * slope + dot_y > 0, first, radius + 1)
+        
+    mirrored = tx < 0
+    fwd_lo = np.where(mirrored, lo, np.maximum(cx + first, lo))
+    fwd_hi = np.where(mirrored, np.minimum(cx - first, hi), hi)
+    
+    def run_sums(run_lo, run_hi):
+        count = np.where(row_inside, np.maximum(run_hi - run_lo + 1, 0), 0)
+        nonempty = count > 0
+        run_lo = np.where(nonempty, run_lo, 0)
+        run_hi = np.where(nonempty, run_hi, -1)
+        total = prefix[ys, run_hi + 1] - prefix[ys, run_lo]
+        return count.sum(axis=1), np.where(nonempty, total, 0).sum(axis=1, dtype=np.int64)
+        
+    count_disk, sum_disk = run_sums(lo, hi)
+    count_fwd, sum_fwd = run_sums(fwd_lo, fwd_hi)
+    count_bwd = count_disk - count_fwd
+    sum_bwd = sum_disk - sum_fwd
+    
+    # Integer sums keep the means bit-identical to np.mean over the same pixels
+    valid = (count_fwd > 0) & (count_bwd > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        darker_fwd = sum_fwd / count_fwd < sum_bwd / count_bwd
+        
+    # Darker side wins
+    return np.where(valid, np.where(darker_fwd, 1, -1), 0)
+
+def vote_radius(yarn_width):
+    # Radius of the disk each stitch's votes look at
+    return max(3, int(yarn_width / 4))
+
+def determine_direction(image_gray, spine_points, stitches, yarn_width, spine_index=None, field=None):
     if not stitches or not spine_points:
         return 0, []
 
-    spine_arr = np.array(spine_points)
-    radius = int(yarn_width / 4)
-    if radius < 3: radius = 3
+    path = yarn_framing.as_spine_path(spine_points)
+    if spine_index is None:
+        spine_index = path.spatial_index
+    nearest = spine_index.project(stitches)
+    radius = vote_radius(yarn_width)
     
     total_votes = 0
     stitch_vote_data = [] 
     
     h, w = image_gray.shape
     
-    for sx, sy in stitches:
-        # Local Spine Tangent
-        dists = np.sum((spine_arr - np.array([sx, sy]))**2, axis=1)
-        idx = np.argmin(dists)
-        
-        if idx < len(spine_points) - 1:
-            tx = spine_points[idx+1][0] - spine_points[idx][0]
-            ty = spine_points[idx+1][1] - spine_points[idx][1]
-        elif idx > 0:
-            tx = spine_points[idx][0] - spine_points[idx-1][0]
-            ty = spine_points[idx][1] - spine_points[idx-1][1]
-        else:
-            tx, ty = 0, 0
-            
-        mag = np.sqrt(tx*tx + ty*ty)
-        if mag == 0: continue
-        tx, ty = tx/mag, ty/mag
-        
-        # Method 1: Darkest Half (Intensity Split)
-        vote1 = get_brightness_vote(image_gray, sx, sy, radius, tx, ty)
-                    
-        # Method 2: Structure Tensor
+    # Local Spine Tangent: towards the next spine point (the previous one at the end)
+    tangents = path.forward_tangents(1)[nearest].tolist()
+    voting = [
+        ((sx, sy), (tx, ty)) for (sx, sy), (tx, ty) in zip(stitches, tangents) if tx != 0 or ty != 0
+    ]
+        
+    # Method 1: Darkest Half (Intensity Split), for all stitches in one batch
+    voting_points = [pt for pt, _ in voting]
+    brightness_votes = get_brightness_votes(
+        image_gray, voting_points, radius, [t for _, t in voting]
+    )
+    
+    # Method 2: Structure Tensor, looked up in a field covering the stitches
+    if field is None and voting_points:
+        xs = [x for x, _ in voting_points]
+        ys = [y for _, y in voting_points]
+        field = OrientationField(image_gray, radius, (min(xs), min(ys), max(xs) + 1, max(ys) + 1))
+    structure_vectors = field.structural_vectors(voting_points).tolist() if voting_points else []
+    
+    for ((sx, sy), (tx, ty)), vote1, (vx_struct, vy_struct) in zip(voting, brightness_votes.tolist(), structure_vectors):
         vote2 = 0
-        vx_struct, vy_struct = get_structural_vector(image_gray, sx, sy, radius)
         
         # Check alignment with Tangent
         dot_struct = vx_struct * tx + vy_struct * ty
@@ -147,49 +294,47 @@ def determine_direction(image_gray, spine_points, stitches, yarn_width):
     global_direction = 1 if total_votes >= 0 else -1
     
     # Calculate Mean Global Vector
+    mean_vec = mean_brightness_vector([t for _, t in voting], brightness_votes.tolist())
+        
+    return global_direction, stitch_vote_data, mean_vec
+
+def mean_brightness_vector(tangents, brightness_votes):
+    # Mean of the tangents, each turned round where its stitch's brightness vote is negative;
+    # cardinal_direction reads the direction from it
     sum_vx = 0.0
     sum_vy = 0.0
     
-    for (_, (bx, by), (sx, sy)) in stitch_vote_data:
-        sum_vx += bx
-        sum_vy += by
+    for (tx, ty), vote in zip(tangents, brightness_votes):
+        vis_b_dir = 1 if vote >= 0 else -1
+        sum_vx += tx * vis_b_dir
+        sum_vy += ty * vis_b_dir
         
-    count = len(stitch_vote_data)
+    count = len(tangents)
     if count > 0:
-        mean_vx = sum_vx / count
-        mean_vy = sum_vy / count
-    else:
-        mean_vx, mean_vy = 0.0, 0.0
-        
-    return global_direction, stitch_vote_data, (mean_vx, mean_vy)
+        return sum_vx / count, sum_vy / count
+    return 0.0, 0.0
+
+def cardinal_direction(mean_vec):
+    # Convert Mean Vector to Cardinal Direction
+    mx, my = mean_vec
+    if abs(mx) > abs(my):
+        return "RIGHT" if mx > 0 else "LEFT"
+    return "DOWN" if my > 0 else "UP"
 
-def check_visual_spine_direction(image_shape, spine_points, global_dir, step=30):
+def check_visual_spine_direction(image_shape, spine_points, global_dir, step=30, delta=5):
     h, w = image_shape[:2]
-    spine_arr = np.array(spine_points)
+    path = yarn_framing.as_spine_path(spine_points)
     
     hits = {'LEFT': 0, 'RIGHT': 0, 'UP': 0, 'DOWN': 0}
     
-    for i in range(0, len(spine_points), step):
-        pt = spine_points[i]
-        
-        # Calculate Tangent
-        if i + 5 < len(spine_points):
-            next_pt = spine_points[i+5]
-            dx = next_pt[0] - pt[0]
-            dy = next_pt[1] - pt[1]
-        elif i - 5 >= 0:
-            prev_pt = spine_points[i-5]
-            dx = pt[0] - prev_pt[0]
-            dy = pt[1] - prev_pt[1]
-        else:
-            continue
-            
-        mag = math.sqrt(dx*dx + dy*dy)
-        if mag == 0: continue
+    # Tangent towards the point delta ahead (delta behind near the end)
+    tangents = path.forward_tangents(delta)[::step].tolist()
+    for pt, (dx, dy) in zip(path.points[::step].tolist(), tangents):
+        if dx == 0 and dy == 0: continue
         
         # Apply Global Direction
-        dx = (dx / mag) * global_dir
-        dy = (dy / mag) * global_dir
+        dx = dx * global_dir
+        dy = dy * global_dir
         
         # Raycast to Wall
         # Find distance to each wall
@@ -0,0 +1,120 @@
+import hashlib
+from collections import OrderedDict
+
+import postprocessing.scheduler as scheduler
+
+class Pipeline:
+    # Named stages that declare the stages they read and the parameters they take. A stage's result
+    # is memoized under a fingerprint of its parameter values and its inputs' fingerprints, so after
+    # set_params or set_source only the stages downstream of what changed run again. Sources are
+    # values supplied from outside (an image, a mask) under a fingerprint chosen by the caller.
+    def __init__(self, workers=1, memo_size=1):
+        self.workers = workers
+        # Results kept per stage; more than one lets a parameter go back to an earlier value for free
+        self.memo_size = max(1, int(memo_size))
+        self.stages = {}
+        self.params = {}
+        self.sources = {}
+        self.memo = {}
+        # Stages computed (not served from memory) by the last run
+        self.computed = []
+
+    def add_source(self, name, value, fingerprint):
+        self._check_new(name)
+        self.sources[name] = (fingerprint, value)
+
+    def set_source(self, name, value, fingerprint):
+        if name not in self.sources:
+            raise ValueError(f"Unknown source: {name}")
+        self.sources[name] = (fingerprint, value)
+
+    def add(self, name, func, inputs=(), params=()):
+        # func receives the results of inputs, in order, then params as keyword arguments
+        self._check_new(name)
+        for dep in inputs:
+            if dep not in self.stages and dep not in self.sources:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+
+        self.stages[name] = (func, tuple(inputs), tuple(params))
+        self.memo[name] = OrderedDict()
+
+    def _check_new(self, name):
+        if name in self.stages or name in self.sources:
+            raise ValueError(f"Duplicate stage: {name}")
+
+    def set_params(self, **params):
+        self.params.update(params)
+
+    def fingerprint(self, name):
+        if name in self.sources:
+            return self.sources[name][0]
+
+        _, inputs, params = self.stages[name]
+        text = repr((name, [(key, self.params.get(key)) for key in params], [self.fingerprint(dep) for dep in inputs]))
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def is_fresh(self, name):
+        # Whether name's result for the current sources and parameters is already in memory
+        return name in self.sources or self.fingerprint(name) in self.memo[name]
+
+    def run(self, *targets):
+        # {name: result} for the targets and everything they read. Stale stages run through a
+        # StageScheduler, so independent ones overlap when workers > 1; fresh ones are not called.
+        # Each stage is memoized as soon as it finishes, so an interrupted run keeps what it got through.
+        needed = []
+        self._collect(targets, needed, set())
+
+        results = {}
+        stale = scheduler.StageScheduler(self.workers)
+        self.computed = []
+        for name in needed:
+            if name in self.sources:
+                results[name] = self.sources[name][1]
+                continue
+
+            fingerprint = self.fingerprint(name)
+            memo = self.memo[name]
+            if fingerprint in memo:
+                memo.move_to_end(fingerprint)
+                results[name] = memo[fingerprint]
+                continue
+
+            inputs = self.stages[name][1]
+            stale.add(name, self._call(name, fingerprint, results), deps=[dep for dep in inputs if dep in stale.stages])
+
+        results.update(stale.run())
+        return results
+
+    def _call(self, name, fingerprint, ready):
+        # Inputs already known are read from ready; stale ones arrive from the scheduler in input order
+        func, inputs, params = self.stages[name]
+        kwargs = {key: self.params[key] for key in params if key in self.params}
+
+        def call(*stale_results):
+            pending = iter(stale_results)
+            args = [ready[dep] if dep in ready else next(pending) for dep in inputs]
+            result = func(*args, **kwargs)
+
+            memo = self.memo[name]
+            memo[fingerprint] = result
+            while len(memo) > self.memo_size:
+                memo.popitem(last=False)
+            self.computed.append(name)
+            return result
+        return call
+
+    def _collect(self, names, order, seen):
+        # Dependencies before dependants
+        for name in names:
+            if name in seen:
+                continue
+            if name not in self.stages and name not in self.sources:
+                raise ValueError(f"Unknown stage: {name}")
+            seen.add(name)
+            if name in self.stages:
+                self._collect(self.stages[name][1], order, seen)
+            order.append(name)
+
+    def clear(self):
+        for memo in self.memo.values():
+            memo.clear()
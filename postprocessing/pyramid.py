@@ -0,0 +1,132 @@
+import math
+
+import cv2
+import numpy as np
+
+
+# Long side the working level is aimed at; yarn stays tens of pixels wide there
+TARGET_LONG_SIDE = 1024
+MAX_LEVEL = 4
+# Enough context for the bilateral filters (d=9) to see the same neighbourhood as on the full image
+FILTER_PAD = 9
+# Full resolution context kept beyond the band's farthest mask pixel, so isolation near the yarn's
+# edge (colour cleaning, hole filling, smoothing) sees the same neighbourhood as on the full image
+BAND_MARGIN = 32
+# Side of the tiles filter_band filters; tiles that miss the band are skipped
+BAND_TILE = 256
+
+def choose_level(shape, target_long_side=TARGET_LONG_SIDE, max_level=MAX_LEVEL):
+    long_side = max(shape[:2])
+    if long_side <= target_long_side:
+        return 0
+    return int(min(max_level, max(0, round(math.log2(long_side / target_long_side)))))
+
+def downscale(image, level):
+    if level == 0:
+        return image
+        
+    s = 2 ** level
+    h, w = image.shape[:2]
+    return cv2.resize(image, (max(1, w // s), max(1, h // s)), interpolation=cv2.INTER_AREA)
+
+def upscale_mask(mask, level, shape):
+    if level == 0:
+        return mask
+        
+    # Resize by exactly 2**level and pad, so working pixel (x, y) covers the same block as to_full maps to
+    s = 2 ** level
+    h, w = shape[:2]
+    mh, mw = mask.shape
+    up = cv2.resize(mask, (mw * s, mh * s), interpolation=cv2.INTER_LINEAR)
+    _, up = cv2.threshold(up, 127, 255, cv2.THRESH_BINARY)
+    
+    full = np.zeros((h, w), dtype=np.uint8)
+    full[:min(h, mh * s), :min(w, mw * s)] = up[:h, :w]
+    return full
+
+def to_working(point, level, shape=None):
+    s = 2 ** level
+    x, y = int(point[0]) // s, int(point[1]) // s
+    if shape is not None:
+        h, w = shape[:2]
+        x = min(max(x, 0), w - 1)
+        y = min(max(y, 0), h - 1)
+    return x, y
+
+def to_full(points, level):
+    # Centre of the working pixel's block
+    s = 2 ** level
+    return [(int(x) * s + s // 2, int(y) * s + s // 2) for x, y in points]
+
+def densify_path(anchors):
+    # Rasterize a polyline into an ordered, 8-connected pixel path
+    anchors = np.asarray(anchors, dtype=np.float64).reshape(-1, 2)
+    if len(anchors) < 2:
+        return [tuple(p) for p in np.rint(anchors).astype(np.int64).tolist()]
+        
+    deltas = np.diff(anchors, axis=0)
+    steps = np.maximum(np.ceil(np.abs(deltas).max(axis=1)), 1).astype(np.int64)
+    
+    seg = np.repeat(np.arange(len(steps)), steps)
+    starts = np.concatenate(([0], np.cumsum(steps)[:-1]))
+    t = (np.arange(steps.sum()) - starts[seg]) / steps[seg]
+    
+    pts = anchors[seg] + deltas[seg] * t[:, None]
+    pts = np.vstack((pts, anchors[-1:]))
+    pts = np.rint(pts).astype(np.int64)
+    
+    keep = np.ones(len(pts), dtype=bool)
+    keep[1:] = np.any(pts[1:] != pts[:-1], axis=1)
+    
+    return [tuple(p) for p in pts[keep].tolist()]
+
+def mask_roi(mask, margin):
+    # Bounding box of the mask grown by margin, as (x1, y1, x2, y2)
+    x, y, w, h = cv2.boundingRect(mask)
+    mh, mw = mask.shape[:2]
+    if w == 0 or h == 0:
+        return 0, 0, mw, mh
+    return max(0, x - margin), max(0, y - margin), min(mw, x + w + margin), min(mh, y + h + margin)
+
+def spine_band(spine_points, mask, level, shape, margin=BAND_MARGIN):
+    # Full resolution band around the working spine, as a mask of the full image and its bounding box.
+    # Its half width is the farthest working mask pixel from the spine plus a block and margin, so every
+    # pixel of the yarn falls inside it; for a yarn without side branches that is about its half width.
+    s = 2 ** level
+    off_spine = np.full(mask.shape[:2], 255, dtype=np.uint8)
+    pts = np.asarray(spine_points, dtype=np.intp).reshape(-1, 2)
+    off_spine[pts[:, 1], pts[:, 0]] = 0
+    distance = cv2.distanceTransform(off_spine, cv2.DIST_L2, 5)
+    
+    reach = float(distance[mask > 0].max()) if np.any(mask) else 0.0
+    band = np.where(distance <= reach + 1 + margin / s, np.uint8(255), np.uint8(0))
+    band = upscale_mask(band, level, shape)
+    return band, mask_roi(band, 0)
+
+def filter_band(image, band, roi, func, tile=BAND_TILE, pad=FILTER_PAD):
+    # filter_window over the tiles of roi that meet the band; the rest of the window is left black
+    x1, y1, x2, y2 = roi
+    filtered = np.zeros((y2 - y1, x2 - x1) + image.shape[2:], dtype=image.dtype)
+    for ty in range(y1, y2, tile):
+        for tx in range(x1, x2, tile):
+            bx2, by2 = min(x2, tx + tile), min(y2, ty + tile)
+            if not band[ty:by2, tx:bx2].any():
+                continue
+            filtered[ty - y1:by2 - y1, tx - x1:bx2 - x1] = filter_window(image, (tx, ty, bx2, by2), func, pad)
+    return filtered
+
+def filter_window(image, roi, func, pad=FILTER_PAD):
+    # Apply func to a padded window so the result matches a full-image pass inside roi
+    x1, y1, x2, y2 = roi
+    h, w = image.shape[:2]
+    px1, py1 = max(0, x1 - pad), max(0, y1 - pad)
+    px2, py2 = min(w, x2 + pad), min(h, y2 + pad)
+    
+    filtered = func(image[py1:py2, px1:px2])
+    return filtered[y1 - py1:y2 - py1, x1 - px1:x2 - px1]
+
+def shift_points(points, offset):
+    ox, oy = offset
+    if ox == 0 and oy == 0:
+        return points
+    return [(x + ox, y + oy) for x, y in points]
@@ -0,0 +1,62 @@
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+def default_workers():
+    return min(4, os.cpu_count() or 1)
+
+class StageScheduler:
+    # Runs named stages as soon as the stages they depend on have finished.
+    # Most OpenCV calls release the GIL, so independent stages overlap on threads.
+    # Each stage runs in a copy of the caller's context, so context variables (such as the
+    # enclosing trace stage) carry over to the pool threads.
+    def __init__(self, workers=1):
+        self.workers = max(1, int(workers or 1))
+        self.stages = {}
+
+    def add(self, name, func, deps=()):
+        # func receives the results of deps, in order, as positional arguments
+        if name in self.stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+
+        self.stages[name] = (func, tuple(deps))
+
+    def run(self):
+        # Returns {name: result}. Stages can only depend on earlier stages, so
+        # insertion order is a valid sequential schedule.
+        if self.workers == 1:
+            results = {}
+            for name, (func, deps) in self.stages.items():
+                results[name] = func(*(results[dep] for dep in deps))
+            return results
+
+        return self._run_parallel()
+
+    def _run_parallel(self):
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                while pending or running:
+                    for name, (func, deps) in list(pending.items()):
+                        if all(dep in results for dep in deps):
+                            del pending[name]
+                            context = contextvars.copy_context()
+                            future = pool.submit(context.run, func, *(results[dep] for dep in deps))
+                            running[future] = name
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results[running.pop(future)] = future.result()
+            except BaseException:
+                # First failure wins; stages that have not started are dropped
+                for future in running:
+                    future.cancel()
+                raise
+
+        return results
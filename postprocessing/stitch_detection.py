@@ -1,68 +1,124 @@
+from functools import partial
+
 import cv2
 import numpy as np
-import preprocessing.filters as filters
-
-def detect_stitches(image, mask, spine_points, yarn_width, max_corners=100, quality_level=0.05, debug=False):
-    if not spine_points or yarn_width is None:
-        return ([], {}) if debug else []
+import preprocessing.image_context as image_context
+import postprocessing.yarn_framing as yarn_framing
+import postprocessing.scheduler as scheduler
 
-    # Sharpening
-    sharpened_img = filters.apply_unsharp_mask(image, strength=0.5)
+# Corner detector settings for stitch candidates
+MAX_CORNERS = 100
+QUALITY_LEVEL = 0.05
+# Neighbourhood of the corner response (goodFeaturesToTrack's blockSize)
+CORNER_BLOCK_SIZE = 9
+# Candidates select_corners checks against its map of covered pixels at once
+SELECT_CHUNK = 4096
 
-    # Prepare Grayscale
-    if len(image.shape) == 3:
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def get_weighted_image(context, max_distance=None):
+    # Compute Spine Map. A tile of a larger mask passes the whole mask's largest distance, which
+    # scales it exactly as the min-max normalization of the whole mask would.
+    if max_distance is None:
+        dist_map = cv2.normalize(context.distance, None, 0, 1.0, cv2.NORM_MINMAX)
     else:
-        gray = image
-
-    # Compute Spine Map
-    dist_map = cv2.distanceTransform(mask, cv2.DIST_L2, 5)
-    cv2.normalize(dist_map, dist_map, 0, 1.0, cv2.NORM_MINMAX)
+        dist_map = context.distance * np.float32(1.0 / max_distance)
     
     # Spine Weighting
     weight_map = np.power(dist_map, 4.0)
     
     # Apply Weighting
-    gray_float = gray.astype(np.float32) / 255.0
+    gray_float = context.gray.astype(np.float32) / 255.0
     weighted_img = gray_float * weight_map
     
-    # Optimization range
+    return weight_map, weighted_img
+
+def get_corner_candidates(context):
+    # Every corner goodFeaturesToTrack could return from the weighted image, strongest first: local
+    # maxima of the minimum eigenvalue map (same block and gradient size), away from the border.
+    # Only the selection depends on minDistance, maxCorners and qualityLevel, so the sweep over
+    # distances and any change of those settings reuse this. Ties keep OpenCV's order (later pixel first).
+    weight_map, weighted_img = get_weighted_image(context)
+    eig = cv2.cornerMinEigenVal(weighted_img, CORNER_BLOCK_SIZE, 3)
+    _, max_value, _, _ = cv2.minMaxLoc(eig)
+    
+    inner = eig[1:-1, 1:-1]
+    ys, xs = np.nonzero((inner > 0) & (inner == cv2.dilate(eig, None)[1:-1, 1:-1]))
+    # Reversed row-major order, so a stable sort leaves equal values later pixel first
+    ys, xs = ys[::-1], xs[::-1]
+    values = inner[ys, xs]
+    order = np.argsort(-values, kind="stable")
+    
+    return {
+        "weight_map": weight_map,
+        "max_value": max_value,
+        "values": values[order],
+        "points": np.column_stack((xs[order] + 1, ys[order] + 1))
+    }
+
+def select_corners(candidates, test_dist, max_corners, quality_level):
+    # goodFeaturesToTrack's result for these settings, as an (N, 1, 2) float32 array
+    threshold = np.float32(candidates["max_value"] * quality_level)
+    count = np.count_nonzero(candidates["values"] > threshold)
+    limit = max_corners if max_corners > 0 else count
+    points = candidates["points"][:count]
+    if count == 0:
+        return np.empty((0, 1, 2), dtype=np.float32)
+    
+    # Greedy in order of strength: keep a corner unless it is within test_dist of one already kept.
+    # Candidates are whole pixels, so "within test_dist" is a fixed disk of offsets; each kept corner
+    # marks its disk in a map over the candidates' bounding box, and a marked candidate is dropped.
+    # Candidates are taken in chunks, dropping those an earlier chunk already covers in one lookup.
+    radius = max(int(np.ceil(test_dist)), 0)
+    dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    disk = dx * dx + dy * dy < test_dist * test_dist
+    
+    x0, y0 = points.min(axis=0)
+    x1, y1 = points.max(axis=0)
+    blocked = np.zeros((y1 - y0 + 1, x1 - x0 + 1), dtype=bool)
+    h, w = blocked.shape
+    
+    kept = []
+    for start in range(0, count, SELECT_CHUNK):
+        chunk = points[start:start + SELECT_CHUNK] - (x0, y0)
+        chunk = chunk[~blocked[chunk[:, 1], chunk[:, 0]]]
+        for x, y in chunk.tolist():
+            if blocked[y, x]:
+                continue
+            kept.append((x + x0, y + y0))
+            if len(kept) == limit:
+                return np.array(kept, dtype=np.float32).reshape(-1, 1, 2)
+            
+            # Mark the disk, clipped to the map
+            bx1, by1 = max(x - radius, 0), max(y - radius, 0)
+            bx2, by2 = min(x + radius + 1, w), min(y + radius + 1, h)
+            blocked[by1:by2, bx1:bx2] |= disk[by1 - y + radius:by2 - y + radius, bx1 - x + radius:bx2 - x + radius]
+            
+    return np.array(kept, dtype=np.float32).reshape(-1, 1, 2)
+
+def sweep_distances(yarn_width):
+    # minDistance values tried for goodFeaturesToTrack, from half to one and a half yarn widths
     start_dist = int(yarn_width * 0.5)
     end_dist = int(yarn_width * 1.5)
     
     start_dist = max(5, start_dist)
     if end_dist <= start_dist:
         end_dist = start_dist + 10
+    return list(range(start_dist, end_dist + 1, 10))
 
+def choose_corners(selections, spine_index, yarn_width, debug=False):
+    # The selection (test_dist -> corners, in sweep order) whose spacing along the spine is most even,
+    # biased towards a minDistance of one yarn width. Returns its corners and, with debug, every step.
     best_score = float('inf')
     best_corners = []
     optimization_steps = []
     
-    spine_arr = np.array(spine_points)
-    
-    for test_dist in range(start_dist, end_dist + 1, 10):
-        corners = cv2.goodFeaturesToTrack(
-            weighted_img,
-            maxCorners=max_corners,
-            qualityLevel=quality_level,
-            minDistance=test_dist,
-            blockSize=9,
-            useHarrisDetector=False
-        )
-        
+    for test_dist, corners in selections.items():
         if corners is None or len(corners) < 3: 
             continue
             
         pts = [tuple(c[0]) for c in np.int32(corners)]
         
         # Project to Spine & Sort
-        spine_indices = []
-        for cx, cy in pts:
-            dists = np.sum((spine_arr - np.array([cx, cy]))**2, axis=1)
-            idx = np.argmin(dists)
-            spine_indices.append(idx)
-            
-        spine_indices.sort()
+        spine_indices = np.sort(spine_index.project(pts))
         
         # Calculate Intervals
         intervals = np.diff(spine_indices)
@@ -83,58 +139,93 @@ def detect_stitches(image, mask, spine_points, yarn_width, max_corners=100, qual
         score = cv_val + (bias * 0.5)
         
         if debug:
-            step_img = image.copy()
-            for cx, cy in pts:
-                cv2.circle(step_img, (cx, cy), 5, (0, 255, 255), -1)
-            
             optimization_steps.append({
                 'dist': test_dist,
                 'score': score,
                 'cv': cv_val,
-                'corners': pts,
-                'image': step_img
+                'corners': pts
             })
 
         if score < best_score:
             best_score = score
             best_corners = pts
             
-    # Refine positions
+    return best_corners, optimization_steps
+
+def snap_radius(yarn_width):
+    return max(3, int(yarn_width / 2))
+
+def snap_corners(snap_gray, corners, yarn_width):
+    # Move each corner to the darkest pixel of snap_gray within snap_radius (a square, clipped to the image)
     refined_corners = []
-    if best_corners:
-        radius = int(yarn_width / 2)
-        if radius < 3: radius = 3
+    radius = snap_radius(yarn_width)
+    h, w = snap_gray.shape
+    
+    for cx, cy in corners:
+        x1 = max(0, cx - radius)
+        y1 = max(0, cy - radius)
+        x2 = min(w, cx + radius + 1)
+        y2 = min(h, cy + radius + 1)
         
-        snap_gray = cv2.bilateralFilter(gray, d=9, sigmaColor=75, sigmaSpace=75)
+        roi = snap_gray[y1:y2, x1:x2]
+        if roi.size == 0:
+            refined_corners.append((cx, cy))
+            continue
+            
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(roi)
         
-        h, w = gray.shape
+        final_x = x1 + min_loc[0]
+        final_y = y1 + min_loc[1]
         
-        for cx, cy in best_corners:
-            x1 = max(0, cx - radius)
-            y1 = max(0, cy - radius)
-            x2 = min(w, cx + radius + 1)
-            y2 = min(h, cy + radius + 1)
-            
-            roi = snap_gray[y1:y2, x1:x2]
-            if roi.size == 0:
-                refined_corners.append((cx, cy))
-                continue
-                
-            min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(roi)
-            
-            final_x = x1 + min_loc[0]
-            final_y = y1 + min_loc[1]
+        refined_corners.append((final_x, final_y))
+        
+    return refined_corners
+
+def detect_stitches(image, mask, spine_points, yarn_width, max_corners=MAX_CORNERS, quality_level=QUALITY_LEVEL, debug=False, spine_index=None, context=None, workers=1, candidates=None):
+    # candidates from get_corner_candidates on the same context may be passed in when they are kept
+    # between calls, e.g. while only max_corners or quality_level change
+    if not spine_points or yarn_width is None:
+        return ([], {}) if debug else []
+
+    context = image_context.get_context(image, mask, context)
+    
+    if spine_index is None:
+        spine_index = yarn_framing.as_spine_path(spine_points).spatial_index
+    
+    # Sweep steps only need the corner candidates and the snap image needs neither, so they overlap
+    test_dists = sweep_distances(yarn_width)
+    stages = scheduler.StageScheduler(workers)
+    if candidates is None:
+        stages.add('candidates', partial(get_corner_candidates, context))
+    else:
+        stages.add('candidates', lambda: candidates)
+    stages.add('snap_gray', lambda: context.snap_gray)
+    for test_dist in test_dists:
+        stages.add(
+            test_dist,
+            partial(select_corners, test_dist=test_dist, max_corners=max_corners, quality_level=quality_level),
+            deps=('candidates',)
+        )
+    results = stages.run()
+    weight_map = results['candidates']['weight_map']
+    
+    best_corners, optimization_steps = choose_corners(
+        {test_dist: results[test_dist] for test_dist in test_dists}, spine_index, yarn_width, debug
+    )
             
-            refined_corners.append((final_x, final_y))
+    # Refine positions
+    refined_corners = snap_corners(results['snap_gray'], best_corners, yarn_width) if best_corners else []
             
     if debug:
-        weight_map_visual = (weight_map * 255).astype(np.uint8)
-        heatmap_img = cv2.applyColorMap(weight_map_visual, cv2.COLORMAP_JET)
-        
+        # Heatmap is drawn on demand from the weight map, see render_heatmap
         return refined_corners, {
-            'heatmap': heatmap_img,
+            'weight_map': weight_map,
             'steps': optimization_steps,
             'raw': best_corners
         }
 
     return refined_corners
+
+def render_heatmap(weight_map):
+    weight_map_visual = (weight_map * 255).astype(np.uint8)
+    return cv2.applyColorMap(weight_map_visual, cv2.COLORMAP_JET)
@@ -0,0 +1,350 @@
+import cv2
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.morphology import skeletonize
+
+import preprocessing.hue_isolator as hue_isolator
+
+DEFAULT_BUDGET_BYTES = 512 * 1024 * 1024
+# Working memory per pixel of a padded tile in the heaviest per-tile step
+# (HSV and range planes, morphology temporaries, int32 labels, float32 distances)
+TILE_BYTES_PER_PIXEL = 48
+MIN_TILE = 256
+# How far each local step looks: clean_color_mask (3x3 kernel, 16 iterations in all)
+# and the 15x15 closing then opening of hue_isolator.finish_mask
+CLEAN_PAD = 32
+SMOOTH_PAD = 32
+# Thinning reaches up to twice the local half thickness; the skeleton pass grows its pad to suit
+SKELETON_MARGIN = 8
+# Working memory per pixel of a padded tile while thinning or measuring its thickness
+# (the block and its boolean copy, skeletonize's buffers, float32 distances and OpenCV's own)
+SKELETON_BYTES_PER_PIXEL = 16
+DISTANCE_PAD = 64
+
+class BudgetError(ValueError):
+    # The memory budget is too small for what this image needs (e.g. the overlap thick yarn needs to thin exactly)
+    pass
+
+class DiskArray:
+    # Array kept in a file. Blocks are mapped with numpy.memmap only while they are copied in or out,
+    # so only the block being worked on is resident, however large the array is.
+    def __init__(self, path, shape, dtype=np.uint8):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        # Sized up front; the file stays sparse until written
+        np.memmap(path, dtype=self.dtype, mode='w+', shape=self.shape).flush()
+
+    def _rows(self, y1, y2, mode):
+        row_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+        return np.memmap(self.path, dtype=self.dtype, mode=mode, offset=y1 * row_bytes,
+                         shape=(y2 - y1,) + self.shape[1:])
+
+    def read(self, box):
+        x1, y1, x2, y2 = box
+        rows = self._rows(y1, y2, 'r')
+        block = np.array(rows[:, x1:x2])
+        del rows
+        return block
+
+    def write(self, box, block):
+        x1, y1, x2, y2 = box
+        rows = self._rows(y1, y2, 'r+')
+        rows[:, x1:x2] = block
+        del rows
+
+def tile_size(budget_bytes, pad, bytes_per_pixel=TILE_BYTES_PER_PIXEL):
+    # Core tile side whose padded tile fits the budget
+    side = int(np.sqrt(budget_bytes / bytes_per_pixel)) - 2 * pad
+    return max(MIN_TILE, side)
+
+def max_pad(budget_bytes, bytes_per_pixel=TILE_BYTES_PER_PIXEL):
+    # Largest pad that still leaves a MIN_TILE core inside the budget
+    return max(0, (int(np.sqrt(budget_bytes / bytes_per_pixel)) - MIN_TILE) // 2)
+
+def budget_for_pad(pad, bytes_per_pixel=TILE_BYTES_PER_PIXEL):
+    # Smallest budget whose padded MIN_TILE tile takes this pad
+    return (MIN_TILE + 2 * pad) ** 2 * bytes_per_pixel
+
+def iter_tiles(shape, tile, roi=None):
+    # Core tiles as (x1, y1, x2, y2), row by row, on a grid anchored at the image origin.
+    # roi limits them to the tiles that meet that box.
+    h, w = shape[:2]
+    rx1, ry1, rx2, ry2 = roi if roi is not None else (0, 0, w, h)
+    for y1 in range(ry1 // tile * tile, ry2, tile):
+        for x1 in range(rx1 // tile * tile, rx2, tile):
+            yield x1, y1, min(w, x1 + tile), min(h, y1 + tile)
+
+def grow(box, pad, shape):
+    x1, y1, x2, y2 = box
+    h, w = shape[:2]
+    return max(0, x1 - pad), max(0, y1 - pad), min(w, x2 + pad), min(h, y2 + pad)
+
+def core_of(block, box, outer):
+    # The part of a padded block that belongs to the core tile
+    x1, y1, x2, y2 = box
+    ox1, oy1 = outer[:2]
+    return block[y1 - oy1:y2 - oy1, x1 - ox1:x2 - ox1]
+
+def union_boxes(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+def map_tiles(func, sources, dest, budget_bytes, pad=0, roi=None):
+    # dest = func(*sources), computed tile by tile. func sees each tile grown by pad (less at the image
+    # edges) and returns a block of the same size; only the core is kept, so any local operation whose
+    # reach is within pad gives the same pixels as on the whole image. Returns the bounding box of the
+    # non-zero output.
+    shape = sources[0].shape
+    bounds = None
+    for box in iter_tiles(shape, tile_size(budget_bytes, pad), roi):
+        outer = grow(box, pad, shape)
+        core = core_of(func(*(source.read(outer) for source in sources)), box, outer)
+        dest.write(box, core)
+
+        if core.ndim == 2:
+            x, y, bw, bh = cv2.boundingRect(core)
+            if bw > 0:
+                bounds = union_boxes(bounds, (box[0] + x, box[1] + y, box[0] + x + bw, box[1] + y + bh))
+
+    return bounds
+
+class TiledLabels:
+    # Connected components of a mask too large to label at once. Each tile is labelled on its own and
+    # labels that touch across a seam are merged, so every merged component is exactly one component
+    # of cv2.connectedComponents on the whole mask.
+    def __init__(self, read, shape, budget_bytes, connectivity=8):
+        # read(box) returns the binary mask block for a box
+        self.read = read
+        self.shape = shape[:2]
+        self.connectivity = connectivity
+        self.tile = tile_size(budget_bytes, 0)
+        self.offsets = {}
+
+        h, w = self.shape
+        # Rows and columns either side of every seam, in global labels
+        above, below, left, right = {}, {}, {}, {}
+        areas = [0]
+        edge_labels = []
+        count = 1
+
+        for box in iter_tiles(self.shape, self.tile):
+            labels, n, stats = self._label(box)
+            self.offsets[box] = count - 1
+            areas.extend(stats[1:, cv2.CC_STAT_AREA].tolist())
+            labels = self._globalize(labels, count - 1)
+            count += n - 1
+
+            x1, y1, x2, y2 = box
+            if y1 > 0:
+                below.setdefault(y1, np.zeros(w, np.int64))[x1:x2] = labels[0]
+            if y2 < h:
+                above.setdefault(y2, np.zeros(w, np.int64))[x1:x2] = labels[-1]
+            if x1 > 0:
+                right.setdefault(x1, np.zeros(h, np.int64))[y1:y2] = labels[:, 0]
+            if x2 < w:
+                left.setdefault(x2, np.zeros(h, np.int64))[y1:y2] = labels[:, -1]
+
+            # Components reaching the image border
+            for edge, on_border in ((labels[0], y1 == 0), (labels[-1], y2 == h),
+                                    (labels[:, 0], x1 == 0), (labels[:, -1], x2 == w)):
+                if on_border:
+                    edge_labels.append(edge[edge > 0])
+
+        pairs = [self._seam_pairs(above[y], below[y]) for y in above]
+        pairs += [self._seam_pairs(left[x], right[x]) for x in left]
+        a = np.concatenate([p[0] for p in pairs]) if pairs else np.zeros(0, np.int64)
+        b = np.concatenate([p[1] for p in pairs]) if pairs else np.zeros(0, np.int64)
+
+        graph = coo_matrix((np.ones(len(a), np.int8), (a, b)), shape=(count, count))
+        _, self.roots = connected_components(graph, directed=False)
+        self.areas = np.bincount(self.roots, weights=np.asarray(areas, dtype=np.float64))
+        self.areas[self.roots[0]] = 0
+
+        self.on_border = np.zeros(len(self.areas), dtype=bool)
+        if edge_labels:
+            self.on_border[self.roots[np.concatenate(edge_labels)]] = True
+        self.on_border[self.roots[0]] = False
+
+    def _label(self, box):
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(self.read(box), connectivity=self.connectivity)
+        return labels, n, stats
+
+    def _globalize(self, labels, offset):
+        return np.where(labels > 0, labels.astype(np.int64) + offset, 0)
+
+    def _seam_pairs(self, first, second):
+        # Label pairs touching across a seam; 8-connectivity also links diagonal neighbours
+        shifts = (0, -1, 1) if self.connectivity == 8 else (0,)
+        a, b = [], []
+        for shift in shifts:
+            if shift == 0:
+                u, v = first, second
+            elif shift < 0:
+                u, v = first[1:], second[:-1]
+            else:
+                u, v = first[:-1], second[1:]
+            both = (u > 0) & (v > 0)
+            a.append(u[both])
+            b.append(v[both])
+        return np.concatenate(a), np.concatenate(b)
+
+    def component_at(self, point):
+        # Merged component under a pixel, or None on the background
+        x, y = point
+        for box in self.offsets:
+            x1, y1, x2, y2 = box
+            if x1 <= x < x2 and y1 <= y < y2:
+                label = self._label(box)[0][y - y1, x - x1]
+                return self.roots[label + self.offsets[box]] if label > 0 else None
+        return None
+
+    def largest(self):
+        if len(self.areas) == 0 or self.areas.max() == 0:
+            return None
+        return int(np.argmax(self.areas))
+
+    def write(self, dest, keep):
+        # 255 where a pixel's merged component is in keep (boolean, per component).
+        # Unlabelled pixels belong to component roots[0], so keep decides them too.
+        keep = np.asarray(keep, dtype=bool)
+        bounds = None
+        for box, offset in self.offsets.items():
+            labels = self._globalize(self._label(box)[0], offset)
+            block = np.where(keep[self.roots[labels]], np.uint8(255), np.uint8(0))
+            dest.write(box, block)
+
+            x, y, bw, bh = cv2.boundingRect(block)
+            if bw > 0:
+                bounds = union_boxes(bounds, (box[0] + x, box[1] + y, box[0] + x + bw, box[1] + y + bh))
+        return bounds
+
+def filter_image(source, dest, func, budget_bytes, pad):
+    map_tiles(func, [source], dest, budget_bytes, pad)
+
+def clean_color_mask(blurred, dest, color_name, budget_bytes):
+    map_tiles(lambda block: hue_isolator.clean_color_mask(block, color_name), [blurred], dest,
+              budget_bytes, CLEAN_PAD)
+
+def keep_components(mask, dest, budget_bytes, point=None):
+    # The component under point, or the largest one; returns its bounding box (None if there is none)
+    labels = TiledLabels(mask.read, mask.shape, budget_bytes)
+    component = labels.component_at(point) if point is not None else labels.largest()
+    if component is None:
+        return None
+
+    keep = np.zeros(len(labels.areas), dtype=bool)
+    keep[component] = True
+    return labels.write(dest, keep)
+
+def fill_holes(mask, dest, budget_bytes):
+    # Like filling the external contours: background not connected to the image border becomes mask.
+    # Background connects through 4-neighbours, as it does around 8-connected contours.
+    background = TiledLabels(lambda box: cv2.bitwise_not(mask.read(box)), mask.shape, budget_bytes, connectivity=4)
+    return background.write(dest, ~background.on_border)
+
+def smooth_mask(mask, dest, budget_bytes, roi=None):
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, hue_isolator.SMOOTH_KERNEL_SIZE)
+
+    def smooth(block):
+        block = cv2.morphologyEx(block, cv2.MORPH_CLOSE, kernel)
+        return cv2.morphologyEx(block, cv2.MORPH_OPEN, kernel)
+
+    if roi is None:
+        return map_tiles(smooth, [mask], dest, budget_bytes, SMOOTH_PAD)
+
+    # Tiles away from the mask stay empty
+    roi = grow(roi, SMOOTH_PAD, mask.shape)
+    return map_tiles(smooth, [mask], dest, budget_bytes, SMOOTH_PAD, roi)
+
+def largest_distance(binary, budget_bytes, roi, widest, bytes_per_pixel=SKELETON_BYTES_PER_PIXEL):
+    # Largest distance to the background inside roi. Distances are only trusted when they stay below the pad
+    # they were computed with, so a tile whose are not is scanned again in smaller tiles with twice the pad.
+    # Returns as soon as a distance exceeds widest, with that distance (a lower bound of the largest), since
+    # the caller cannot use more.
+    thickest = 0.0
+    tile = tile_size(budget_bytes, DISTANCE_PAD, bytes_per_pixel)
+    tiles = [(box, DISTANCE_PAD) for box in iter_tiles(binary.shape, tile, roi)]
+    while tiles:
+        box, pad = tiles.pop()
+        outer = grow(box, pad, binary.shape)
+        block = binary.read(outer)
+        if not block.any():
+            continue
+        distance = cv2.distanceTransform(block, cv2.DIST_L2, 5)
+        largest = float(core_of(distance, box, outer).max())
+        if largest > widest:
+            return largest
+        if largest < pad - 1 or outer == (0, 0, binary.shape[1], binary.shape[0]):
+            thickest = max(thickest, largest)
+            continue
+        # Doubling stops at the largest pad that could be used; largest > widest before it is exceeded
+        pad = min(2 * pad, int(widest) + 2)
+        tiles.extend((sub, pad) for sub in iter_tiles(binary.shape, tile_size(budget_bytes, pad, bytes_per_pixel), box))
+
+    return thickest
+
+def skeleton_pad(binary, budget_bytes, roi):
+    # Pad that lets every tile thin exactly like the whole image: twice the thickest half width, plus a margin.
+    # Thinning is not local for thick regions, so rather than thin tiles that cannot be joined exactly (or a
+    # "tile" the size of the image), BudgetError is raised as soon as the pad would not fit the budget.
+    # Half widths beyond this need a larger pad than the budget allows
+    widest = (max_pad(budget_bytes, SKELETON_BYTES_PER_PIXEL) - SKELETON_MARGIN) / 2
+    thickest = largest_distance(binary, budget_bytes, roi, widest)
+    if thickest > widest:
+        raise pad_error(2 * int(np.ceil(thickest)) + SKELETON_MARGIN, budget_bytes)
+
+    return 2 * int(np.ceil(thickest)) + SKELETON_MARGIN
+
+def pad_error(pad, budget_bytes, thickness=None, purpose="to thin exactly", bytes_per_pixel=SKELETON_BYTES_PER_PIXEL):
+    # The scan stops at the first region too thick for the budget, so pad is a lower bound
+    if thickness is None:
+        thickness = pad - SKELETON_MARGIN
+    return BudgetError(
+        f"parts of the mask are at least {thickness}px thick and need at least {pad}px of tile overlap {purpose}, "
+        f"more than a {budget_bytes / 2**20:.0f} MB budget allows ({max_pad(budget_bytes, bytes_per_pixel)}px); "
+        f"raise the memory budget to at least {int(np.ceil(budget_for_pad(pad, bytes_per_pixel) / 2**20))} MB"
+    )
+
+def skeleton_points(binary, budget_bytes, roi, pad=None):
+    # Skeleton pixels of a binary image as row-major (x, y) arrays, thinned tile by tile
+    if pad is None:
+        pad = skeleton_pad(binary, budget_bytes, roi)
+    if pad > max_pad(budget_bytes, SKELETON_BYTES_PER_PIXEL):
+        raise pad_error(pad, budget_bytes)
+    points = {}
+    for box in iter_tiles(binary.shape, tile_size(budget_bytes, pad, SKELETON_BYTES_PER_PIXEL), roi):
+        outer = grow(box, pad, binary.shape)
+        block = binary.read(outer)
+        if not block.any():
+            continue
+        core = core_of(skeletonize(block > 0), box, outer)
+        ys, xs = np.nonzero(core)
+        points[box] = (xs + box[0], ys + box[1])
+
+    if not points:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    xs = np.concatenate([p[0] for p in points.values()])
+    ys = np.concatenate([p[1] for p in points.values()])
+    order = np.lexsort((xs, ys))
+    return xs[order], ys[order]
+
+def read_downscaled(array, box, level, budget_bytes, interpolation=cv2.INTER_AREA):
+    # box of array shrunk by 2**level, read in bands of whole blocks so only a band is ever full size.
+    # The box must be a multiple of 2**level on each side.
+    s = 2 ** level
+    x1, y1, x2, y2 = box
+    row_bytes = (x2 - x1) * int(np.prod(array.shape[2:])) * array.dtype.itemsize
+    band = max(s, (budget_bytes // max(1, 4 * row_bytes)) // s * s)
+
+    parts = []
+    for top in range(y1, y2, band):
+        bottom = min(y2, top + band)
+        block = array.read((x1, top, x2, bottom))
+        parts.append(cv2.resize(block, ((x2 - x1) // s, (bottom - top) // s), interpolation=interpolation))
+    return np.concatenate(parts, axis=0)
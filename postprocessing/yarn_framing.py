@@ -1,27 +1,119 @@
+from functools import cached_property
+
 import cv2
 import numpy as np
 from skimage.morphology import skeletonize
-import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+import preprocessing.image_context as image_context
+
+# Forward half of the 8-neighbourhood (dy, dx); the reverse edges are implied
+NEIGHBOUR_OFFSETS = ((0, 1), (1, -1), (1, 0), (1, 1))
+# Points either side of a spine point whose chord gives its smoothed tangent
+TANGENT_DELTA = 5
 
-def find_spine(image, return_skeleton=False):
-    if len(image.shape) == 3:
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    else:
-        gray = image
+def find_spine(image, return_skeleton=False, context=None):
+    gray = image_context.get_context(image, context=context).gray
         
     _, binary = cv2.threshold(gray, 1, 255, cv2.THRESH_BINARY)
     binary_bool = binary > 0
     
     skeleton = skeletonize(binary_bool)
     
-    y_idxs, x_idxs = np.where(skeleton)
-    points = list(zip(x_idxs, y_idxs))
+    path = trace_longest_path(skeleton)
     
     if return_skeleton:
         skeleton_uint8 = (skeleton * 255).astype(np.uint8)
+        return path, skeleton_uint8
+    return path
+
+def build_skeleton_graph(skeleton):
+    # Nodes are skeleton pixels in row-major order
+    y_idxs, x_idxs = np.nonzero(skeleton)
+    return build_point_graph(x_idxs, y_idxs)
+
+def build_point_graph(x_idxs, y_idxs):
+    # 8-connected graph of pixel coordinates given in row-major order. Neighbours are found by
+    # searching sorted pixel keys, so memory follows the number of pixels, not their bounding box.
+    num_nodes = len(y_idxs)
+    
+    if num_nodes == 0:
+        return csr_matrix((0, 0)), x_idxs, y_idxs
+        
+    # Keys over the bounding box, padded by a column each side so neighbour keys never wrap into another row
+    x0, y0 = x_idxs.min(), y_idxs.min()
+    local_x = (x_idxs - x0 + 1).astype(np.int64)
+    local_y = (y_idxs - y0).astype(np.int64)
+    row = int(local_x.max()) + 2
+    keys = local_y * row + local_x
+    
+    rows = []
+    cols = []
+    weights = []
+    for dy, dx in NEIGHBOUR_OFFSETS:
+        wanted = keys + (dy * row + dx)
+        found = np.minimum(np.searchsorted(keys, wanted), num_nodes - 1)
+        has_edge = keys[found] == wanted
+        
+        rows.append(np.flatnonzero(has_edge))
+        cols.append(found[has_edge].astype(np.int32))
+        weights.append(np.full(np.count_nonzero(has_edge), np.hypot(dx, dy)))
+        
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    weights = np.concatenate(weights)
+    
+    # Symmetric adjacency
+    graph = csr_matrix(
+        (np.concatenate((weights, weights)), (np.concatenate((rows, cols)), np.concatenate((cols, rows)))),
+        shape=(num_nodes, num_nodes)
+    )
+    
+    return graph, x_idxs, y_idxs
+
+def trace_longest_path(skeleton):
+    y_idxs, x_idxs = np.nonzero(skeleton)
+    return trace_point_path(x_idxs, y_idxs)
+
+def trace_point_path(x_idxs, y_idxs):
+    # Longest path through skeleton pixels given as row-major coordinates
+    graph, x_idxs, y_idxs = build_point_graph(x_idxs, y_idxs)
+    
+    if graph.shape[0] == 0:
+        return SpinePath([])
+        
+    degrees = np.diff(graph.indptr)
+    leaves = np.flatnonzero(degrees == 1)
+    
+    start_node = leaves[0] if len(leaves) >= 2 else 0
+    
+    def get_furthest_node(source):
+        # Adjacency already holds both edge directions
+        lengths, predecessors = dijkstra(graph, directed=True, indices=source, return_predecessors=True)
+        lengths[np.isinf(lengths)] = -1
+        return int(np.argmax(lengths)), predecessors
+        
+    # Double sweep: the node furthest from any start is one end of the longest path
+    far_node, _ = get_furthest_node(start_node)
+    end_node, predecessors = get_furthest_node(far_node)
+    
+    path = [end_node]
+    while path[-1] != far_node:
+        path.append(predecessors[path[-1]])
+    path.reverse()
+    
+    return SpinePath(np.column_stack((x_idxs[path], y_idxs[path])))
+
+def trace_longest_path_networkx(skeleton):
+    # Reference implementation (one Python graph node per pixel), kept for benchmarking
+    import networkx as nx
+    
+    y_idxs, x_idxs = np.where(skeleton)
+    points = list(zip(x_idxs, y_idxs))
     
     if not points:
-        return ([], skeleton_uint8) if return_skeleton else []
+        return []
         
     G = nx.Graph()
     for p in points:
@@ -45,8 +137,6 @@ def find_spine(image, return_skeleton=False):
     leaves = [n for n, d in degrees.items() if d == 1]
     
     if len(leaves) < 2:
-        if not points:
-            return ([], skeleton_uint8) if return_skeleton else []
         leaves = [points[0]]
         
     def get_furthest_node(start_node):
@@ -60,53 +150,247 @@ def find_spine(image, return_skeleton=False):
     
     path = nx.shortest_path(G, far_node, end_node, weight='weight')
     
-    if return_skeleton:
-        return path, skeleton_uint8
-    return path
+    return [(int(x), int(y)) for x, y in path]
 
-def measure_width_at_center(spine_points, mask):
+class SpinePath:
+    # Ordered spine pixels as one contiguous int32 array. Arc length, tangents, normals and the
+    # nearest point lookup (spatial_index) are derived once and shared by every stage that is handed
+    # the path. It reads as a sequence of (x, y) tuples, so code written for point lists takes it unchanged.
+    def __init__(self, points):
+        self.points = np.ascontiguousarray(np.asarray(points, dtype=np.int32).reshape(-1, 2))
+        self.points.flags.writeable = False
+        self._tangents = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return SpinePath(self.points[item])
+        x, y = self.points[item].tolist()
+        return (x, y)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        return self.points if dtype is None else self.points.astype(dtype)
+
+    def tolist(self):
+        return [tuple(p) for p in self.points.tolist()]
+
+    def index(self, point):
+        # Position of the first occurrence of point, like list.index
+        hits = np.flatnonzero((self.points == np.asarray(point, dtype=np.int64)).all(axis=1))
+        if len(hits) == 0:
+            raise ValueError(f"{tuple(point)} is not in the spine")
+        return int(hits[0])
+
+    @property
+    def nbytes(self):
+        # Points plus whatever has been derived so far
+        total = self.points.nbytes + sum(t.nbytes for t in self._tangents.values())
+        if "arc_length" in self.__dict__:
+            total += self.arc_length.nbytes
+        return total
+
+    def shifted(self, offset):
+        ox, oy = offset
+        if ox == 0 and oy == 0:
+            return self
+        return SpinePath(self.points + np.array([ox, oy], dtype=np.int32))
+
+    @cached_property
+    def arc_length(self):
+        # Distance along the path from the first point to each point
+        steps = np.diff(self.points, axis=0).astype(np.float64)
+        arc = np.zeros(len(self.points), dtype=np.float64)
+        np.cumsum(np.hypot(steps[:, 0], steps[:, 1]), out=arc[1:])
+        return arc.astype(np.float32)
+
+    @property
+    def length(self):
+        return float(self.arc_length[-1]) if len(self.points) else 0.0
+
+    @cached_property
+    def spatial_index(self):
+        return SpineIndex(self.points)
+
+    def tangents(self, delta=TANGENT_DELTA):
+        # Unit chords from point i - delta to i + delta, clamped at the ends; zero where the two coincide
+        key = ("central", delta)
+        if key not in self._tangents:
+            n = len(self.points)
+            idx = np.arange(n)
+            pts = self.points.astype(np.int64)
+            self._tangents[key] = _unit_rows(pts[np.minimum(n - 1, idx + delta)] - pts[np.maximum(0, idx - delta)])
+        return self._tangents[key]
+
+    def forward_tangents(self, step=1):
+        # Unit chords from point i to i + step, or from i - step to i where the path ends first;
+        # zero where neither exists or the two points coincide
+        key = ("forward", step)
+        if key not in self._tangents:
+            n = len(self.points)
+            idx = np.arange(n)
+            pts = self.points.astype(np.int64)
+            ahead = idx + step < n
+            behind = ~ahead & (idx >= step)
+            chords = np.zeros((n, 2), dtype=np.int64)
+            chords[ahead] = pts[idx[ahead] + step] - pts[idx[ahead]]
+            chords[behind] = pts[idx[behind]] - pts[idx[behind] - step]
+            self._tangents[key] = _unit_rows(chords)
+        return self._tangents[key]
+
+    def normals(self, delta=TANGENT_DELTA):
+        # Tangents turned a quarter: (-ty, tx)
+        key = ("normal", delta)
+        if key not in self._tangents:
+            tangents = self.tangents(delta)
+            normals = np.column_stack((-tangents[:, 1], tangents[:, 0]))
+            normals.flags.writeable = False
+            self._tangents[key] = normals
+        return self._tangents[key]
+
+    def resample(self, step):
+        # Points every step pixels of arc length from the start, rounded to pixels
+        if len(self.points) < 2:
+            return SpinePath(self.points)
+            
+        arc = self.arc_length.astype(np.float64)
+        stations = np.arange(0.0, arc[-1] + step / 2, step)
+        xs = np.interp(stations, arc, self.points[:, 0])
+        ys = np.interp(stations, arc, self.points[:, 1])
+        return SpinePath(np.rint(np.column_stack((xs, ys))))
+
+def _unit_rows(chords):
+    # Integer chords to unit vectors with the same arithmetic as the scalar code they replace
+    lengths = np.sqrt((chords * chords).sum(axis=1))
+    units = np.zeros(chords.shape, dtype=np.float64)
+    np.divide(chords, lengths[:, None], out=units, where=lengths[:, None] > 0)
+    units.flags.writeable = False
+    return units
+
+def as_spine_path(spine_points):
+    if isinstance(spine_points, SpinePath):
+        return spine_points
+    return SpinePath(spine_points)
+
+class SpineIndex:
+    # Nearest-spine-point lookup, built once per spine and queried in bulk
+    def __init__(self, spine_points, max_ties=8):
+        self.points = np.asarray(spine_points, dtype=np.float64).reshape(-1, 2)
+        self.tree = cKDTree(self.points)
+        self.k = min(max_ties, len(self.points))
+
+    def __len__(self):
+        return len(self.points)
+
+    def project(self, points):
+        pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(pts) == 0 or self.k == 0:
+            return np.zeros(0, dtype=np.intp)
+            
+        dists, idxs = self.tree.query(pts, k=self.k)
+        if self.k == 1:
+            return idxs.astype(np.intp)
+            
+        # Break distance ties towards the lowest spine index, like np.argmin over the full spine
+        tied = dists == dists[:, :1]
+        return np.where(tied, idxs, len(self.points)).min(axis=1).astype(np.intp)
+
+def measure_width_at_center(spine_points, mask, delta=TANGENT_DELTA, offset=(0, 0)):
     if not spine_points or len(spine_points) < 2:
         return None
         
-    center_idx = len(spine_points) // 2
-    center_pt = spine_points[center_idx]
-    cx, cy = center_pt
+    path = as_spine_path(spine_points)
+    center_idx = len(path) // 2
     
-    # Calculate Tangent
-    delta = 5
-    p_start = spine_points[max(0, center_idx - delta)]
-    p_end = spine_points[min(len(spine_points) - 1, center_idx + delta)]
+    # The profile's ray march at the one centre sample, so the two measurements always agree
+    _, p1, p2, half_widths = measure_width_profile(path, mask, delta=delta, indices=[center_idx], offset=offset)
+    if np.isnan(half_widths[0]):
+        return None
     
-    dx = p_end[0] - p_start[0]
-    dy = p_end[1] - p_start[1]
+    return tuple(p1[0].tolist()), tuple(p2[0].tolist()), float(half_widths[0])
+
+def cast_rays(mask, start_x, start_y, dir_x, dir_y, active, offset=(0, 0)):
+    # Steps every active ray while it stays on the mask; returns the first off-mask pixel of each as int64 (x, y).
+    # mask may be a window of a larger mask at offset: rays still march in the larger mask's coordinates,
+    # so they round exactly as they would on the whole mask, and end where they leave the window.
+    ox, oy = offset
+    curr_x = np.asarray(start_x, dtype=np.float64).copy()
+    curr_y = np.asarray(start_y, dtype=np.float64).copy()
+    active = np.array(active, dtype=bool)
     
-    length = np.sqrt(dx*dx + dy*dy)
-    if length == 0:
+    h, w = mask.shape
+    while active.any():
+        ray = np.flatnonzero(active)
+        xi = curr_x[ray].astype(np.int64) - ox
+        yi = curr_y[ray].astype(np.int64) - oy
+        inside = (xi >= 0) & (xi < w) & (yi >= 0) & (yi < h)
+        on_mask = np.zeros(len(ray), dtype=bool)
+        on_mask[inside] = mask[yi[inside], xi[inside]] != 0
+        
+        active[ray[~on_mask]] = False
+        moving = ray[on_mask]
+        curr_x[moving] += dir_x[moving]
+        curr_y[moving] += dir_y[moving]
+        
+    return np.column_stack([curr_x.astype(np.int64), curr_y.astype(np.int64)])
+
+def measure_width_profile(spine_points, mask, step=1, delta=TANGENT_DELTA, indices=None, offset=(0, 0)):
+    # Width across the spine at every step-th spine point (or at the given indices), with all
+    # normal rays marched together. Returns (indices, p1, p2, half_widths) as arrays; points
+    # without a tangent get a NaN half width. A mask window at offset is measured as in cast_rays.
+    path = as_spine_path(spine_points)
+    n = len(path)
+    if n < 2:
         return None
         
-    ux = dx / length
-    uy = dy / length
+    if indices is None:
+        indices = np.arange(0, n, max(1, int(step)))
+    indices = np.asarray(indices, dtype=np.intp)
+    centers = path.points[indices]
     
-    # Calculate Normal (-y, x)
-    nx_vec = -uy
-    ny_vec = ux
+    tangents = path.tangents(delta)[indices]
+    ux = tangents[:, 0]
+    uy = tangents[:, 1]
+    valid = (ux != 0) | (uy != 0)
     
-    # Raycast to find edges
-    h, w = mask.shape
+    # Calculate Normal (-y, x), one ray each way
+    dir_x = np.concatenate([-uy, uy])
+    dir_y = np.concatenate([ux, -ux])
+    ends = cast_rays(
+        mask, np.concatenate([centers[:, 0], centers[:, 0]]), np.concatenate([centers[:, 1], centers[:, 1]]),
+        dir_x, dir_y, np.concatenate([valid, valid]), offset
+    )
+    p1 = ends[:len(indices)]
+    p2 = ends[len(indices):]
     
-    def cast_ray(start_x, start_y, dir_x, dir_y):
-        curr_x, curr_y = start_x, start_y
-        while 0 <= int(curr_x) < w and 0 <= int(curr_y) < h:
-            if mask[int(curr_y), int(curr_x)] == 0:
-                break
-            curr_x += dir_x
-            curr_y += dir_y
-        return (int(curr_x), int(curr_y))
-
-    p1 = cast_ray(cx, cy, nx_vec, ny_vec)
-    p2 = cast_ray(cx, cy, -nx_vec, -ny_vec)
+    full_dist = np.sqrt(((p1 - p2) ** 2).sum(axis=1))
+    half_widths = np.where(valid, full_dist / 2.0, np.nan)
     
-    full_dist = np.sqrt((p1[0]-p2[0])**2 + (p1[1]-p2[1])**2)
-    half_width = full_dist / 2.0
+    return indices, p1, p2, half_widths
+
+def summarize_width_profile(widths):
+    # Robust statistics of a width profile, ignoring NaN samples
+    values = np.asarray(widths, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return None
+        
+    median = float(np.median(values))
+    p10, p25, p75, p90 = np.percentile(values, [10, 25, 75, 90])
     
-    return p1, p2, half_width
+    return {
+        "samples": int(len(values)),
+        "median": median,
+        "mean": float(np.mean(values)),
+        "std": float(np.std(values)),
+        "mad": float(np.median(np.abs(values - median))),
+        "iqr": float(p75 - p25),
+        "p10": float(p10),
+        "p90": float(p90),
+        "min": float(values.min()),
+        "max": float(values.max())
+    }
@@ -1,6 +1,11 @@
 import cv2
 
-def apply_bilateral_filter(image, d=9, sigma_color=150, sigma_space=150):
+# Edge-preserving smoothing applied to every loaded image
+BILATERAL_D = 9
+BILATERAL_SIGMA_COLOR = 150
+BILATERAL_SIGMA_SPACE = 150
+
+def apply_bilateral_filter(image, d=BILATERAL_D, sigma_color=BILATERAL_SIGMA_COLOR, sigma_space=BILATERAL_SIGMA_SPACE):
     return cv2.bilateralFilter(image, d, sigma_color, sigma_space)
 
 def apply_unsharp_mask(image, strength=2.0):
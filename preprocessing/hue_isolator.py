@@ -1,5 +1,16 @@
+from functools import lru_cache
+
 import cv2
 import numpy as np
+import preprocessing.image_context as image_context
+
+COLOR_NAMES = ('red', 'orange', 'yellow', 'green', 'blue', 'purple', 'pink',
+               'cyan', 'magenta', 'white', 'gray', 'black')
+
+SMOOTH_KERNEL_SIZE = (15, 15)
+
+# Label images are int32 and full size, so only the most recent colours are kept
+COMPONENT_CACHE_SIZE = 3
 
 def get_color_ranges(color_name):
     color = color_name.lower()
@@ -25,6 +36,78 @@ def get_color_ranges(color_name):
     
     return colors.get(color, [])
 
+@lru_cache(maxsize=None)
+def get_range_tables():
+    # One bit per HSV range. The ranges are boxes, so a pixel lies inside a range
+    # exactly when the H, S and V tables all set that range's bit.
+    values = np.arange(256)
+    tables = np.zeros((3, 256), dtype=np.uint16)
+    color_bits = {}
+    bit = 0
+    for name in COLOR_NAMES:
+        color_bits[name] = 0
+        for lower, upper in get_color_ranges(name):
+            for channel in range(3):
+                inside = (values >= lower[channel]) & (values <= upper[channel])
+                tables[channel, inside] |= 1 << bit
+            color_bits[name] |= 1 << bit
+            bit += 1
+    return tables, color_bits
+
+@lru_cache(maxsize=None)
+def get_label_tables():
+    # The range edges cut H, S and V into a few intervals of equal membership (13, 3 and 5),
+    # so the interval triple of a pixel fits in one byte and decides every colour it belongs to.
+    # Returns the channel tables, weighted so that adding the three lookups gives the label,
+    # and per colour a table from label to mask value.
+    tables, color_bits = get_range_tables()
+    codes = []
+    uniques = []
+    for table in tables:
+        unique, inverse = np.unique(table, return_inverse=True)
+        uniques.append(unique)
+        codes.append(inverse)
+    
+    counts = [len(unique) for unique in uniques]
+    assert np.prod(counts) <= 256, "colour ranges have too many distinct intervals for a uint8 label"
+    weights = (counts[1] * counts[2], counts[2], 1)
+    channel_tables = np.stack([code * weight for code, weight in zip(codes, weights)]).astype(np.uint8)
+    
+    label_bits = np.zeros(256, dtype=np.uint16)
+    h, s, v = np.meshgrid(*[np.arange(n) for n in counts], indexing="ij")
+    label_bits[(h * weights[0] + s * weights[1] + v).ravel()] = (
+        uniques[0][h] & uniques[1][s] & uniques[2][v]
+    ).ravel()
+    
+    mask_tables = {
+        name: np.where(label_bits & bit, np.uint8(255), np.uint8(0)) for name, bit in color_bits.items()
+    }
+    return channel_tables, mask_tables
+
+def get_color_labels(hsv):
+    # Every pixel's colour memberships as one uint8 label, in one pass over the image
+    channel_tables, _ = get_label_tables()
+    labels = None
+    for plane, table in zip(cv2.split(hsv), channel_tables):
+        plane_labels = cv2.LUT(plane, table)
+        labels = plane_labels if labels is None else cv2.add(labels, plane_labels)
+    return labels
+
+def get_color_mask(image, color_name, context=None):
+    _, mask_tables = get_label_tables()
+    table = mask_tables.get(color_name.lower())
+    if table is None:
+        return np.zeros(image.shape[:2], dtype="uint8")
+
+    labels = image_context.get_context(image, context=context).color_labels
+    return cv2.LUT(labels, table)
+
+def get_color_areas(image, context=None):
+    # Pixel count of every colour before cleaning, from the label histogram
+    _, mask_tables = get_label_tables()
+    counts = image_context.get_context(image, context=context).label_counts
+    return {name: int(counts[table > 0].sum()) for name, table in mask_tables.items()}
+
 def get_color_name_from_hsv(h, s, v):
     if s < 60:
         if v < 40: return 'black'
@@ -46,7 +129,7 @@ def get_color_name_from_hsv(h, s, v):
     
     return 'gray'
 
-def get_dominant_color_name(image, x, y, kernel_size=5):
+def get_dominant_color_name(image, x, y, kernel_size=5, context=None):
     h, w = image.shape[:2]
     
     x1 = max(0, x - kernel_size // 2)
@@ -58,22 +141,19 @@ def get_dominant_color_name(image, x, y, kernel_size=5):
     if roi.size == 0:
         return None
         
-    hsv_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
+    if context is not None:
+        hsv_roi = context.hsv[y1:y2, x1:x2]
+    else:
+        hsv_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
     avg_hsv = np.mean(hsv_roi, axis=(0, 1))
     
     return get_color_name_from_hsv(avg_hsv[0], avg_hsv[1], avg_hsv[2])
 
-def isolate_color(image, color_name):
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    ranges = get_color_ranges(color_name)
-    
-    if not ranges:
+def isolate_color(image, color_name, context=None):
+    if not get_color_ranges(color_name):
         return image
         
-    mask_final = np.zeros(image.shape[:2], dtype="uint8")
-    for (lower, upper) in ranges:
-        mask = cv2.inRange(hsv, lower, upper)
-        mask_final = cv2.bitwise_or(mask_final, mask)
+    mask_final = get_color_mask(image, color_name, context=context)
         
     kernel = np.ones((3,3), np.uint8)
     mask_final = cv2.morphologyEx(mask_final, cv2.MORPH_OPEN, kernel, iterations=2)
@@ -101,17 +181,25 @@ def keep_component_at_point(mask, point):
     
     return new_mask
 
-def get_isolation_mask(image, color_name, click_point=None):
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    ranges = get_color_ranges(color_name)
+def keep_largest_component(mask):
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
     
-    if not ranges:
-        return np.zeros(image.shape[:2], dtype="uint8")
+    if num_labels <= 1:
+        return np.zeros_like(mask)
         
-    mask_final = np.zeros(image.shape[:2], dtype="uint8")
-    for (lower, upper) in ranges:
-        mask = cv2.inRange(hsv, lower, upper)
-        mask_final = cv2.bitwise_or(mask_final, mask)
+    # Label 0 is background
+    target_label = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    
+    new_mask = np.zeros_like(mask)
+    new_mask[labels == target_label] = 255
+    
+    return new_mask
+
+def clean_color_mask(image, color_name, context=None):
+    mask_final = get_color_mask(image, color_name, context=context)
+    if not cv2.countNonZero(mask_final):
+        # Colour absent from the image: nothing to clean
+        return mask_final
         
     # Clean up mask (Dilation followed by Erosion)
     kernel = np.ones((3,3), np.uint8)
@@ -121,30 +209,104 @@ def get_isolation_mask(image, color_name, click_point=None):
     # Closing
     mask_final = cv2.morphologyEx(mask_final, cv2.MORPH_CLOSE, kernel, iterations=4)
     
-    # Filter by connected component
-    if click_point:
-        mask_final = keep_component_at_point(mask_final, click_point)
+    return mask_final
+
+def get_color_components(image, color_name, context=None):
+    # Labelled components of the cleaned colour mask, cached per colour on the context
+    context = image_context.get_context(image, context=context)
+    key = color_name.lower()
+    
+    components = context.components
+    if key in components:
+        components.move_to_end(key)
+        return components[key]
         
+    mask = clean_color_mask(image, color_name, context=context)
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    
+    components[key] = (labels, stats)
+    while len(components) > COMPONENT_CACHE_SIZE:
+        components.popitem(last=False)
+        
+    return labels, stats
+
+def finish_mask(mask_final):
     # Fill Holes
     contours, _ = cv2.findContours(mask_final, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if contours:
         cv2.drawContours(mask_final, contours, -1, 255, thickness=cv2.FILLED)
  
     # Smooth Edges
-    smooth_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (15, 15))
+    smooth_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, SMOOTH_KERNEL_SIZE)
     mask_final = cv2.morphologyEx(mask_final, cv2.MORPH_CLOSE, smooth_kernel)
     mask_final = cv2.morphologyEx(mask_final, cv2.MORPH_OPEN, smooth_kernel)
 
     return mask_final
 
+def finish_component(labels, stats, label):
+    # (box, mask) of one labelled component, finished on a crop: (x1, y1, x2, y2) and the mask inside it.
+    # Closing then opening never reaches further than one kernel from the blob,
+    # so finishing a padded crop around it gives the same pixels as the full frame
+    h, w = labels.shape
+    pad = max(SMOOTH_KERNEL_SIZE) + 1
+    x, y, bw, bh = stats[label, :4]
+    x1, y1 = max(0, x - pad), max(0, y - pad)
+    x2, y2 = min(w, x + bw + pad), min(h, y + bh + pad)
+    
+    crop = np.where(labels[y1:y2, x1:x2] == label, np.uint8(255), np.uint8(0))
+    return (x1, y1, x2, y2), finish_mask(crop)
+
+def get_component_mask(labels, stats, point):
+    h, w = labels.shape
+    px, py = point
+    target_label = labels[py, px]
+    
+    if target_label == 0:
+        return np.zeros((h, w), dtype="uint8")
+        
+    (x1, y1, x2, y2), crop = finish_component(labels, stats, target_label)
+    
+    mask_final = np.zeros((h, w), dtype="uint8")
+    mask_final[y1:y2, x1:x2] = crop
+    
+    return mask_final
+
+def get_component_crops(image, color_name, min_area=0, context=None):
+    # Every component of the colour with at least min_area pixels, largest first, as finished (box, mask) crops
+    if not get_color_ranges(color_name):
+        return []
+        
+    labels, stats = get_color_components(image, color_name, context=context)
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    order = 1 + np.argsort(-areas, kind="stable")
+    
+    return [finish_component(labels, stats, label) for label in order if stats[label, cv2.CC_STAT_AREA] >= min_area]
+
+def get_isolation_mask(image, color_name, click_point=None, context=None):
+    if not get_color_ranges(color_name):
+        return np.zeros(image.shape[:2], dtype="uint8")
+        
+    # Filter by connected component
+    if click_point:
+        h, w = image.shape[:2]
+        px, py = click_point
+        if 0 <= px < w and 0 <= py < h:
+            labels, stats = get_color_components(image, color_name, context=context)
+            return get_component_mask(labels, stats, click_point)
+            
+    mask_final = clean_color_mask(image, color_name, context=context)
+    
+    return finish_mask(mask_final)
+
 def apply_mask_to_image(image, mask, darken_factor=0.0):
     if darken_factor == 0.0:
-        return cv2.bitwise_and(image, image, mask=mask)
+        result = np.zeros_like(image)
+        cv2.copyTo(image, mask, result)
+        return result
         
-    fg = cv2.bitwise_and(image, image, mask=mask)
-    
-    mask_inv = cv2.bitwise_not(mask)
-    bg = cv2.bitwise_and(image, image, mask=mask_inv)
-    bg = (bg * darken_factor).astype(np.uint8)
+    # Darken every pixel through a table, then copy the masked pixels back untouched
+    table = (np.arange(256) * darken_factor).astype(np.uint8)
+    result = cv2.LUT(image, table)
+    cv2.copyTo(image, mask, result)
     
-    return cv2.add(fg, bg)
+    return result
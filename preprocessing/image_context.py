@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+class cached_plane:
+    # Like functools.cached_property, but threads that ask for a plane while another is computing it
+    # wait for that result instead of computing their own copy (cached_property has no lock on 3.12+)
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        values = instance.__dict__
+        if self.name not in values:
+            with instance._plane_lock(self.name):
+                if self.name not in values:
+                    values[self.name] = self.func(instance)
+        return values[self.name]
+
+class ImageContext:
+    # Lazily computed, memoized planes of one image (and optionally its mask).
+    # Safe to share between stage threads: each plane is computed at most once.
+    def __init__(self, image, mask=None):
+        self.image = image
+        self.mask = mask
+        # Colour name -> (labels, stats), filled by hue_isolator.get_color_components
+        self.components = OrderedDict()
+        # One lock per plane, so planes built from other planes (color_labels from hsv) do not deadlock
+        self._plane_locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _plane_lock(self, name):
+        with self._locks_lock:
+            return self._plane_locks.setdefault(name, threading.Lock())
+
+    @cached_plane
+    def gray(self):
+        if len(self.image.shape) == 3:
+            return cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self.image
+
+    @cached_plane
+    def hsv(self):
+        return cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV)
+
+    @cached_plane
+    def color_labels(self):
+        # Per-pixel colour membership label, see hue_isolator.get_label_tables
+        from preprocessing import hue_isolator
+        return hue_isolator.get_color_labels(self.hsv)
+
+    @cached_plane
+    def label_counts(self):
+        # Pixels per colour label; calcHist counts in float32, which is only approximate
+        # past 2**24 pixels per label, but presence and area thresholds do not mind
+        hist = cv2.calcHist([self.color_labels], [0], None, [256], [0, 256])
+        return hist.ravel().astype(np.int64)
+
+    @cached_plane
+    def snap_gray(self):
+        # Edge-preserving blur used to snap stitches to the darkest nearby pixel
+        return cv2.bilateralFilter(self.gray, d=9, sigmaColor=75, sigmaSpace=75)
+
+    @cached_plane
+    def distance(self):
+        if self.mask is None:
+            return None
+        return cv2.distanceTransform(self.mask, cv2.DIST_L2, 5)
+
+    def with_mask(self, mask):
+        # Same image, new mask: keep the image-only planes, drop mask-derived ones
+        context = ImageContext(self.image, mask)
+        context.components = self.components
+        for name in ('gray', 'hsv', 'color_labels', 'label_counts', 'snap_gray'):
+            if name in self.__dict__:
+                context.__dict__[name] = self.__dict__[name]
+        return context
+
+def get_context(image, mask=None, context=None):
+    if context is not None:
+        return context
+    return ImageContext(image, mask)
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import unittest
+import threading
+import http.client
+
+from crochet.server import AnalysisServer, AnalysisService
+
+IMAGES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_images")
+
+def read_image(name):
+    with open(os.path.join(IMAGES, name), "rb") as f:
+        return f.read()
+
+class LocalServer:
+    # AnalysisServer on a free localhost port, served from a background thread
+    def __init__(self, **service_args):
+        self.service = AnalysisService(**service_args)
+        self.service.warm()
+        self.server = AnalysisServer(("127.0.0.1", 0), self.service)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def request(self, method, path, body=None, headers=None):
+        # (status, decoded JSON body)
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def raw_post(self, path, headers):
+        # POST with exactly these headers, e.g. a Content-Length http.client would not send
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+        try:
+            connection.putrequest("POST", path)
+            for name, value in headers.items():
+                connection.putheader(name, value)
+            connection.endheaders()
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+
+class ServerTest(unittest.TestCase):
+    # One worker and no queue, so a second distinct request while one runs is refused
+    @classmethod
+    def setUpClass(cls):
+        cls.local = LocalServer(workers=1, queue_size=0)
+        cls.up_8 = read_image("up_8_stitches.jpeg")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.local.close()
+
+    def test_analyze(self):
+        status, record = self.local.request("POST", "/analyze?x=1500&y=1650", self.up_8)
+        self.assertEqual(status, 200)
+        self.assertEqual(record["count"], 8)
+        self.assertEqual(record["direction"], "UP")
+        self.assertNotIn("error", record)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.local.raw_post("/analyze", {"Content-Length": "abc"})[0], 400)
+        self.assertEqual(self.local.raw_post("/analyze", {"Content-Length": "-5"})[0], 400)
+        self.assertEqual(self.local.request("POST", "/analyze", b"not an image")[0], 400)
+        self.assertEqual(self.local.request("POST", "/analyze?point=2,0", self.up_8)[0], 400)
+        self.assertEqual(self.local.request("POST", "/analyze?color=mauve", self.up_8)[0], 400)
+        self.assertEqual(self.local.request("GET", "/nowhere")[0], 404)
+
+    def test_failed_analysis(self):
+        status, record = self.local.request("POST", "/analyze?color=purple", self.up_8)
+        self.assertEqual(status, 422)
+        self.assertIn("error", record)
+
+    def test_backpressure(self):
+        # Hold the only slot with one analysis, then send a different image
+        first = {}
+        thread = threading.Thread(
+            target=lambda: first.update(result=self.local.request("POST", "/analyze?x=1500&y=1650&points=1", self.up_8))
+        )
+        thread.start()
+        deadline = time.monotonic() + 30
+        while self.local.service.metrics()["admitted"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        status, payload = self.local.request("POST", "/analyze", read_image("left_5_stitches.jpeg"))
+        thread.join()
+        self.assertEqual(status, 429)
+        self.assertIn("error", payload)
+        self.assertEqual(first["result"][0], 200)
+
+        metrics = self.local.request("GET", "/metrics")[1]
+        self.assertGreaterEqual(metrics["responses"]["429"], 1)
+        self.assertGreaterEqual(metrics["counters"]["rejected"], 1)
+        self.assertEqual(metrics["admitted"], 0)
+
+    def test_metrics(self):
+        self.local.raw_post("/analyze", {"Content-Length": "abc"})
+        status, metrics = self.local.request("GET", "/metrics")
+        self.assertEqual(status, 200)
+        self.assertEqual(metrics["workers"], 1)
+        self.assertGreaterEqual(metrics["responses"]["400"], 1)
+        self.assertEqual(metrics["request_seconds"]["count"], sum(metrics["responses"].values()))
+
+class TimeoutTest(unittest.TestCase):
+    # A deadline already past when the worker starts, so the analysis stops at its first stage
+    @classmethod
+    def setUpClass(cls):
+        cls.local = LocalServer(workers=1, queue_size=0, timeout=0.001)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.local.close()
+
+    def test_timeout(self):
+        status, payload = self.local.request("POST", "/analyze", read_image("up_8_stitches.jpeg"))
+        self.assertEqual(status, 504)
+        self.assertIn("error", payload)
+
+        metrics = self.local.request("GET", "/metrics")[1]
+        self.assertEqual(metrics["responses"]["504"], 1)
+
+if __name__ == "__main__":
+    unittest.main()